@@ -1,33 +1,47 @@
 from GMLID.logging import setup_logging, get_logger
-from GMLID.setup import setup_GMLID
+from GMLID.setup import setup_GMLID, create_headless_context
 
 import GMLID.physics as physics
-from GMLID.physics.system import System, Lens
+from GMLID.physics.system import System, Lens, LensArray
 from GMLID.physics.analytical import (
     get_amplification_at_position,
     get_critical_curves,
     apply_lens_equation,
 )
-from GMLID.physics.numerical import IRSDeflectionMap, IRSHistogram
+from GMLID.physics.numerical import IRSDeflectionMap, IRSHistogram, IRSPolygonMap
+
+import GMLID.resources as resources
+from GMLID.resources import get_resources, release_resources
 
 import GMLID.io as io
 from GMLID.io import dump_histogram, load_histogram, dump_system, load_system
 
+import GMLID.archive as archive
+from GMLID.archive import IRSArchive
+
 __all__ = (
     "setup_logging",
     "get_logger",
     "setup_GMLID",
+    "create_headless_context",
     "physics",
     "System",
     "Lens",
+    "LensArray",
     "get_amplification_at_position",
     "get_critical_curves",
     "apply_lens_equation",
     "IRSDeflectionMap",
     "IRSHistogram",
+    "IRSPolygonMap",
+    "resources",
+    "get_resources",
+    "release_resources",
     "io",
     "dump_histogram",
     "load_histogram",
     "dump_system",
     "load_system",
+    "archive",
+    "IRSArchive",
 )
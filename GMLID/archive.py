@@ -0,0 +1,397 @@
+"""
+An archive of many maps with an index of their parameters.
+
+Sweeps produce thousands of histograms, and with one file per system finding every
+map in a range of parameters means opening every file. The IRSArchive instead
+appends each map as a block of one data file, aligned to IRS_ARCHIVE_ALIGNMENT so it
+can be memory mapped in place, and records its parameters as one fixed size record
+of an index file. The whole index is a structured NumPy array, so queries are
+vectorised comparisons and only the blocks that are used are ever read.
+
+An archive is a directory of four files:
+    blocks.bin  The map blocks, stored as they are on the GPU (see `flipped`)
+    lenses.bin  The mass and position of every lens as little endian float64 triples
+    index.bin   One IRS_ARCHIVE_INDEX_DTYPE record per map
+    lock        Locked by writers, so several processes can append at once
+
+A record is only written once its block and lenses are, so readers never see a
+partial map. Readers pick up maps appended by other processes with `refresh()`.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Generator
+
+import numpy as np
+
+from GMLID.logging import get_logger
+from GMLID.physics.system import System, create_lenses
+from GMLID.physics.numerical import (
+    IRSDeflectionMap,
+    IRSHistogram,
+    IRSCausticMap,
+    IRSMagnificationMap,
+    get_rays_per_pixel,
+)
+from GMLID.physics.shared import read_texture_into
+
+logger = get_logger("archive")
+try:
+    from fcntl import flock, LOCK_EX, LOCK_UN
+
+    _USE_LOCK = True
+except ImportError:
+    logger.warning("Failed to import fcntl, archives can't be appended to by concurrent writers")
+
+    flock = None
+    _USE_LOCK = False
+
+# The alignment of every block in the data file, a page so blocks map cleanly
+IRS_ARCHIVE_ALIGNMENT: int = 4096
+
+IRS_ARCHIVE_INDEX_DTYPE: np.dtype = np.dtype(
+    [
+        ("offset", "<i8"),  # The byte offset of the block in blocks.bin
+        ("nbytes", "<i8"),
+        ("kind", "S16"),  # "histogram", "deflection", "magnification" or "caustic"
+        ("dtype", "S8"),
+        ("height", "<i8"),
+        ("width", "<i8"),
+        ("components", "<i8"),
+        ("flipped", "?"),  # Whether the rows are stored from the bottom, as on the GPU
+        ("storage", "S8"),  # How a deflection map was stored on the GPU
+        ("lens_offset", "<i8"),  # The first lens in lenses.bin
+        ("lens_count", "<i8"),
+        ("lens_distance", "<f8"),  # In parsecs (pc)
+        ("source_distance", "<f8"),  # In parsecs (pc)
+        ("mass", "<f8"),  # In solar masses (M*)
+        ("q", "<f8"),  # The lightest over the heaviest lens mass, nan for a single lens
+        ("separation", "<f8"),  # Between the two most massive lenses in Au
+        ("separation_einstein", "<f8"),  # The same separation in Einstein radii
+        ("einstein_angle", "<f8"),  # In radians (rad)
+        ("viewport_x", "<f8"),  # In Einstein radii
+        ("viewport_y", "<f8"),
+        ("centre_x", "<f8"),  # The centre of the viewport in the source plane in Einstein radii
+        ("centre_y", "<f8"),
+        ("ray_count", "<i8"),  # The rays along each axis of the level
+        ("level", "<i8"),  # The level of a progressive histogram
+        ("iterations", "<i8"),
+        ("rays_per_pixel", "<f8"),  # The rays per pixel without lenses, nan if not a histogram
+        ("delay", "<f8"),  # nan if there was no delay
+    ]
+)
+_LENS_DTYPE = np.dtype("<f8")
+
+
+def _get_system_parameters(system: System) -> dict[str, Any]:
+    m, x, y = system.get_lens_columns()
+    if len(m) > 1:
+        q = float(np.min(m) / np.max(m))
+        # Large populations have too many pairs to compare, and a binary lens query
+        # means the separation of the two lenses which dominate anyway
+        first, second = np.argpartition(-m, 1)[:2]
+        separation = float(np.hypot(x[first] - x[second], y[first] - y[second]))
+    else:
+        q, separation = float("nan"), 0.0
+    return {
+        "lens_count": len(m),
+        "lens_distance": system.lens_distance,
+        "source_distance": system.source_distance,
+        "mass": system.mass,
+        "q": q,
+        "separation": separation,
+        "separation_einstein": separation / system.lens_radius if len(m) > 1 else 0.0,
+        "einstein_angle": system.einstein_angle,
+    }
+
+
+class IRSArchive:
+    """
+    The IRSArchive appends maps to, and queries maps in, an archive directory. With
+    `create` a missing archive is created, otherwise opening it fails.
+
+    `index` holds a record of every map, with the parameters of its system, so
+    `query()` can find maps without touching their blocks. `get_block()` maps a block
+    straight from the file, so nothing is read until its values are used.
+    """
+
+    def __init__(self, path: Path | str, create: bool = True) -> None:
+        self._path: Path = Path(path)
+        if not (self._path / "index.bin").exists():
+            if not create:
+                logger.error(f"{self._path} is not an archive")
+                raise ValueError(f"{self._path} is not an archive")
+            self._path.mkdir(parents=True, exist_ok=True)
+            for name in ("blocks.bin", "lenses.bin", "index.bin", "lock"):
+                (self._path / name).touch()
+            logger.debug(f"Created the archive {self._path}")
+
+        self._index: np.ndarray = np.empty((0,), dtype=IRS_ARCHIVE_INDEX_DTYPE)
+        self._lenses: np.ndarray = np.empty((0, 3), dtype=_LENS_DTYPE)
+        self.refresh()
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def index(self) -> np.ndarray:
+        return self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def refresh(self):
+        """
+        Read the records and lenses appended since the archive was last read.
+        """
+        itemsize = IRS_ARCHIVE_INDEX_DTYPE.itemsize
+        count = (self._path / "index.bin").stat().st_size // itemsize
+        if count == len(self._index):
+            return
+        # Only whole records are read, in case another writer is midway through one
+        records = np.fromfile(
+            self._path / "index.bin",
+            dtype=IRS_ARCHIVE_INDEX_DTYPE,
+            count=count - len(self._index),
+            offset=len(self._index) * itemsize,
+        )
+        self._index = np.concatenate((self._index, records))
+        lenses = int(np.max(self._index["lens_offset"] + self._index["lens_count"]))
+        if lenses == 0:
+            return
+        self._lenses = np.memmap(
+            self._path / "lenses.bin", dtype=_LENS_DTYPE, mode="r", shape=(lenses, 3)
+        )
+
+    @contextmanager
+    def _lock(self) -> Generator[None, None, None]:
+        if not _USE_LOCK:
+            yield
+            return
+        with open(self._path / "lock", "r+b") as fp:
+            flock(fp.fileno(), LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(fp.fileno(), LOCK_UN)
+
+    def _append(
+        self,
+        kind: str,
+        shape: tuple[int, ...],
+        dtype: np.dtype,
+        system: System,
+        write: Callable[[np.ndarray], None],
+        **parameters: Any,
+    ) -> int:
+        record = np.zeros((), dtype=IRS_ARCHIVE_INDEX_DTYPE)
+        record["rays_per_pixel"] = record["delay"] = float("nan")
+        for name, value in {**parameters, **_get_system_parameters(system)}.items():
+            record[name] = value
+        record["kind"] = kind.encode()
+        record["dtype"] = dtype.str.encode()
+        record["height"], record["width"] = shape[:2]
+        record["components"] = shape[2] if len(shape) > 2 else 1
+        record["nbytes"] = int(np.prod(shape)) * dtype.itemsize
+        lenses = np.stack(system.get_lens_columns(), axis=-1).astype(_LENS_DTYPE)
+
+        with self._lock():
+            blocks = self._path / "blocks.bin"
+            size = blocks.stat().st_size
+            offset = -(-size // IRS_ARCHIVE_ALIGNMENT) * IRS_ARCHIVE_ALIGNMENT
+            record["offset"] = offset
+            with open(blocks, "r+b") as fp:
+                fp.truncate(offset + int(record["nbytes"]))
+            block = np.memmap(blocks, dtype=dtype, mode="r+", offset=offset, shape=shape)
+            write(block)
+            block.flush()
+            del block
+
+            with open(self._path / "lenses.bin", "ab") as fp:
+                record["lens_offset"] = fp.tell() // (3 * _LENS_DTYPE.itemsize)
+                fp.write(lenses.tobytes())
+
+            # The record goes last, once everything it points to has been written
+            with open(self._path / "index.bin", "ab") as fp:
+                entry = fp.tell() // IRS_ARCHIVE_INDEX_DTYPE.itemsize
+                fp.write(record.tobytes())
+
+        logger.debug(f"Appended a {shape} {kind} to {self._path} as entry {entry}")
+        self.refresh()
+        return entry
+
+    def _append_texture(self, texture, kind: str, system: System, **parameters: Any) -> int:
+        # Read straight from the GPU into the mapped block, without a copy on the host
+        w, h = texture.size
+        shape = (h, w) if texture.components == 1 else (h, w, texture.components)
+        return self._append(
+            kind,
+            shape,
+            np.dtype("<f4"),
+            system,
+            lambda block: read_texture_into(texture, memoryview(block).cast("B")),
+            flipped=True,
+            **parameters,
+        )
+
+    def append_histogram(self, histogram: IRSHistogram, level: int = 0) -> int:
+        """
+        Append the ray counts of a level of a histogram, returning its entry. The entry
+        records the ray count of the level, so it loads as a histogram of that size.
+        """
+        iterations = histogram.get_iterations(level)
+        return self._append_texture(
+            histogram.get_histogram(level),
+            "histogram",
+            histogram.system,
+            viewport_x=histogram.viewport_x,
+            viewport_y=histogram.viewport_y,
+            centre_x=histogram.centre[0],
+            centre_y=histogram.centre[1],
+            ray_count=histogram.get_level_count(level),
+            level=level,
+            iterations=iterations,
+            rays_per_pixel=get_rays_per_pixel(histogram, iterations),
+            delay=float("nan") if histogram.delay is None else histogram.delay,
+        )
+
+    def append_deflection_map(self, deflection_map: IRSDeflectionMap) -> int:
+        """
+        Append the source plane positions of a deflection map. Maps stored as residuals
+        are rebuilt on the host first.
+        """
+        parameters = {
+            "viewport_x": deflection_map.viewport_x,
+            "viewport_y": deflection_map.viewport_y,
+            "storage": deflection_map.storage.encode(),
+        }
+        if deflection_map.storage != "residual":
+            return self._append_texture(
+                deflection_map.deflection_map, "deflection", deflection_map.system, **parameters
+            )
+        return self.append_array(
+            deflection_map.read(), "deflection", deflection_map.system, **parameters
+        )
+
+    def append_magnification_map(self, magnification_map: IRSMagnificationMap) -> int:
+        histogram = magnification_map.histogram
+        return self._append_texture(
+            magnification_map.magnification_map,
+            "magnification",
+            histogram.system,
+            viewport_x=histogram.viewport_x,
+            viewport_y=histogram.viewport_y,
+            centre_x=histogram.centre[0],
+            centre_y=histogram.centre[1],
+            ray_count=histogram.ray_count,
+            iterations=histogram.iterations,
+        )
+
+    def append_caustic_map(self, caustic_map: IRSCausticMap) -> int:
+        histogram = caustic_map.histogram
+        return self.append_array(
+            caustic_map.caustic,
+            "caustic",
+            histogram.system,
+            viewport_x=histogram.viewport_x,
+            viewport_y=histogram.viewport_y,
+            centre_x=histogram.centre[0],
+            centre_y=histogram.centre[1],
+            ray_count=histogram.ray_count,
+            iterations=histogram.iterations,
+        )
+
+    def append_array(self, array: np.ndarray, kind: str, system: System, **parameters: Any) -> int:
+        """
+        Append a map already on the host, with the rows from the top. Any column of
+        IRS_ARCHIVE_INDEX_DTYPE not taken from the system can be given as a keyword.
+        """
+        array = np.asarray(array)
+        dtype = array.dtype.newbyteorder("<")
+
+        def write(block: np.ndarray):
+            block[...] = array
+
+        return self._append(kind, array.shape, dtype, system, write, **parameters)
+
+    def _check_entry(self, entry: int) -> np.void:
+        if not -len(self._index) <= entry < len(self._index):
+            logger.error(f"{self._path} has no entry {entry}, it holds {len(self._index)}")
+            raise IndexError(f"{self._path} has no entry {entry}, it holds {len(self._index)}")
+        return self._index[entry]
+
+    def get_raw_block(self, entry: int, mode: str = "r") -> np.memmap:
+        """
+        Map the block of an entry as it is stored, with the rows from the bottom if it
+        is `flipped`. The mode is that of `np.memmap`, by default read only.
+        """
+        record = self._check_entry(entry)
+        h, w, components = int(record["height"]), int(record["width"]), int(record["components"])
+        return np.memmap(
+            self._path / "blocks.bin",
+            dtype=np.dtype(record["dtype"].decode()),
+            mode=mode,
+            offset=int(record["offset"]),
+            shape=(h, w) if components == 1 else (h, w, components),
+        )
+
+    def get_block(self, entry: int) -> np.ndarray:
+        """
+        Map the block of an entry with the rows from the top, like `read()` of the map.
+        Nothing is read from disk until the values are used.
+        """
+        block = self.get_raw_block(entry)
+        return block[::-1] if self._index[entry]["flipped"] else block
+
+    def get_system(self, entry: int) -> System:
+        record = self._check_entry(entry)
+        start = int(record["lens_offset"])
+        lenses = np.array(self._lenses[start : start + int(record["lens_count"])])
+        return System.create(
+            float(record["lens_distance"]), float(record["source_distance"]), create_lenses(lenses)
+        )
+
+    def query(self, **conditions: Any) -> np.ndarray:
+        """
+        Find the entries whose index columns meet every condition. A (low, high) tuple
+        keeps values within the inclusive range, where None leaves that side open, and
+        anything else must be equal, e.g. `query(kind="histogram", q=(None, 0.3))`.
+        """
+        keep = np.ones(len(self._index), dtype=bool)
+        for name, condition in conditions.items():
+            if name not in IRS_ARCHIVE_INDEX_DTYPE.names:
+                logger.error(f"Unknown archive column {name}")
+                raise ValueError(f"Unknown archive column {name}")
+            column = self._index[name]
+            if isinstance(condition, tuple):
+                low, high = condition
+                if low is not None:
+                    keep &= column >= low
+                if high is not None:
+                    keep &= column <= high
+            else:
+                keep &= column == (condition.encode() if isinstance(condition, str) else condition)
+        return np.flatnonzero(keep)
+
+    def load_histogram(self, entry: int, deflection_map: IRSDeflectionMap) -> IRSHistogram:
+        """
+        Upload an archived histogram onto the GPU, using a deflection map of its system.
+        A level of a progressive histogram loads as a single level histogram of its size.
+        """
+        record = self._check_entry(entry)
+        if record["kind"] != b"histogram":
+            logger.error(f"Entry {entry} of {self._path} is a {record['kind'].decode()}")
+            raise ValueError(f"Entry {entry} of {self._path} is a {record['kind'].decode()}")
+        # Copy on write, as the upload needs a writable buffer but never writes to it
+        block = self.get_raw_block(entry, "c")
+        return IRSHistogram(
+            int(record["ray_count"]),
+            (int(record["width"]), int(record["height"])),
+            deflection_map,
+            viewport=(float(record["viewport_x"]), float(record["viewport_y"])),
+            centre=(float(record["centre_x"]), float(record["centre_y"])),
+            delay=None if np.isnan(record["delay"]) else float(record["delay"]),
+            iterations=int(record["iterations"]),
+            data=memoryview(block if record["flipped"] else np.ascontiguousarray(block[::-1])),
+        )
@@ -1,4 +1,4 @@
-#version 330
+#version 430
 /*
 The critical curve is the locations in the lens plane which have "infinite" amplification.
 The caustic map is the projected amplifications on the source plane.
@@ -7,17 +7,35 @@ This shader samples the IRS histogram (caustic map) based on the deflection map
 to reconstruct the critical curve.
 */
 
+// 0: interpolate the deflection map, 1: deflect directly by the lens block, 2: fetch the nearest texel
+#define MODE 0
+
+#include :gmlid:IRS_lens_lib.glsl
+#include :gmlid:IRS_deflection_lib.glsl
+
 uniform sampler2D deflectionMap;
 uniform sampler2D causticMap;
 
+uniform vec2 viewport; // Half size of the caustic map, and so the lens plane shown (2.0, 2.0) by default.
+uniform vec2 centre; // Centre of the caustic map in the source plane (0.0, 0.0) by default.
+uniform vec2 extent; // Half size of the deflection map in the lens plane (3.0, 3.0) by default.
+
 in vec2 vs_uv;
 
 out vec4 fs_colour;
 
 void main(){
-    vec2 source = (vs_uv * 2.0 / 3.0) + 1.0/6.0;
-    vec2 target = 0.25 * texture(deflectionMap, source).rg + 0.5; // convert -2.0 to 2.0 -> 0.0 to 1.0
+    vec2 position = (vs_uv * 2.0 - 1.0) * viewport;
+#if MODE == 1
+    vec2 deflected = apply_lens_equation(position);
+#elif MODE == 2
+    ivec2 texel = ivec2((0.5 * position / extent + 0.5) * vec2(textureSize(deflectionMap, 0)));
+    vec2 deflected = fetch_deflection(deflectionMap, texel);
+#else
+    vec2 deflected = sample_deflection(deflectionMap, 0.5 * position / extent + 0.5);
+#endif
+    vec2 target = 0.5 * (deflected - centre) / viewport + 0.5; // convert -viewport to viewport -> 0.0 to 1.0
     // is the target outside of the -2.0 to 2.0 range of the image? If it isn't then discard the sample
     // fs_colour = (target.x < 0.0 || 1.0 < target.x || target.y < 0.0 || 1.0 < target.y)? vec4(0.0, 0.0, 0.0, 1.0) : texture(causticMap, target);
     fs_colour = texture(causticMap, target);
-}
\ No newline at end of file
+}
@@ -0,0 +1,53 @@
+/*
+   Sampling the IRSDeflectionMap. Must be included after IRS_lens_lib.glsl.
+   Residual maps store the deflection of every lens except the dominant one,
+   which is added back exactly at the sampled position.
+   Nested maps also have high resolution patches around the lenses, packed into a grid
+   in a second texture. The first patch covering a sample is used instead of the map.
+*/
+
+// 0: the map stores source plane locations, 1: the map stores residual deflections
+#define RESIDUAL 0
+// 1: sample the lens patches where they cover the map
+#define NESTED 0
+#define MAX_PATCHES 16
+
+uniform vec3 dominant_lens; // position (xy) and einstein angle squared (z) of the dominant lens
+uniform vec2 deflection_extent; // Half size of the deflection map in the lens plane (3.0, 3.0) by default.
+
+#if NESTED == 1
+uniform sampler2D deflection_patches;
+uniform int patch_count;
+uniform ivec2 patch_grid; // The columns and rows of patches in the patch texture
+uniform vec4 patches[MAX_PATCHES]; // The centre (xy) and half size (zw) of each patch in map uv
+#endif
+
+vec2 decode_deflection(vec2 value, vec2 uv){
+#if RESIDUAL == 1
+  vec2 ray = (uv * 2.0 - 1.0) * deflection_extent;
+  return ray - value - find_deflection(ray, dominant_lens.xy, dominant_lens.z);
+#else
+  return value;
+#endif
+}
+
+vec2 sample_deflection(sampler2D map, vec2 uv){
+#if NESTED == 1
+  vec2 size = vec2(textureSize(deflection_patches, 0)) / vec2(patch_grid);
+  for (int i = 0; i < patch_count; i++){
+    vec2 local = 0.5 * (uv - patches[i].xy) / patches[i].zw + 0.5;
+    // Only use the patch between its outer texel centres, so its samples never
+    // bleed into the neighbouring patches
+    if (all(greaterThanEqual(local, 0.5 / size)) && all(lessThanEqual(local, 1.0 - 0.5 / size))){
+      vec2 cell = vec2(i % patch_grid.x, i / patch_grid.x);
+      return decode_deflection(texture(deflection_patches, (cell + local) / vec2(patch_grid)).rg, uv);
+    }
+  }
+#endif
+  return decode_deflection(texture(map, uv).rg, uv);
+}
+
+vec2 fetch_deflection(sampler2D map, ivec2 texel){
+  vec2 uv = (vec2(texel) + 0.5) / vec2(textureSize(map, 0));
+  return decode_deflection(texelFetch(map, texel, 0).rg, uv);
+}
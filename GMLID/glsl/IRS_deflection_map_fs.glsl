@@ -1,37 +1,42 @@
 #version 430
-/*
-   For inverse ray shooting (IRS) lens magnification the lens positions are stored relative to the center of mass.
-   all positions in einstein angles.
-*/
 
-struct Lens {
-  float mass; // Mass in Solar Masses
-  float einstein_sqr; // einstein angle of the lens (Squared to save on duplicate calculations)
-  vec2 position; // position in einstein angle of the whole lens system
-};
+// 0: store the location in the source plane, 1: store the deflection of every lens but the dominant one
+#define RESIDUAL 0
+// 1: also store the determinant of the lens equation's Jacobian in the second target
+#define JACOBIAN 0
+// 1: also store the Fermat potential in the second target
+#define POTENTIAL 0
 
-layout(std430) readonly buffer lensBlock {
-  int count;
-  int reserved;
-  Lens lens[];
-} lenses;
+#include :gmlid:IRS_lens_lib.glsl
 
-vec2 find_deflection(vec2 ray, vec2 lens, float radius_sqr){
-  vec2 relative = ray - lens;
-  // we don't need the sqrt because we need to normalise relative and also divide by separation which is sqrt * sqrt.
-  float separation = dot(relative, relative);
-  return radius_sqr * relative / separation;
-}
+uniform int dominant; // index of the lens left out of a residual map
 
 in vec2 vs_uv; // (x, y) location in lens place
 
-out vec4 fs_ray; // (r, g) location in source plane, (b) reserved, (a) 1.0;
+layout(location = 0) out vec4 fs_ray; // (r, g) location in source plane, (b) reserved, (a) 1.0;
+#if JACOBIAN == 1 || POTENTIAL == 1
+layout(location = 1) out vec4 fs_lens; // (r) Jacobian determinant, (g) Fermat potential
+#endif
 
 void main(){
-  vec2 fs_pos = vs_uv;
+#if RESIDUAL == 1
+  vec2 residual = vec2(0.0);
   for (int i = 0; i < lenses.count; i++){
-    fs_pos = fs_pos - find_deflection(vs_uv, lenses.lens[i].position, lenses.lens[i].einstein_sqr);
+    if (i != dominant){
+      residual = residual + find_deflection(vs_uv, lenses.lens[i].position, lenses.lens[i].einstein_sqr);
+    }
   }
-
-  fs_ray = vec4(fs_pos, 0.0, 1.0);
+  fs_ray = vec4(residual, 0.0, 1.0);
+#else
+  fs_ray = vec4(apply_lens_equation(vs_uv), 0.0, 1.0);
+#endif
+#if JACOBIAN == 1 || POTENTIAL == 1
+  fs_lens = vec4(0.0, 0.0, 0.0, 1.0);
+#endif
+#if JACOBIAN == 1
+  fs_lens.r = find_jacobian_determinant(vs_uv);
+#endif
+#if POTENTIAL == 1
+  fs_lens.g = find_fermat_potential(vs_uv);
+#endif
 }
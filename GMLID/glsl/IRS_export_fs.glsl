@@ -0,0 +1,62 @@
+#version 430
+/*
+Colour a band of rows of a texture for export. Each pixel averages a block of texels
+of the source, so thumbnails are box filtered rather than point sampled.
+
+One component maps through a colour map, after optionally taking its log10. The two
+components of a deflection map are shown as red and green with a constant blue.
+*/
+
+// 0: one component through the colour map, 1: the deflection as red and green
+#define CHANNELS 0
+// 0: linear, 1: log10 of the value
+#define SCALE 0
+
+#include :gmlid:IRS_lens_lib.glsl
+#include :gmlid:IRS_deflection_lib.glsl
+
+uniform sampler2D source;
+uniform sampler2D colour_map; // One row lookup from the lowest to highest value
+
+uniform int component;
+uniform ivec2 offset; // The pixel of the whole image at the bottom left of this band
+uniform ivec2 block; // The texels along each axis averaged into one pixel
+uniform vec2 limits; // The (scaled) values at the ends of the colour map
+uniform float blue; // The blue value of deflection maps from 0.0 to 1.0
+uniform int wrap; // 1: deflection values past the limits wrap around like uint8 instead of clamping
+
+out vec4 fs_colour;
+
+void main(){
+  ivec2 start = (ivec2(gl_FragCoord.xy) + offset) * block;
+  // Blocks on the last row and column can hang past the edge of the source
+  ivec2 end = min(start + block, textureSize(source, 0));
+
+  vec2 total = vec2(0.0);
+  for (int y = start.y; y < end.y; y++){
+    for (int x = start.x; x < end.x; x++){
+#if CHANNELS == 1
+      total += fetch_deflection(source, ivec2(x, y));
+#else
+      total.x += texelFetch(source, ivec2(x, y), 0)[component];
+#endif
+    }
+  }
+  vec2 value = total / float((end.x - start.x) * (end.y - start.y));
+
+#if CHANNELS == 1
+  vec2 level = floor((value - limits.x) / (limits.y - limits.x) * 255.0);
+  level = (wrap == 1) ? mod(level, 256.0) : clamp(level, 0.0, 255.0);
+  fs_colour = vec4(level / 255.0, blue, 1.0);
+#else
+#if SCALE == 1
+  // Zero and negative values take the bottom of the colour map
+  float scaled = (value.x > 0.0) ? log2(value.x) * 0.30102999566 : limits.x;
+#else
+  float scaled = value.x;
+#endif
+  float t = clamp((scaled - limits.x) / (limits.y - limits.x), 0.0, 1.0);
+  int size = textureSize(colour_map, 0).x;
+  fs_colour = texelFetch(colour_map, ivec2(int(t * float(size - 1)), 0), 0);
+#endif
+}
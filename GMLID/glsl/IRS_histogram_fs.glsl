@@ -1,9 +1,23 @@
-#version 330
+#version 430
+
+// 0: each ray lands in one pixel, 1: each ray is split between the four nearest pixels
+#define DEPOSIT 0
 
 in vec2 vs_uv;
 
+#if DEPOSIT == 1
+flat in vec2 vs_position; // Where the ray landed in pixels
+#endif
+
 out vec4 fs_value;
 
 void main(){
+#if DEPOSIT == 1
+  // The ray is drawn as a 2x2 point centred on where it landed, so it covers the four
+  // pixel centres around it. Each gets the bilinear weight of its distance to the ray.
+  vec2 weight = max(1.0 - abs(gl_FragCoord.xy - vs_position), 0.0);
+  fs_value = vec4(weight.x * weight.y);
+#else
   fs_value = vec4(1.0);
+#endif
 }
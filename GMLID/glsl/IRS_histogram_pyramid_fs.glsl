@@ -0,0 +1,26 @@
+#version 330
+/*
+Each level of a progressive histogram's pyramid is the rays shot at that level
+plus the sum of the 2x2 texels of the finer level, so every ray counts towards
+every coarser level.
+*/
+
+uniform sampler2D finer;
+uniform sampler2D level;
+
+out vec4 fs_value;
+
+void main(){
+  ivec2 texel = ivec2(gl_FragCoord.xy);
+  ivec2 bounds = textureSize(finer, 0);
+
+  float value = texelFetch(level, texel, 0).r;
+  for (int i = 0; i < 4; i++){
+    ivec2 fine = 2 * texel + ivec2(i & 1, i >> 1);
+    // Odd sized levels lose their last row and column rather than double counting
+    if (fine.x < bounds.x && fine.y < bounds.y){
+      value += texelFetch(finer, fine, 0).r;
+    }
+  }
+  fs_value = vec4(value);
+}
@@ -1,14 +1,39 @@
-#version 330
+#version 430
 
+// 0: each ray lands in one pixel, 1: each ray is split between the four nearest pixels
+#define DEPOSIT 0
+
+#include :gmlid:IRS_lens_lib.glsl
+#include :gmlid:IRS_deflection_lib.glsl
+#include :gmlid:IRS_ray_lib.glsl
 
 uniform sampler2D deflection_map;
 
-in ivec2 origin;
+uniform vec2 centre; // Centre of the histogram in the source plane (0.0, 0.0) by default.
+uniform vec2 scale; // Downscaling for output (-2.0 to 2.0 -> -1.0 to 1.0) by default.
+
 out vec2 vs_uv;
 
+#if DEPOSIT == 1
+uniform vec2 resolution; // Size of the histogram in pixels
+
+flat out vec2 vs_position; // Where the ray landed in pixels
+#endif
+
 void main(){
+    vec2 origin;
+    if (!get_ray_origin(origin)){
+        gl_Position = vec4(0.0, 0.0, 2.0, 1.0); // Outside of the clip volume
+        return;
+    }
+
     // For high resolution deflection maps it is not worth it to sample interpolated
     // values. This also makes the IRS deterministic rather than random
-    vec2 target = texelFetch(deflection_map, origin, 0).rg * 0.5;
-    gl_Position = vec4(target, 0.0, 1.0);
+    ivec2 texel = ivec2(origin * vec2(textureSize(deflection_map, 0)));
+    vec2 target = fetch_deflection(deflection_map, texel);
+    gl_Position = vec4((target - centre) * scale, 0.0, 1.0);
+#if DEPOSIT == 1
+    vs_position = (gl_Position.xy * 0.5 + 0.5) * resolution;
+    gl_PointSize = 2.0; // Cover the four pixel centres around the ray
+#endif
 }
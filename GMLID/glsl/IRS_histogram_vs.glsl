@@ -1,23 +1,63 @@
-#version 330
+#version 430
+
+// 0: pseudo-random jitter per iteration, 1: R2 low-discrepancy jitter
+#define JITTER 0
+// 0: interpolate the deflection map, 1: deflect each ray directly by the lens block
+#define MODE 0
+// 0: each ray lands in one pixel, 1: each ray is split between the four nearest pixels
+#define DEPOSIT 0
 
 #include :system:shaders/lib/random.glsl
+#include :gmlid:IRS_lens_lib.glsl
+#include :gmlid:IRS_deflection_lib.glsl
+#include :gmlid:IRS_ray_lib.glsl
 
 uniform sampler2D deflection_map;
 
 uniform float seed; // Random Seed P-RNG
+uniform vec2 offset; // The R2 sequence point for this iteration
 uniform vec2 shift; // Scale of Shifting
+uniform vec2 centre; // Centre of the histogram in the source plane (0.0, 0.0) by default.
 uniform vec2 scale; // Downscaling for output (-2.0 to 2.0 -> -1.0 to 1.0) by default.
+uniform vec2 extent; // Half size of the lens plane the rays are shot from (3.0, 3.0) by default.
 
-in vec2 origin;
 out vec2 vs_uv;
 
+#if DEPOSIT == 1
+uniform vec2 resolution; // Size of the histogram in pixels
+
+flat out vec2 vs_position; // Where the ray landed in pixels
+#endif
+
 void main(){
+  vec2 origin;
+  if (!get_ray_origin(origin)){
+    gl_Position = vec4(0.0, 0.0, 2.0, 1.0); // Outside of the clip volume
+    return;
+  }
+
+#if JITTER == 1
+  // Cranley-Patterson rotation. Every ray shares the same low-discrepancy sequence,
+  // but offset by a fixed per-ray amount so neighbouring rays don't move in lockstep.
+  vec2 rotation = vec2(random(origin), random(vec3(origin, 1.0)));
+  vec2 jitter = fract(offset + rotation);
+#else
   float shift_x = random(vec3(seed, origin));
   float shift_y = random(shift_x);
+  vec2 jitter = vec2(shift_x, shift_y);
+#endif
   // Adjust origin to get rays various final ray locations.
   // The mod wraps the ray around to avoid the bias the clamp sample mode has.
   // 1.0 is added to ensure the resulting origin is always positive before modulo.
-  vec2 shifted = mod(origin + shift*(vec2(shift_x, shift_y)-0.5)+1.0, 1.0);
-  vec2 target = texture(deflection_map, shifted).rg;
-  gl_Position = vec4(target*scale, 0.0, 1.0);
+  vec2 shifted = mod(origin + shift*(jitter-0.5)+1.0, 1.0);
+#if MODE == 1
+  vec2 target = apply_lens_equation((shifted * 2.0 - 1.0) * extent);
+#else
+  vec2 target = sample_deflection(deflection_map, shifted);
+#endif
+  gl_Position = vec4((target - centre) * scale, 0.0, 1.0);
+#if DEPOSIT == 1
+  vs_position = (gl_Position.xy * 0.5 + 0.5) * resolution;
+  gl_PointSize = 2.0; // Cover the four pixel centres around the ray
+#endif
 }
@@ -1,18 +1,52 @@
-#version 330
+#version 430
+/*
+Draw the lens plane view of an extended source. Surface brightness is conserved by
+lensing, so each pixel is simply the source image at the pixel's position in the
+source plane, found from the deflection map with one texture fetch.
+*/
 
-uniform sampler2D texture0;
+// 0: interpolate the deflection map, 1: deflect directly by the lens block, 2: fetch the nearest texel
+#define MODE 0
 
-uniform vec4 source;
+#include :gmlid:IRS_lens_lib.glsl
+#include :gmlid:IRS_deflection_lib.glsl
+
+uniform sampler2D deflectionMap;
+uniform sampler2D sourceImage;
+
+uniform vec2 viewport; // Half size of the lens plane shown
+uniform vec2 centre; // Centre of the lens plane shown
+uniform vec2 extent; // Half size of the deflection map in the lens plane
+uniform vec2 source_centre; // Centre of the source image in the source plane
+uniform vec2 source_size; // Half size of the source image in the source plane
+uniform vec4 background; // The colour where the source image doesn't reach
 
 in vec2 vs_uv;
+
 out vec4 fs_colour;
 
 void main(){
-  vec2 pos = texture(texture0, vs_uv).xy;
-
-  fs_colour = texture(texture0, vs_uv)*0.25 + 0.5 + vec4(vec3(1.0 - step(source.z, length(pos - source.xy))), 1.0);
-  /*if (fs_colour.r < 0.0 || 1.0 < fs_colour.r || fs_colour.g < 0.0 || 1.0 < fs_colour.g){
-    fs_colour = vec4(0.0, 0.0, 0.0, 1.0);
-  }*/
-  //fs_colour = texture(texture0, vs_uv);
+  vec2 position = centre + (vs_uv * 2.0 - 1.0) * viewport;
+#if MODE == 1
+  vec2 deflected = apply_lens_equation(position);
+#else
+  vec2 map_uv = 0.5 * position / extent + 0.5;
+  // Past the edge of the map the deflection is unknown
+  if (any(lessThan(map_uv, vec2(0.0))) || any(greaterThan(map_uv, vec2(1.0)))){
+    fs_colour = background;
+    return;
+  }
+#if MODE == 2
+  ivec2 size = textureSize(deflectionMap, 0);
+  vec2 deflected = fetch_deflection(deflectionMap, min(ivec2(map_uv * vec2(size)), size - 1));
+#else
+  vec2 deflected = sample_deflection(deflectionMap, map_uv);
+#endif
+#endif
+  vec2 target = 0.5 * (deflected - source_centre) / source_size + 0.5;
+  if (any(lessThan(target, vec2(0.0))) || any(greaterThan(target, vec2(1.0)))){
+    fs_colour = background;
+    return;
+  }
+  fs_colour = texture(sourceImage, target);
 }
@@ -0,0 +1,63 @@
+/*
+   For inverse ray shooting (IRS) lens magnification the lens positions are stored relative to the center of mass.
+   all positions in einstein angles.
+*/
+
+struct Lens {
+  float mass; // Mass in Solar Masses
+  float einstein_sqr; // einstein angle of the lens (Squared to save on duplicate calculations)
+  vec2 position; // position in einstein angle of the whole lens system
+};
+
+layout(std430, binding = 0) readonly buffer lensBlock {
+  int count;
+  int reserved;
+  Lens lens[];
+} lenses;
+
+vec2 find_deflection(vec2 ray, vec2 lens, float radius_sqr){
+  vec2 relative = ray - lens;
+  // we don't need the sqrt because we need to normalise relative and also divide by separation which is sqrt * sqrt.
+  float separation = dot(relative, relative);
+  return radius_sqr * relative / separation;
+}
+
+// Deflect a ray in the lens plane by every lens to find where it lands in the source plane.
+vec2 apply_lens_equation(vec2 ray){
+  vec2 source = ray;
+  for (int i = 0; i < lenses.count; i++){
+    source = source - find_deflection(ray, lenses.lens[i].position, lenses.lens[i].einstein_sqr);
+  }
+  return source;
+}
+
+// The shear (gamma1, gamma2) of a point lens at a ray. Point lenses have no
+// convergence so the Jacobian of the lens equation is [[1 - g1, -g2], [-g2, 1 + g1]].
+vec2 find_shear(vec2 ray, vec2 lens, float radius_sqr){
+  vec2 relative = ray - lens;
+  float separation = dot(relative, relative);
+  vec2 shear = vec2(relative.y * relative.y - relative.x * relative.x, -2.0 * relative.x * relative.y);
+  return radius_sqr * shear / (separation * separation);
+}
+
+// The determinant of the Jacobian of the lens equation, zero on the critical curves.
+float find_jacobian_determinant(vec2 ray){
+  vec2 shear = vec2(0.0);
+  for (int i = 0; i < lenses.count; i++){
+    shear = shear + find_shear(ray, lenses.lens[i].position, lenses.lens[i].einstein_sqr);
+  }
+  return 1.0 - dot(shear, shear);
+}
+
+// The Fermat potential of a ray for the source position it lands on. Images of
+// the same source are delayed by the difference in their potentials.
+float find_fermat_potential(vec2 ray){
+  vec2 deflection = vec2(0.0);
+  float potential = 0.0;
+  for (int i = 0; i < lenses.count; i++){
+    vec2 relative = ray - lenses.lens[i].position;
+    deflection = deflection + find_deflection(ray, lenses.lens[i].position, lenses.lens[i].einstein_sqr);
+    potential = potential + 0.5 * lenses.lens[i].einstein_sqr * log(dot(relative, relative));
+  }
+  return 0.5 * dot(deflection, deflection) - potential;
+}
@@ -0,0 +1,40 @@
+#version 330
+/*
+The magnification of a finite source is the average magnification over its disk.
+Each pixel sums the histogram within the source disk around it and divides by the
+rays that would land in the disk without any lenses.
+
+Large sources cover too many pixels to sum in one draw, so the kernel is split into
+tiles which are each drawn as a separate pass and added together.
+*/
+
+uniform sampler2D histogram;
+
+uniform vec2 radius; // Radius of the source in pixels along each axis
+uniform ivec2 kernel_start; // The first offset of this tile of the kernel
+uniform ivec2 kernel_end; // The last offset (exclusive) of this tile of the kernel
+uniform float normalisation; // 1.0 / (rays per pixel * pixels in the source disk)
+
+out vec4 fs_value;
+
+void main(){
+  ivec2 pixel = ivec2(gl_FragCoord.xy);
+  ivec2 bounds = textureSize(histogram, 0);
+
+  // Only the offsets that land inside the histogram are summed, as there are no rays past its edge
+  ivec2 start = max(kernel_start, -pixel);
+  ivec2 end = min(kernel_end, bounds - pixel);
+
+  float total = 0.0;
+  for (int y = start.y; y < end.y; y++){
+    // The half width of the disk along this row
+    float v = float(y) / radius.y;
+    int span = int(floor(radius.x * sqrt(max(1.0 - v * v, 0.0))));
+    int row_start = max(start.x, -span);
+    int row_end = min(end.x, span + 1);
+    for (int x = row_start; x < row_end; x++){
+      total += texelFetch(histogram, pixel + ivec2(x, y), 0).r;
+    }
+  }
+  fs_value = vec4(total * normalisation);
+}
@@ -0,0 +1,9 @@
+#version 430
+
+flat in float vs_flux;
+
+out vec4 fs_value;
+
+void main(){
+  fs_value = vec4(vs_flux);
+}
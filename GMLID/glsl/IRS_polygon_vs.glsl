@@ -0,0 +1,80 @@
+#version 430
+/*
+Inverse polygon mapping. The lens plane is split into a count x count grid of cells,
+each made of two triangles. The corners of every triangle are deflected onto the source
+plane, and the triangle is rasterised with its share of the flux spread over its area.
+A cell carries the same flux as a single ray of the IRSHistogram.
+
+Triangles smaller than a pixel may not cover any pixel centres, so they are instead
+splatted as a single point in a second pass.
+*/
+
+// 0: rasterise the triangles, 1: splat the triangles smaller than a pixel as points
+#define POINTS 0
+// 0: interpolate the deflection map, 1: deflect each corner directly by the lens block
+#define MODE 0
+
+#include :gmlid:IRS_lens_lib.glsl
+#include :gmlid:IRS_deflection_lib.glsl
+
+uniform sampler2D deflection_map;
+
+uniform int count; // Cells along each axis of the lens plane grid
+uniform vec2 offset; // Shift of the grid in cells for this iteration
+uniform vec2 centre; // Centre of the histogram in the source plane (0.0, 0.0) by default.
+uniform vec2 scale; // Downscaling for output (-2.0 to 2.0 -> -1.0 to 1.0) by default.
+uniform vec2 extent; // Half size of the lens plane the grid covers (3.0, 3.0) by default.
+uniform vec2 resolution; // Size of the histogram in pixels
+
+flat out float vs_flux;
+
+// The corners of the two triangles of a cell
+const ivec2 CORNERS[6] = ivec2[6](
+  ivec2(0, 0), ivec2(1, 0), ivec2(0, 1),
+  ivec2(1, 1), ivec2(0, 1), ivec2(1, 0)
+);
+
+vec2 get_corner(ivec2 cell, ivec2 corner){
+  vec2 uv = (vec2(cell + corner) + offset) / float(count);
+#if MODE == 1
+  vec2 target = apply_lens_equation((uv * 2.0 - 1.0) * extent);
+#else
+  vec2 target = sample_deflection(deflection_map, uv);
+#endif
+  return (target - centre) * scale;
+}
+
+void main(){
+#if POINTS == 1
+  int triangle = gl_VertexID;
+#else
+  int triangle = gl_VertexID / 3;
+#endif
+  int index = triangle / 2;
+  ivec2 cell = ivec2(index % count, index / count);
+  int first = 3 * (triangle % 2);
+  vec2 corners[3] = vec2[3](
+    get_corner(cell, CORNERS[first]),
+    get_corner(cell, CORNERS[first + 1]),
+    get_corner(cell, CORNERS[first + 2])
+  );
+
+  // The area of the triangle in pixels
+  vec2 ab = 0.5 * (corners[1] - corners[0]) * resolution;
+  vec2 ac = 0.5 * (corners[2] - corners[0]) * resolution;
+  float area = 0.5 * abs(ab.x * ac.y - ab.y * ac.x);
+
+  // A corner on top of a lens has no defined deflection
+  bool valid = !(isinf(area) || isnan(area));
+#if POINTS == 1
+  vs_flux = 0.5;
+  valid = valid && area < 1.0;
+  vec2 position = (corners[0] + corners[1] + corners[2]) / 3.0;
+#else
+  vs_flux = 0.5 / area;
+  valid = valid && area >= 1.0;
+  vec2 position = corners[gl_VertexID % 3];
+#endif
+  // Anything outside of the clip volume isn't drawn
+  gl_Position = valid ? vec4(position, 0.0, 1.0) : vec4(0.0, 0.0, 2.0, 1.0);
+}
@@ -0,0 +1,30 @@
+/*
+   The origins of the rays shot by the IRSHistogram, evenly spaced between 0.0 and 1.0 (exclusive)
+   on a count x count grid. Nothing is uploaded, the origin is derived from gl_VertexID.
+   With a region of interest only some square tiles of the grid are shot. Each instance is
+   one tile from the tile block, and the vertices are the rays within that tile.
+*/
+
+// 0: shoot the whole grid, 1: only shoot the tiles in the tile block
+#define ROI 0
+
+uniform int count; // Rays along each axis of the ray grid
+
+#if ROI == 1
+uniform int tile; // Rays along each axis of a tile
+
+layout(std430, binding = 1) readonly buffer tileBlock {
+  ivec2 tiles[];
+};
+#endif
+
+// False if the ray is past the edge of the grid and shouldn't be shot
+bool get_ray_origin(out vec2 origin){
+#if ROI == 1
+  ivec2 cell = tiles[gl_InstanceID] * tile + ivec2(gl_VertexID % tile, gl_VertexID / tile);
+#else
+  ivec2 cell = ivec2(gl_VertexID % count, gl_VertexID / count);
+#endif
+  origin = (vec2(cell) + 0.5) / float(count);
+  return cell.x < count && cell.y < count;
+}
@@ -0,0 +1,7 @@
+#version 330
+
+out vec4 fs_value;
+
+void main(){
+  fs_value = vec4(1.0);
+}
@@ -0,0 +1,32 @@
+#version 330
+/*
+Bin the log10 of every texel of a texture. Each vertex reads one texel and is drawn
+as a point on the pixel of its bin, and the points are added together with blending.
+Every batch of texels is binned into its own row, so no bin counts past the
+2^24 values a float can count exactly.
+*/
+
+uniform sampler2D source;
+uniform int component;
+uniform float scale; // Multiplies each value before it is binned
+uniform vec2 range; // The log10 of the start of the first bin and the end of the last
+uniform int bins;
+uniform int row; // The row of this batch
+uniform int rows;
+
+void main(){
+  int width = textureSize(source, 0).x;
+  ivec2 texel = ivec2(gl_VertexID % width, gl_VertexID / width);
+  float value = texelFetch(source, texel, 0)[component] * scale;
+
+  float t = (log2(value) * 0.30102999566 - range.x) / (range.y - range.x);
+  // Zero, negative and out of range values are moved off screen
+  if (!(value > 0.0) || t < 0.0 || t >= 1.0){
+    gl_Position = vec4(2.0, 2.0, 0.0, 1.0);
+    return;
+  }
+  float bin = floor(t * float(bins));
+  gl_Position = vec4(
+    (bin + 0.5) / float(bins) * 2.0 - 1.0, (float(row) + 0.5) / float(rows) * 2.0 - 1.0, 0.0, 1.0
+  );
+}
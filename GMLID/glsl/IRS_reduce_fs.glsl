@@ -0,0 +1,32 @@
+#version 330
+/*
+One pass of reducing a texture to its maximum, minimum, sum and sum of squares.
+Each texel of the pass reduces a block of texels of the source. The first pass reads
+one component of the texture being reduced, the later passes read the previous pass.
+*/
+
+uniform sampler2D source;
+uniform int first; // 1 when the source is the texture being reduced
+uniform int component; // The component of the texture being reduced
+uniform ivec2 block; // The texels of the source reduced by each texel along each axis
+
+out vec4 fs_value; // (max, min, sum, sum of squares)
+
+void main(){
+  ivec2 start = ivec2(gl_FragCoord.xy) * block;
+  // Blocks on the last row and column can hang past the edge of the source
+  ivec2 end = min(start + block, textureSize(source, 0));
+
+  vec4 result = vec4(-3.4e38, 3.4e38, 0.0, 0.0);
+  for (int y = start.y; y < end.y; y++){
+    for (int x = start.x; x < end.x; x++){
+      vec4 texel = texelFetch(source, ivec2(x, y), 0);
+      if (first == 1){
+        float value = texel[component];
+        texel = vec4(value, value, value, value * value);
+      }
+      result = vec4(max(result.x, texel.x), min(result.y, texel.y), result.zw + texel.zw);
+    }
+  }
+  fs_value = result;
+}
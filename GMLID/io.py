@@ -1,11 +1,12 @@
 from pathlib import Path
 
+import numpy as np
 from tomli_w import dump as dump_toml
 from tomllib import load as load_toml
 
 from GMLID.logging import get_logger
 from GMLID.physics.numerical import IRSDeflectionMap, IRSHistogram
-from GMLID.physics.system import Lens, System
+from GMLID.physics.system import Lens, System, create_lenses
 
 logger = get_logger("io")
 try:
@@ -35,6 +36,12 @@ _SYSTEM_INFO_SIZE = struct.calcsize("q2d")
 _LENS_SIZE = struct.calcsize("3d")
 
 _DEFLECTION_SIZE = struct.calcsize("2q")
+# The deflection block name records how the deflection map texels are stored
+_DEFLECTION_BLOCKS = {
+    "f4": b"deflection      ",
+    "f2": b"deflection f2   ",
+    "residual": b"deflection res  ",
+}
 _HISTOGRAM_SIZE = struct.calcsize("4q3d")  # ray count, iterations, size, viewport [x, y], delay
 
 
@@ -46,20 +53,24 @@ def _dump_histogram_raw(path: Path, histogram: IRSHistogram):
     count = len(system.lenses)
 
     system_size = _SYSTEM_INFO_SIZE + count * _LENS_SIZE
-    system_info = b"system          " + struct.pack(
-        f">qq2d{3 * count}d",
-        system_size,
-        count,
-        system.lens_distance,
-        system.source_distance,
-        *(val for lens in system.lenses for val in lens),
+    system_info = (
+        b"system          "
+        + struct.pack(
+            ">qq2d",
+            system_size,
+            count,
+            system.lens_distance,
+            system.source_distance,
+        )
+        + np.stack(system.get_lens_columns(), axis=-1).astype(">f8").tobytes()
     )
 
-    deflection_size = _DEFLECTION_SIZE + 8 * deflection_map.width * deflection_map.height
+    deflection_data = deflection_map.deflection_map.read()
+    deflection_size = _DEFLECTION_SIZE + len(deflection_data)
     deflection_info = (
-        b"deflection      "
+        _DEFLECTION_BLOCKS[deflection_map.storage]
         + struct.pack(">3q", deflection_size, deflection_map.width, deflection_map.height)
-        + deflection_map.deflection_map.read()
+        + deflection_data
     )
 
     histogram_size = _HISTOGRAM_SIZE + 4 * histogram.width * histogram.height
@@ -100,24 +111,31 @@ def _load_histogram_raw(path: Path) -> IRSHistogram | None:
         logger.critical(f"{path} is not a valid histogram file")
         return None
 
-    def _load_raw_block(start: int) -> tuple[str, bytes, int]:
-        block_type = str(data[start : start + 16]).strip()
+    def _load_raw_block(start: int) -> tuple[bytes, bytes, int]:
+        block_type = data[start : start + 16]
         block_size = int.from_bytes(data[start + 16 : start + 24])
         block_data = data[start + 24 : start + 24 + block_size]
         return block_type, block_data, start + 24 + block_size
 
     _, system_data, pointer = _load_raw_block(14)
-    count, lens_dist, source_dist = struct.unpack(">qddd", system_data[:24])
-    l_data = struct.unpack(f">{3 * count}d", system_data[24:])
-    lenses = (Lens(l_data[3 * i], l_data[3 * i + 1], l_data[3 * i + 2]) for i in range(count))
+    count, lens_dist, source_dist = struct.unpack(">qdd", system_data[:24])
+    lenses = create_lenses(np.frombuffer(system_data, dtype=">f8", count=3 * count, offset=24))
 
     system = System.create(lens_dist, source_dist, lenses)
 
-    _, deflection_data, pointer = _load_raw_block(pointer)
+    deflection_type, deflection_data, pointer = _load_raw_block(pointer)
+    storage = next(
+        (name for name, block in _DEFLECTION_BLOCKS.items() if block == deflection_type), None
+    )
+    if storage is None:
+        logger.critical(f"{path} has an unknown deflection block {deflection_type}")
+        return None
 
     d_width = int.from_bytes(deflection_data[0:8])
     d_height = int.from_bytes(deflection_data[8:16])
-    deflection = IRSDeflectionMap(system, (d_width, d_height), data=deflection_data[16:])
+    deflection = IRSDeflectionMap(
+        system, (d_width, d_height), storage=storage, data=deflection_data[16:]
+    )
 
     _, histogram_data, pointer = _load_raw_block(pointer)
     h_count, h_iter, h_width, h_height, h_v_x, h_v_y, h_delay = struct.unpack(
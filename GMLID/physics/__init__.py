@@ -18,8 +18,19 @@ from .util import (
     SOLAR_MASS,
     EINSTEIN_FACTOR,
     calculate_einstein_angle,
+    PLASTIC_NUMBER,
+    get_r2_offset,
+)
+from .system import LENS_DTYPE, LENS_ARRAY_THRESHOLD, Lens, LensArray, System, create_lenses
+from .source import (
+    LIMB_DARKENING_LAWS,
+    SourceProfile,
+    uniform_profile,
+    linear_profile,
+    quadratic_profile,
+    create_source_kernel,
+    create_source_image,
 )
-from .system import Lens, System
 from .analytical import (
     get_amplification_at_position,
     one_lens_amplificiation,
@@ -28,8 +39,54 @@ from .analytical import (
     one_lens_critical_curves,
     two_lens_critical_curves,
     apply_lens_equation,
+    get_lens_jacobian,
+    solve_polynomials,
+    get_two_lens_roots,
+    get_complex_images,
+    get_image_positions,
+)
+from .numerical import (
+    IRSDeflectionMap,
+    IRSHistogram,
+    IRSPolygonMap,
+    IRSCriticalMap,
+    IRSLensedImage,
+    IRSMagnificationMap,
+    IRSSourceMaps,
+    warmup_IRS_programs,
+    get_lens_equation_bounds,
+    deposit_rays,
+)
+from .reduction import IRSStatistics, IRSReducer, get_reducer, release_reducer
+from .export import (
+    IRS_EXPORT_SCALES,
+    IRS_COLOUR_MAPS,
+    get_colour_map,
+    PNGStream,
+    IRSExport,
+    export_png,
+)
+from .images import IRSImages, IRSImageIndex
+from .planner import IRSCalibration, IRSPlan, calibrate, plan_histogram
+from .shared import (
+    IRSSharedDescriptor,
+    IRSSharedMap,
+    read_texture_into,
+    publish_histogram,
+    publish_deflection_map,
+    publish_magnification_map,
+    publish_caustic_map,
+    publish_array,
+)
+from .lightcurve import (
+    FiniteSourceTables,
+    get_finite_source_tables,
+    get_finite_source_factor,
+    get_point_magnification,
+    get_one_lens_magnification,
+    get_one_lens_lightcurves,
 )
-from .numerical import IRSDeflectionMap, IRSHistogram, IRSCriticalMap
+from .contour import get_contour_magnification, get_contour_lightcurve
 
 __all__ = (
     "LIGHT_SPEED_m",
@@ -45,8 +102,21 @@ __all__ = (
     "SOLAR_MASS",
     "EINSTEIN_FACTOR",
     "calculate_einstein_angle",
+    "PLASTIC_NUMBER",
+    "get_r2_offset",
+    "LENS_DTYPE",
+    "LENS_ARRAY_THRESHOLD",
     "Lens",
+    "LensArray",
     "System",
+    "create_lenses",
+    "LIMB_DARKENING_LAWS",
+    "SourceProfile",
+    "uniform_profile",
+    "linear_profile",
+    "quadratic_profile",
+    "create_source_kernel",
+    "create_source_image",
     "get_amplification_at_position",
     "one_lens_amplificiation",
     "two_lens_amplification",
@@ -54,7 +124,51 @@ __all__ = (
     "one_lens_critical_curves",
     "two_lens_critical_curves",
     "apply_lens_equation",
+    "get_lens_jacobian",
+    "solve_polynomials",
+    "get_two_lens_roots",
+    "get_complex_images",
+    "get_image_positions",
     "IRSDeflectionMap",
     "IRSHistogram",
+    "IRSPolygonMap",
     "IRSCriticalMap",
+    "IRSLensedImage",
+    "IRSMagnificationMap",
+    "IRSSourceMaps",
+    "warmup_IRS_programs",
+    "get_lens_equation_bounds",
+    "deposit_rays",
+    "IRSStatistics",
+    "IRSReducer",
+    "get_reducer",
+    "release_reducer",
+    "IRS_EXPORT_SCALES",
+    "IRS_COLOUR_MAPS",
+    "get_colour_map",
+    "PNGStream",
+    "IRSExport",
+    "export_png",
+    "IRSImages",
+    "IRSImageIndex",
+    "IRSCalibration",
+    "IRSPlan",
+    "calibrate",
+    "plan_histogram",
+    "IRSSharedDescriptor",
+    "IRSSharedMap",
+    "read_texture_into",
+    "publish_histogram",
+    "publish_deflection_map",
+    "publish_magnification_map",
+    "publish_caustic_map",
+    "publish_array",
+    "FiniteSourceTables",
+    "get_finite_source_tables",
+    "get_finite_source_factor",
+    "get_point_magnification",
+    "get_one_lens_magnification",
+    "get_one_lens_lightcurves",
+    "get_contour_magnification",
+    "get_contour_lightcurve",
 )
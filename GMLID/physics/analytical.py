@@ -6,6 +6,9 @@ from .system import System
 
 logger = get_logger("physics.analytical")
 
+# Roots of the two lens polynomial which satisfy the lens equation to within this are images
+IMAGE_TOLERANCE: float = 1e-6
+
 
 def get_amplification_at_position(system: System, locations: np.ndarray) -> np.ndarray:
     """
@@ -46,12 +49,176 @@ def one_lens_amplificiation(system: System, locations: np.ndarray) -> np.ndarray
 
 
 def two_lens_amplification(system: System, locations: np.ndarray) -> np.ndarray:
+    """
+    The point source amplification of a two lens system, summed over the images found
+    by `get_image_positions()`. The locations are in Einstein radii relative to the
+    center of mass, like `apply_lens_equation()`.
+    """
     if len(system.lenses) != 2:
         logger.error("This amplification solution only works for one lens")
         raise ValueError("This amplification solution only works for two lenses")
 
-    logger.warning("two_lens_amplification is currently unimplemented.")
-    return np.asarray([0.0])
+    images = get_image_positions(system, locations)
+    found = np.all(np.isfinite(images), axis=-1)
+    magnifications = np.zeros(found.shape)
+    magnifications[found] = np.abs(1.0 / np.linalg.det(get_lens_jacobian(system, images[found])))
+    return np.sum(magnifications, axis=-1)
+
+
+def _get_complex_lenses(system: System) -> tuple[np.ndarray, np.ndarray]:
+    positions = system.get_packed_positions()
+    return positions[:, 0] + 1j * positions[:, 1], system.get_mass_fractions()
+
+
+def _multiply_polynomials(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # The product of batches of polynomials with their coefficients from the highest power
+    shape = np.broadcast_shapes(a.shape[:-1], b.shape[:-1])
+    result = np.zeros(shape + (a.shape[-1] + b.shape[-1] - 1,), dtype=np.complex128)
+    for idx in range(a.shape[-1]):
+        result[..., idx : idx + b.shape[-1]] += a[..., idx, None] * b
+    return result
+
+
+def get_two_lens_roots(
+    system: System, sources: np.ndarray, guesses: np.ndarray | None = None
+) -> np.ndarray:
+    """
+    Get the (..., 5) roots of the complex polynomial of Witt & Mao (1995) for complex
+    source positions x + iy. Every image of the source is a root, but when the source
+    is outside of the caustics two of the roots aren't images. See `solve_polynomials()`
+    for the `guesses`.
+    """
+    (z1, z2), (m1, m2) = _get_complex_lenses(system)
+    sources = np.asarray(sources, dtype=np.complex128)
+    # The polynomial is degenerate for a source exactly at a lens
+    at_lens = (np.abs(sources - z1) < 1e-12) | (np.abs(sources - z2) < 1e-12)
+    sources = np.where(at_lens, sources + 1e-9, sources)
+
+    # Substituting the conjugate of the lens equation into itself gives
+    # (z - source) N1 N2 - D (m1 N2 + m2 N1) = 0 where D = (z - z1)(z - z2) and
+    # Ni = (conj(source) - conj(zi)) D + m1 (z - z2) + m2 (z - z1)
+    shape = sources.shape
+    D = np.asarray((1.0, -(z1 + z2), z1 * z2), dtype=np.complex128)
+    N = []
+    for lens in (z1, z2):
+        a = (np.conj(sources) - np.conj(lens))[..., None]
+        N.append(a * D + np.asarray((0.0, m1 + m2, -m1 * z2 - m2 * z1)))
+    shift = np.stack((np.ones(shape, dtype=np.complex128), -sources), axis=-1)
+    coefficients = _multiply_polynomials(shift, _multiply_polynomials(N[0], N[1]))
+    coefficients[..., 1:] -= _multiply_polynomials(D, m1 * N[1] + m2 * N[0])
+
+    return solve_polynomials(coefficients.reshape((-1, 6)), guesses).reshape(shape + (5,))
+
+
+def _get_aberth_steps(coefficients: np.ndarray, roots: np.ndarray) -> np.ndarray:
+    # The arrays are (degree, N) so each root of the batch is contiguous
+    value = np.zeros_like(roots)
+    slope = np.zeros_like(roots)
+    for idx in range(coefficients.shape[0]):
+        slope = slope * roots + value
+        value = value * roots + coefficients[idx]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        newton = value / slope
+        # The repulsion of the other roots, each pair is only divided once
+        repulsion = np.zeros_like(roots)
+        for i in range(len(roots)):
+            for j in range(i + 1, len(roots)):
+                inverse = 1.0 / (roots[i] - roots[j])
+                repulsion[i] += inverse
+                repulsion[j] -= inverse
+        steps = newton / (1.0 - newton * repulsion)
+    return np.where(np.isfinite(steps), steps, 0.0)
+
+
+def solve_polynomials(
+    coefficients: np.ndarray, guesses: np.ndarray | None = None, iterations: int = 64
+) -> np.ndarray:
+    """
+    Find every root of a (N, degree + 1) batch of complex polynomials, with their
+    coefficients from the highest power, by the Aberth-Ehrlich method. Good `guesses`
+    of the (N, degree) roots, such as the roots of a nearby polynomial, cut the
+    iterations down to a few. Polynomials which don't converge fall back on the
+    eigenvalues of their companion matrix.
+    """
+    coefficients = np.asarray(coefficients, dtype=np.complex128)
+    count, degree = coefficients.shape[0], coefficients.shape[1] - 1
+    monic = coefficients[:, 1:] / coefficients[:, :1]
+    if guesses is None:
+        # Spread the guesses around a circle bounding the roots, off the real axis so
+        # the guesses aren't symmetric with a real polynomial
+        centre = -monic[:, :1] / degree
+        radius = np.max(np.abs(monic) ** (1.0 / np.arange(1, degree + 1)), axis=-1) + 1.0
+        angles = 2.0 * np.pi * np.arange(degree) / degree + 0.4
+        guesses = centre + radius[:, None] * np.exp(1j * angles)
+    roots = np.array(np.reshape(guesses, (count, degree)).T, dtype=np.complex128)
+    transposed = coefficients.T
+
+    # Only the polynomials which haven't converged are iterated
+    active = np.arange(count)
+    for _ in range(iterations):
+        steps = _get_aberth_steps(transposed[:, active], roots[:, active])
+        roots[:, active] -= steps
+        # The convergence is cubic, so the last step leaves the roots far more precise
+        moving = np.any(np.abs(steps) > 1e-12 * (1.0 + np.abs(roots[:, active])), axis=0)
+        active = active[moving]
+        if len(active) == 0:
+            break
+    roots = roots.T
+
+    if len(active):
+        companion = np.zeros((len(active), degree, degree), dtype=np.complex128)
+        companion[:, 0, :] = -monic[active]
+        companion[:, np.arange(1, degree), np.arange(degree - 1)] = 1.0
+        roots[active] = np.linalg.eigvals(companion)
+    return roots
+
+
+def get_complex_images(
+    system: System, sources: np.ndarray, guesses: np.ndarray | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the candidate images of complex source positions x + iy (in Einstein radii
+    relative to the center of mass) of a one or two lens system, and whether each
+    candidate is an image. One lens gives (..., 2) candidates and two lenses (..., 5),
+    whose roots can be started from `guesses` (see `solve_polynomials()`).
+    """
+    positions, fractions = _get_complex_lenses(system)
+    sources = np.asarray(sources, dtype=np.complex128)
+    count = len(positions)
+    if count == 1:
+        # Both images lie on the line through the lens and the source. A source right
+        # on the lens has a ring of images, so it is moved off the lens slightly
+        relative = sources - positions[0]
+        relative = np.where(np.abs(relative) < 1e-12, 1e-9, relative)
+        root = np.sqrt(1.0 + 4.0 / np.abs(relative) ** 2)
+        scale = np.stack((0.5 * (1.0 + root), 0.5 * (1.0 - root)), axis=-1)
+        images = positions[0] + relative[..., None] * scale
+        return images, np.ones(images.shape, dtype=bool)
+    elif count != 2:
+        logger.error(
+            f"No analytical images for a {count} lens system. Use GMLID.physics.images instead"
+        )
+        raise ValueError(
+            f"No analytical images for a {count} lens system. Use GMLID.physics.images instead"
+        )
+
+    images = get_two_lens_roots(system, sources, guesses)
+    deflection = np.sum(fractions / np.conj(images[..., None] - positions), axis=-1)
+    residual = np.abs(images - deflection - sources[..., None])
+    return images, residual <= IMAGE_TOLERANCE * (1.0 + np.abs(sources[..., None]))
+
+
+def get_image_positions(system: System, locations: np.ndarray) -> np.ndarray:
+    """
+    Get the images of (N, 2) source positions in Einstein radii relative to the center
+    of mass of a one or two lens system. Returns (N, 2, 2) positions for one lens, or
+    (N, 5, 2) for two, where the candidates which aren't images are nan.
+    """
+    locations = np.asarray(locations, dtype=np.float64)
+    images, real = get_complex_images(system, locations[..., 0] + 1j * locations[..., 1])
+    positions = np.stack((images.real, images.imag), axis=-1)
+    positions[~real] = np.nan
+    return positions
 
 
 def get_critical_curves(system: System, count: int) -> np.ndarray:
@@ -136,20 +303,12 @@ def two_lens_critical_curves(system: System, count: int) -> np.ndarray:
 
 
 def apply_lens_equation(system: System, locations: np.ndarray) -> np.ndarray:
-    c_x = system.com_x
-    c_y = system.com_y
-
-    M = system.mass
-
-    Rl = system.lens_radius
+    # Get lens positions relative to com and normalised, and their mass fractions
+    positions = system.get_packed_positions()
+    fractions = system.get_mass_fractions()
 
     results = np.copy(locations)
-    for lens in system.lenses:
-        # Get lens positions relative to com and normalised
-        pos = (lens.x - c_x) / Rl, (lens.y - c_y) / Rl
-        # Get the mass fraction of the lens
-        fraction = lens.m / M
-
+    for pos, fraction in zip(positions, fractions):
         # find the difference and compute lens diflection
         diff = locations - pos
         sep = np.vecdot(diff, diff).reshape((locations.shape[0], -1))
@@ -157,3 +316,26 @@ def apply_lens_equation(system: System, locations: np.ndarray) -> np.ndarray:
         results = results - fraction * diff / sep
 
     return results
+
+
+def get_lens_jacobian(system: System, locations: np.ndarray) -> np.ndarray:
+    """
+    Get the (N, 2, 2) Jacobian of the lens equation at each location in the lens plane.
+    The magnification of an image is one over its determinant.
+    """
+    positions = system.get_packed_positions()
+    fractions = system.get_mass_fractions()
+
+    xx = np.ones(locations.shape[0])
+    yy = np.ones(locations.shape[0])
+    xy = np.zeros(locations.shape[0])
+    for pos, fraction in zip(positions, fractions):
+        diff = locations - pos
+        sep = np.vecdot(diff, diff)
+        # The shear of each lens, the derivative of its deflection is traceless
+        shear = fraction / sep**2
+        xx = xx - shear * (diff[:, 1] ** 2 - diff[:, 0] ** 2)
+        yy = yy - shear * (diff[:, 0] ** 2 - diff[:, 1] ** 2)
+        xy = xy + shear * 2.0 * diff[:, 0] * diff[:, 1]
+
+    return np.stack((np.stack((xx, xy), axis=-1), np.stack((xy, yy), axis=-1)), axis=-2)
@@ -0,0 +1,297 @@
+"""
+Finite source magnification of one and two lens systems by contour integration.
+
+The images of a uniform source disk are bounded by the images of its boundary, so
+by Green's theorem their area is an integral along the image of the boundary. The
+boundary is sampled at angles theta, the images of each sample are solved with
+`get_complex_images()`, and the images of neighbouring samples are matched into
+arcs. Each arc adds the area swept between its ends, plus a parabolic correction
+from the tangents of the images (Bozza 2010), signed by the parity of the image.
+Where the boundary crosses a caustic two images of opposite parity meet on the
+critical curve, so their arcs are joined across the gap between them.
+
+The samples are refined where the arcs are least certain, which is almost always
+next to a caustic crossing, until the estimated error is below the tolerance. Many
+source positions are integrated together, and each drops out once it converges.
+Limb darkened sources are integrated over concentric uniform disks.
+"""
+
+import numpy as np
+
+from GMLID.logging import get_logger
+
+from .system import System
+from .analytical import get_complex_images
+
+logger = get_logger("physics.contour")
+
+# The samples of the boundary each source starts with
+CONTOUR_SAMPLES: int = 64
+# The intervals of the boundary of each source bisected per round of refinement
+CONTOUR_REFINEMENT: int = 32
+# The most rounds of refinement before a source is accepted anyway
+CONTOUR_ROUNDS: int = 48
+# The uniform disks limb darkened sources are integrated over
+CONTOUR_ANNULI: int = 8
+
+
+class _Boundary:
+    # The samples of the boundaries of a batch of sources, sorted by theta
+
+    def __init__(
+        self,
+        theta: np.ndarray,
+        images: np.ndarray,
+        real: np.ndarray,
+        parity: np.ndarray,
+        tangents: np.ndarray,
+    ) -> None:
+        self.theta: np.ndarray = theta  # (N, K)
+        self.images: np.ndarray = images  # (N, K, M) complex
+        self.real: np.ndarray = real  # (N, K, M) whether each candidate is an image
+        self.parity: np.ndarray = parity  # (N, K, M) the sign of the jacobian determinant
+        self.tangents: np.ndarray = tangents  # (N, K, M) the derivative with theta
+
+    def take(self, sources: np.ndarray) -> "_Boundary":
+        return _Boundary(
+            self.theta[sources],
+            self.images[sources],
+            self.real[sources],
+            self.parity[sources],
+            self.tangents[sources],
+        )
+
+    def insert(self, other: "_Boundary") -> "_Boundary":
+        theta = np.concatenate((self.theta, other.theta), axis=1)
+        order = np.argsort(theta, axis=1)
+        return _Boundary(
+            np.take_along_axis(theta, order, axis=1),
+            *(
+                np.take_along_axis(np.concatenate((a, b), axis=1), order[..., None], axis=1)
+                for a, b in (
+                    (self.images, other.images),
+                    (self.real, other.real),
+                    (self.parity, other.parity),
+                    (self.tangents, other.tangents),
+                )
+            ),
+        )
+
+
+def _sample_boundaries(
+    system: System,
+    centres: np.ndarray,
+    radii: np.ndarray,
+    theta: np.ndarray,
+    guesses: np.ndarray | None = None,
+) -> _Boundary:
+    positions = system.get_packed_positions()
+    lenses = positions[:, 0] + 1j * positions[:, 1]
+    fractions = system.get_mass_fractions()
+
+    direction = np.exp(1j * theta)
+    sources = centres[:, None] + radii[:, None] * direction
+    images, real = get_complex_images(system, sources, guesses)
+
+    # The lens equation is source = z - conj(f(z)) with f(z) = sum m / (z - lens), so
+    # d source = dz - conj(f'(z) dz), and the image moves by solving for dz
+    shear = np.conj(np.sum(-fractions / (images[..., None] - lenses) ** 2, axis=-1))
+    determinant = 1.0 - np.abs(shear) ** 2
+    velocity = (1j * radii[:, None] * direction)[..., None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        tangents = (velocity + shear * np.conj(velocity)) / determinant
+    return _Boundary(theta, images, real, np.sign(determinant), tangents)
+
+
+def _match_images(current: np.ndarray, following: np.ndarray) -> np.ndarray:
+    # For each candidate image the index of the nearest candidate of the following
+    # sample, pairing the closest remaining candidates first
+    count = current.shape[-1]
+    distance = np.abs(current[..., :, None] - following[..., None, :])
+    order = np.zeros(current.shape, dtype=np.intp)
+    for _ in range(count):
+        flat = np.argmin(distance.reshape(distance.shape[:-2] + (-1,)), axis=-1)
+        row, column = np.divmod(flat, count)
+        np.put_along_axis(order, row[..., None], column[..., None], axis=-1)
+        np.put_along_axis(distance, row[..., None, None], np.inf, axis=-2)
+        np.put_along_axis(distance, column[..., None, None], np.inf, axis=-1)
+    return order
+
+
+def _get_junctions(
+    images: np.ndarray, parity: np.ndarray, ending: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    # Join each positive image which ends (or starts) to the nearest negative image
+    # doing the same. Returns the area of the chords and their squared lengths
+    positive = ending & (parity > 0)
+    negative = ending & (parity < 0)
+    distance = np.abs(images[..., :, None] - images[..., None, :])
+    distance = np.where(positive[..., :, None] & negative[..., None, :], distance, np.inf)
+    nearest = np.argmin(distance, axis=-1)
+    partner = np.take_along_axis(images, nearest, axis=-1)
+    joined = positive & np.isfinite(np.min(distance, axis=-1))
+    chord = np.where(joined, 0.5 * np.imag(np.conj(images) * partner), 0.0)
+    gap = np.where(joined, np.abs(partner - images) ** 2, 0.0)
+    # An image with nothing to join to is missing its whole end of the arc
+    unpaired = np.sum(positive, axis=-1) != np.sum(negative, axis=-1)
+    return np.sum(chord, axis=-1), np.sum(gap, axis=-1) + np.where(unpaired, np.inf, 0.0)
+
+
+def _integrate(boundary: _Boundary) -> tuple[np.ndarray, np.ndarray]:
+    # The area of the images of each source and the error estimate of each interval
+    theta = boundary.theta
+    width = np.roll(theta, -1, axis=1) - theta
+    width[:, -1] += 2.0 * np.pi
+    order = _match_images(boundary.images, np.roll(boundary.images, -1, axis=1))
+
+    def get_following(array: np.ndarray) -> np.ndarray:
+        return np.take_along_axis(np.roll(array, -1, axis=1), order, axis=-1)
+
+    z, t, real, parity = boundary.images, boundary.tangents, boundary.real, boundary.parity
+    next_z, next_t = get_following(z), get_following(t)
+    next_real, next_parity = get_following(real), get_following(parity)
+
+    # The arcs of images which are real at both ends of the interval
+    h = width[..., None]
+    arc = real & next_real & (parity == next_parity)
+    step = next_z - z
+    chord = 0.5 * np.imag(np.conj(z) * next_z)
+    with np.errstate(invalid="ignore", over="ignore"):
+        correction = h * h * np.imag(np.conj(t) * next_t) / 12.0
+        # The corrections from the tangent at either end agree for a parabolic arc, so
+        # their difference measures how far the arc is from one
+        start = h * np.imag(np.conj(t) * step) / 6.0
+        end = h * np.imag(np.conj(step) * next_t) / 6.0
+        area = np.where(arc, parity * (chord + correction), 0.0)
+        error = np.where(arc, np.abs(start - end) + np.abs(correction - 0.5 * (start + end)), 0.0)
+    area = np.where(np.isfinite(area), area, 0.0)
+    error = np.where(np.isfinite(error), error, np.inf)
+
+    # Images which end within the interval are joined at the start of it, and images
+    # which start within it are joined at its end, closing the image contours
+    ending, ending_gap = _get_junctions(z, parity, real & ~next_real)
+    starting, starting_gap = _get_junctions(next_z, next_parity, ~real & next_real)
+    # Mismatched parities mean the images weren't matched across the interval
+    mismatched = np.any(real & next_real & (parity != next_parity), axis=-1)
+
+    total = np.sum(area, axis=(1, 2)) + np.sum(ending - starting, axis=1)
+    errors = np.sum(error, axis=-1) + ending_gap + starting_gap
+    errors = np.where(mismatched, np.inf, errors)
+    return total, errors
+
+
+def _get_uniform_magnifications(
+    system: System,
+    centres: np.ndarray,
+    radii: np.ndarray,
+    tolerance: float,
+    samples: int,
+    refinement: int,
+    rounds: int,
+) -> np.ndarray:
+    # The samples start off the axes, so sources on the axis of a lens don't land a
+    # sample exactly on it
+    theta = np.linspace(0.0, 2.0 * np.pi, samples, endpoint=False) + 0.1
+    theta = np.broadcast_to(theta, (len(centres), samples))
+    boundary = _sample_boundaries(system, centres, radii, theta)
+
+    areas = np.zeros(len(centres))
+    active = np.arange(len(centres))
+    for idx in range(rounds + 1):
+        total, errors = _integrate(boundary)
+        converged = np.sum(errors, axis=1) <= tolerance * np.abs(total)
+        if idx == rounds:
+            converged[:] = True
+            logger.debug(f"{len(active)} sources didn't converge in {rounds} rounds")
+        areas[active[converged]] = total[converged]
+        active = active[~converged]
+        if len(active) == 0:
+            break
+        boundary = boundary.take(~converged)
+
+        # Bisect the intervals with the largest errors, starting their images from
+        # those at the start of the interval
+        theta = boundary.theta
+        count = min(refinement, theta.shape[1])
+        errors = np.nan_to_num(errors[~converged], posinf=np.finfo(np.float64).max)
+        worst = np.argpartition(-errors, count - 1, axis=1)[:, :count]
+        width = np.roll(theta, -1, axis=1) - theta
+        width[:, -1] += 2.0 * np.pi
+        middle = np.take_along_axis(theta + 0.5 * width, worst, axis=1) % (2.0 * np.pi)
+        guesses = np.take_along_axis(boundary.images, worst[..., None], axis=1)
+        extra = _sample_boundaries(
+            system,
+            centres[active],
+            radii[active],
+            middle,
+            guesses if boundary.images.shape[-1] == 5 else None,
+        )
+        boundary = boundary.insert(extra)
+
+    return areas / (np.pi * radii**2)
+
+
+def get_contour_magnification(
+    system: System,
+    sources: np.ndarray,
+    rho: np.ndarray | float,
+    limb: float = 0.0,
+    *,
+    tolerance: float = 1e-4,
+    samples: int = CONTOUR_SAMPLES,
+    annuli: int = CONTOUR_ANNULI,
+) -> np.ndarray:
+    """
+    The magnification of finite sources of radius rho at (N, 2) positions, both in
+    Einstein radii relative to the center of mass, for a one or two lens system.
+    Each source is refined until the estimated relative error is below `tolerance`.
+    With the linear limb darkening coefficient `limb` the flux is integrated over
+    `annuli` uniform disks of smaller radii.
+    """
+    sources = np.asarray(sources, dtype=np.float64).reshape((-1, 2))
+    centres = sources[:, 0] + 1j * sources[:, 1]
+    rho = np.broadcast_to(np.asarray(rho, dtype=np.float64), (len(centres),))
+    if np.any(rho <= 0.0):
+        logger.error("Contour integration needs sources with a positive radius")
+        raise ValueError("Contour integration needs sources with a positive radius")
+
+    options = (tolerance, samples, CONTOUR_REFINEMENT, CONTOUR_ROUNDS)
+    if limb == 0.0 or annuli <= 1:
+        return _get_uniform_magnifications(system, centres, rho, *options)
+
+    # With the linear law I = 1 - limb (1 - mu) and D(r) the magnified area of the
+    # disk of radius r, integrating the flux by parts leaves
+    # (1 - limb) D(1) + limb * integral of D(sqrt(1 - mu^2)) over 0 <= mu <= 1
+    # D is smooth in mu, so a few disks at the Gauss-Legendre nodes of mu are enough
+    nodes, weights = np.polynomial.legendre.leggauss(annuli)
+    mu, weights = 0.5 * (nodes + 1.0), 0.5 * weights
+    flux = (1.0 - limb) * _get_uniform_magnifications(system, centres, rho, *options)
+    for node, weight in zip(mu, weights):
+        radius = np.sqrt(1.0 - node**2)
+        magnification = _get_uniform_magnifications(system, centres, rho * radius, *options)
+        flux += limb * weight * magnification * radius**2
+    # The same flux without lenses
+    return flux / (1.0 - limb / 3.0)
+
+
+def get_contour_lightcurve(
+    system: System,
+    times: np.ndarray,
+    u0: float,
+    t0: float,
+    tE: float,
+    alpha: float,
+    rho: float,
+    limb: float = 0.0,
+    **options,
+) -> np.ndarray:
+    """
+    The finite source light curve of a source moving in a straight line at the angle
+    `alpha` (in radians) to the x axis, passing closest to the center of mass at t0
+    at an impact parameter of u0 Einstein radii, and crossing an Einstein radius in tE.
+    See `get_contour_magnification()` for the options.
+    """
+    tau = (np.asarray(times, dtype=np.float64) - t0) / tE
+    cos, sin = np.cos(alpha), np.sin(alpha)
+    sources = np.stack((tau * cos - u0 * sin, tau * sin + u0 * cos), axis=-1)
+    return get_contour_magnification(system, sources, rho, limb, **options)
@@ -0,0 +1,331 @@
+"""
+Exporting maps as colour mapped images without building full size arrays on the host.
+
+The colour map or log scaling is applied on the GPU into an RGBA8 band of rows, and
+the bands are read back one at a time from the top of the image. Streamed into a
+PNGStream the host only ever holds one band, so an 8192x8192 map costs a few
+megabytes rather than several gigabyte sized float copies.
+
+Thumbnails average blocks of texels on the GPU, so they come out box filtered.
+"""
+
+from pathlib import Path
+from typing import Any, Callable, Generator
+from struct import pack
+from zlib import compressobj, crc32
+
+import numpy as np
+from arcade import ArcadeContext
+import arcade.gl as gl
+
+from GMLID.resources import get_resources
+from GMLID.logging import get_logger
+
+from .reduction import IRSStatistics
+
+logger = get_logger("physics.export")
+
+# How single component maps are scaled before the colour map and their SCALE shader define
+IRS_EXPORT_SCALES: dict[str, int] = {"linear": 0, "log": 1}
+# The decades below the maximum shown by log scaled exports when no limits are given
+IRS_EXPORT_DECADES: float = 3.0
+
+
+def _get_heat_colour_map() -> np.ndarray:
+    # Black through red and yellow to white
+    t = np.linspace(0.0, 1.0, 256)
+    red = np.clip(3.0 * t, 0.0, 1.0)
+    green = np.clip(3.0 * t - 1.0, 0.0, 1.0)
+    blue = np.clip(3.0 * t - 2.0, 0.0, 1.0)
+    return np.stack((red, green, blue), axis=-1)
+
+
+# The named colour maps, each a (N, 3) array from the lowest to highest value
+IRS_COLOUR_MAPS: dict[str, np.ndarray] = {
+    "grey": np.repeat(np.linspace(0.0, 1.0, 256)[:, None], 3, axis=1),
+    "heat": _get_heat_colour_map(),
+}
+
+
+def get_colour_map(colour_map: str | np.ndarray) -> np.ndarray:
+    """
+    Get a colour map as a (N, 4) uint8 array, either by name from IRS_COLOUR_MAPS or
+    from a (N, 3) or (N, 4) array of floats from 0.0 to 1.0.
+    """
+    if isinstance(colour_map, str):
+        if colour_map not in IRS_COLOUR_MAPS:
+            logger.error(f"Unknown colour map {colour_map}. Expected one of {tuple(IRS_COLOUR_MAPS)}")
+            raise ValueError(
+                f"Unknown colour map {colour_map}. Expected one of {tuple(IRS_COLOUR_MAPS)}"
+            )
+        colour_map = IRS_COLOUR_MAPS[colour_map]
+
+    colours = np.asarray(colour_map, dtype=np.float64)
+    if colours.ndim != 2 or colours.shape[1] not in (3, 4) or len(colours) < 2:
+        logger.error(f"Colour maps must be (N, 3) or (N, 4) arrays, not {colours.shape}")
+        raise ValueError(f"Colour maps must be (N, 3) or (N, 4) arrays, not {colours.shape}")
+    if colours.shape[1] == 3:
+        colours = np.concatenate((colours, np.ones((len(colours), 1))), axis=1)
+    return np.round(np.clip(colours, 0.0, 1.0) * 255.0).astype(np.uint8)
+
+
+def get_export_limits(statistics: IRSStatistics, scale: str = "linear") -> tuple[float, float]:
+    """
+    The limits used when none are given. Linear exports show zero to the maximum,
+    log exports show the IRS_EXPORT_DECADES below the maximum.
+    """
+    if scale == "log":
+        top = np.log10(statistics.maximum) if statistics.maximum > 0.0 else 0.0
+        return float(top - IRS_EXPORT_DECADES), float(top)
+    return 0.0, statistics.maximum if statistics.maximum > 0.0 else 1.0
+
+
+class PNGStream:
+    """
+    Write a PNG one band of rows at a time, so the whole image is never in memory.
+    Each row is filtered against the one above it before it is compressed, which
+    suits the smooth maps far better than no filtering. Use it as a context manager,
+    or call `close()` once every row has been written.
+    """
+
+    SIGNATURE: bytes = b"\x89PNG\r\n\x1a\n"
+    # The PNG colour type of each number of components
+    COLOUR_TYPES: dict[int, int] = {1: 0, 3: 2, 4: 6}
+
+    def __init__(self, path: Path | str, width: int, height: int, components: int = 3) -> None:
+        if components not in self.COLOUR_TYPES:
+            logger.error(f"PNGs can't be written with {components} components")
+            raise ValueError(f"PNGs can't be written with {components} components")
+
+        self._path: Path = Path(path)
+        self._size: tuple[int, int] = width, height
+        self._components: int = components
+        self._rows: int = 0
+        self._previous: np.ndarray = np.zeros((width * components,), dtype=np.uint8)
+        self._compressor = compressobj(6)
+
+        self._file = open(self._path, "wb")
+        self._file.write(self.SIGNATURE)
+        colour_type = self.COLOUR_TYPES[components]
+        self._write_chunk(b"IHDR", pack(">2I5B", width, height, 8, colour_type, 0, 0, 0))
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def rows(self) -> int:
+        return self._rows
+
+    def _write_chunk(self, kind: bytes, data: bytes):
+        self._file.write(pack(">I", len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(pack(">I", crc32(data, crc32(kind))))
+
+    def write(self, rows: np.ndarray):
+        """
+        Write the next (N, width, components) uint8 rows, from the top of the image.
+        """
+        w, h = self._size
+        rows = np.asarray(rows, dtype=np.uint8).reshape((-1, w * self._components))
+        if self._rows + len(rows) > h:
+            logger.error(f"Writing {len(rows)} rows would pass the height of {self._path}")
+            raise ValueError(f"Writing {len(rows)} rows would pass the height of {self._path}")
+
+        # The "up" filter stores each byte minus the byte above it
+        above = np.concatenate((self._previous[None, :], rows[:-1]), axis=0)
+        filtered = np.empty((len(rows), w * self._components + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        np.subtract(rows, above, out=filtered[:, 1:])
+        self._previous = rows[-1].copy()
+        self._rows += len(rows)
+
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._write_chunk(b"IDAT", data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._rows != self._size[1]:
+            logger.warning(f"Closed {self._path} after {self._rows} of {self._size[1]} rows")
+        self._write_chunk(b"IDAT", self._compressor.flush())
+        self._write_chunk(b"IEND", b"")
+        self._file.close()
+
+    def __enter__(self) -> "PNGStream":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class IRSExport:
+    """
+    The IRSExport colours a texture on the GPU and reads it back in bands of rows.
+
+    Single component textures go through the colour map between the two `limits`,
+    after taking the log10 of each value if `scale` is "log". With `deflection` the
+    texture is a deflection map and its source plane positions are shown as red and
+    green, `limits` being the positions at 0 and 255. The `setup` callback is given the
+    program before each band is drawn to bind anything else the shader samples (see
+    `IRSDeflectionMap.use()`), and `defines` must match how the texture is stored.
+
+    Each pixel averages a `block` x `block` square of texels, so a block of 8 makes a
+    thumbnail an eighth the size.
+    """
+
+    def __init__(
+        self,
+        ctx: ArcadeContext,
+        texture: gl.Texture2D,
+        *,
+        limits: tuple[float, float] = (0.0, 1.0),
+        scale: str = "linear",
+        colour_map: str | np.ndarray = "grey",
+        component: int = 0,
+        block: int = 1,
+        band: int = 256,
+        deflection: bool = False,
+        blue: float = 0.5,
+        wrap: bool = False,
+        defines: dict[str, Any] | None = None,
+        setup: Callable[[gl.Program], None] | None = None,
+    ) -> None:
+        if scale not in IRS_EXPORT_SCALES:
+            logger.error(f"Unknown export scale {scale}. Expected one of {tuple(IRS_EXPORT_SCALES)}")
+            raise ValueError(
+                f"Unknown export scale {scale}. Expected one of {tuple(IRS_EXPORT_SCALES)}"
+            )
+        if limits[1] == limits[0]:
+            logger.error(f"The export limits {limits} are empty")
+            raise ValueError(f"The export limits {limits} are empty")
+
+        self._ctx: ArcadeContext = ctx
+        self._texture: gl.Texture2D = texture
+        self._limits: tuple[float, float] = limits
+        self._component: int = component
+        self._block: int = max(1, block)
+        self._blue: float = blue
+        self._wrap: bool = wrap
+        self._setup: Callable[[gl.Program], None] | None = setup
+
+        w, h = texture.size
+        self._size: tuple[int, int] = -(-w // self._block), -(-h // self._block)
+        self._band: int = max(1, min(band, self._size[1]))
+
+        resources = get_resources(ctx)
+        self._geometry: gl.Geometry = resources.get_fullscreen_geometry()
+        self._program: gl.Program = resources.load_program(
+            vertex_shader="UTIL_unprojected_uv_vs",
+            fragment_shader="IRS_export_fs",
+            defines={
+                "CHANNELS": int(deflection),
+                "SCALE": IRS_EXPORT_SCALES[scale],
+                **(defines or {}),
+            },
+        )
+
+        colours = get_colour_map(colour_map)
+        self._colour_map: gl.Texture2D = ctx.texture(
+            (len(colours), 1), components=4, dtype="f1", data=colours.tobytes()
+        )
+        self._target: gl.Texture2D = ctx.texture(
+            (self._size[0], self._band), components=4, dtype="f1"
+        )
+        self._frame: gl.Framebuffer = ctx.framebuffer(color_attachments=self._target)
+
+    @property
+    def width(self) -> int:
+        return self._size[0]
+
+    @property
+    def height(self) -> int:
+        return self._size[1]
+
+    @property
+    def band(self) -> int:
+        return self._band
+
+    def _render_band(self, start: int, rows: int) -> np.ndarray:
+        w, h = self._size
+        program = self._program
+        # The program is shared between exports so every uniform is set per render
+        program["source"] = 0
+        program.set_uniform_safe("colour_map", 1)
+        program.set_uniform_safe("component", self._component)
+        program["offset"] = 0, h - start - rows
+        program["block"] = self._block, self._block
+        program["limits"] = self._limits
+        program.set_uniform_safe("blue", self._blue)
+        program.set_uniform_safe("wrap", int(self._wrap))
+        if self._setup is not None:
+            self._setup(program)
+
+        with self._frame.activate():
+            self._texture.use(0)
+            self._colour_map.use(1)
+            self._geometry.render(program)
+        data = self._frame.read(viewport=(0, 0, w, rows), components=4, dtype="f1")
+        return np.frombuffer(data, dtype=np.uint8).reshape((rows, w, 4))[::-1]
+
+    def read_rows(self) -> Generator[tuple[int, np.ndarray], None, None]:
+        """
+        Yield the first row of each band and its (rows, width, 4) uint8 pixels, from
+        the top of the image.
+        """
+        h = self._size[1]
+        for start in range(0, h, self._band):
+            yield start, self._render_band(start, min(self._band, h - start))
+
+    def read(self) -> np.ndarray:
+        """
+        The whole (height, width, 4) uint8 image, the only full size copy on the host.
+        """
+        w, h = self._size
+        image = np.empty((h, w, 4), dtype=np.uint8)
+        for start, rows in self.read_rows():
+            image[start : start + len(rows)] = rows
+        return image
+
+    def write_png(self, path: Path | str, alpha: bool = False):
+        """
+        Stream the image into a PNG, one band at a time.
+        """
+        components = 4 if alpha else 3
+        with PNGStream(path, *self._size, components) as stream:
+            for _, rows in self.read_rows():
+                stream.write(rows[:, :, :components])
+        logger.debug(f"Exported {self._size} to {path} in bands of {self._band} rows")
+
+    def release(self):
+        self._frame.delete()
+        self._target.delete()
+        self._colour_map.delete()
+
+
+def get_thumbnail_path(path: Path | str) -> Path:
+    path = Path(path)
+    return path.with_name(f"{path.stem}_thumbnail{path.suffix}")
+
+
+def export_png(
+    get_export: Callable[..., IRSExport],
+    path: Path | str,
+    *,
+    thumbnail: int | None = None,
+    alpha: bool = False,
+    **options: Any,
+):
+    """
+    Stream the export made by `get_export(**options)` into a PNG. With `thumbnail`
+    also write a copy that many times smaller next to it (see `get_thumbnail_path()`).
+    """
+    export = get_export(**options)
+    export.write_png(path, alpha)
+    export.release()
+    if thumbnail is not None:
+        export = get_export(**{**options, "block": thumbnail})
+        export.write_png(get_thumbnail_path(path), alpha)
+        export.release()
@@ -0,0 +1,251 @@
+"""
+Finding the lensed images of source positions from a deflection map.
+
+Each cell between four texels of the IRSDeflectionMap is mapped onto the source
+plane as a quad. The quads are bucketed on a regular grid over the source plane, so
+the cells that may contain an image of a source are found by looking up its bucket.
+Every cell whose quad contains the source gives a first guess of the image, which
+is refined by Newton steps on the lens equation, and duplicates are removed.
+
+The images of a source are only found if they lie within the deflection map. Images
+in cells whose quad is far larger than the index, which only happens right next to
+a lens, can be missed. They are very faint so the total magnification barely changes.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+from GMLID.logging import get_logger
+
+from .system import System
+from .analytical import apply_lens_equation, get_lens_jacobian
+from .numerical import IRSDeflectionMap
+
+logger = get_logger("physics.images")
+
+
+class IRSImages(NamedTuple):
+    source: np.ndarray  # The index of the source position each image belongs to
+    positions: np.ndarray  # (N, 2) In the lens plane in Einstein radii
+    magnifications: np.ndarray  # Signed by the parity of the image
+    count: int  # The number of source positions queried
+
+    def get_total_magnification(self) -> np.ndarray:
+        return np.bincount(self.source, np.abs(self.magnifications), minlength=self.count)
+
+    def get_image_counts(self) -> np.ndarray:
+        return np.bincount(self.source, minlength=self.count)
+
+    def get_centroids(self) -> np.ndarray:
+        """
+        The magnification weighted centroid of the images of each source position.
+        """
+        weights = np.abs(self.magnifications)
+        total = self.get_total_magnification()
+        centroid_x = np.bincount(self.source, weights * self.positions[:, 0], minlength=self.count)
+        centroid_y = np.bincount(self.source, weights * self.positions[:, 1], minlength=self.count)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.stack((centroid_x, centroid_y), axis=-1) / total[:, None]
+
+    def get_centroid_shifts(self, sources: np.ndarray) -> np.ndarray:
+        """
+        The astrometric shift of each source position by the lenses.
+        """
+        return self.get_centroids() - sources
+
+
+class IRSImageIndex:
+    """
+    A bucketed grid over the source plane of the cells of a deflection map. It covers
+    the source plane within `viewport` of the center of mass, and each bucket is
+    roughly `bucket_size` Einstein radii across, by default sized so each holds a few
+    cells. The deflection map must already be generated.
+    """
+
+    def __init__(
+        self,
+        deflection_map: IRSDeflectionMap,
+        viewport: tuple[float, float] = (2.0, 2.0),
+        bucket_size: float | None = None,
+    ) -> None:
+        self._system: System = deflection_map.system
+        self._viewport: tuple[float, float] = viewport
+
+        # The source position (corners) and lens plane position (lens) of every texel
+        self._corners: np.ndarray = deflection_map.read().astype(np.float64)
+        h, w, _ = self._corners.shape
+        v_x, v_y = deflection_map.viewport_x, deflection_map.viewport_y
+        x = ((np.arange(w) + 0.5) / w * 2.0 - 1.0) * v_x
+        y = ((np.arange(h) + 0.5) / h * 2.0 - 1.0)[::-1] * v_y  # The rows from the top like read()
+        self._lens: np.ndarray = np.stack(np.meshgrid(x, y), axis=-1)
+
+        if bucket_size is None:
+            # The cells cover the lens plane, so about the same number of buckets over
+            # the (smaller) source plane viewport holds a few cells each
+            bucket_size = 2.0 * max(viewport) / max(w, h) * 4.0
+        self._buckets: tuple[int, int] = (
+            max(1, int(np.ceil(2.0 * viewport[0] / bucket_size))),
+            max(1, int(np.ceil(2.0 * viewport[1] / bucket_size))),
+        )
+        self._starts: np.ndarray
+        self._cells: np.ndarray
+        # The source plane bounds of every cell
+        self._low: np.ndarray
+        self._high: np.ndarray
+        self._build()
+
+    @property
+    def system(self) -> System:
+        return self._system
+
+    @property
+    def viewport(self) -> tuple[float, float]:
+        return self._viewport
+
+    @property
+    def bucket_count(self) -> tuple[int, int]:
+        return self._buckets
+
+    @property
+    def entry_count(self) -> int:
+        return len(self._cells)
+
+    def _get_bucket(self, positions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        b_x, b_y = self._buckets
+        v_x, v_y = self._viewport
+        i = np.floor((positions[..., 0] / v_x * 0.5 + 0.5) * b_x).astype(np.int64)
+        j = np.floor((positions[..., 1] / v_y * 0.5 + 0.5) * b_y).astype(np.int64)
+        return i, j
+
+    def _get_quads(self) -> np.ndarray:
+        # The source positions of the four corners of each cell, in winding order
+        c = self._corners
+        return np.stack((c[:-1, :-1], c[:-1, 1:], c[1:, 1:], c[1:, :-1]), axis=2)
+
+    def _build(self):
+        quads = self._get_quads().reshape((-1, 4, 2))
+        valid = np.all(np.isfinite(quads), axis=(1, 2))
+        low = np.where(valid[:, None], np.min(quads, axis=1), np.inf)
+        high = np.where(valid[:, None], np.max(quads, axis=1), -np.inf)
+        self._low, self._high = low, high
+
+        b_x, b_y = self._buckets
+        i0, j0 = self._get_bucket(low)
+        i1, j1 = self._get_bucket(high)
+        # Only the cells which overlap the index are kept, clamped to its edges
+        inside = valid & (i1 >= 0) & (j1 >= 0) & (i0 < b_x) & (j0 < b_y)
+        cells = np.flatnonzero(inside)
+        i0, i1 = np.clip(i0[cells], 0, b_x - 1), np.clip(i1[cells], 0, b_x - 1)
+        j0, j1 = np.clip(j0[cells], 0, b_y - 1), np.clip(j1[cells], 0, b_y - 1)
+
+        # Expand every cell into each bucket it overlaps
+        span_x = i1 - i0 + 1
+        spans = span_x * (j1 - j0 + 1)
+        owner = np.repeat(np.arange(len(cells)), spans)
+        offset = np.arange(len(owner)) - np.repeat(np.cumsum(spans) - spans, spans)
+        bucket_x = i0[owner] + offset % span_x[owner]
+        bucket_y = j0[owner] + offset // span_x[owner]
+        buckets = bucket_y * b_x + bucket_x
+
+        order = np.argsort(buckets, kind="stable")
+        self._cells = cells[owner[order]]
+        self._starts = np.concatenate(
+            ((0,), np.cumsum(np.bincount(buckets, minlength=b_x * b_y)))
+        )
+        logger.debug(
+            f"Indexed {len(cells)} cells into {b_x * b_y} buckets ({len(owner)} entries)"
+        )
+
+    def get_candidates(self, sources: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the pairs of (source index, cell index) where the source position is within
+        the bounds of the cell. Cells are indexed as row * (width - 1) + column of read().
+        """
+        b_x, b_y = self._buckets
+        i, j = self._get_bucket(sources)
+        inside = (i >= 0) & (j >= 0) & (i < b_x) & (j < b_y)
+        if not np.all(inside):
+            logger.warning(f"{np.sum(~inside)} source positions are outside of the index")
+        bucket = np.where(inside, j * b_x + i, 0)
+        start = self._starts[bucket]
+        lengths = np.where(inside, self._starts[bucket + 1] - start, 0)
+
+        source = np.repeat(np.arange(len(sources)), lengths)
+        offset = np.arange(len(source)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        cells = self._cells[start[source] + offset]
+
+        # Most cells of the bucket don't reach the source
+        points = sources[source]
+        near = np.all((self._low[cells] <= points) & (points <= self._high[cells]), axis=-1)
+        return source[near], cells[near]
+
+    def _get_first_guesses(
+        self, sources: np.ndarray, source: np.ndarray, cells: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # Split each quad into two triangles and keep the pairs where the source is
+        # inside one, interpolating the lens plane position with the barycentric weights
+        h, w, _ = self._corners.shape
+        row, column = cells // (w - 1), cells % (w - 1)
+        points = sources[source]
+        found_source, found_guess = [], []
+        for second in ((0, 1), (1, 1)), ((1, 1), (1, 0)):
+            corners = ((0, 0),) + second
+            s = [self._corners[row + r, column + c] for r, c in corners]
+            l = [self._lens[row + r, column + c] for r, c in corners]
+            e1, e2, p = s[1] - s[0], s[2] - s[0], points - s[0]
+            det = e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                u = (p[:, 0] * e2[:, 1] - p[:, 1] * e2[:, 0]) / det
+                v = (e1[:, 0] * p[:, 1] - e1[:, 1] * p[:, 0]) / det
+            # A small tolerance so sources on a shared edge aren't missed by both
+            inside = (u >= -1e-6) & (v >= -1e-6) & (u + v <= 1.0 + 1e-6)
+            guess = l[0] + u[:, None] * (l[1] - l[0]) + v[:, None] * (l[2] - l[0])
+            found_source.append(source[inside])
+            found_guess.append(guess[inside])
+        return np.concatenate(found_source), np.concatenate(found_guess)
+
+    def find_images(
+        self,
+        sources: np.ndarray,
+        steps: int = 8,
+        tolerance: float = 1e-9,
+    ) -> IRSImages:
+        """
+        Find the images of a batch of (N, 2) source positions in Einstein radii. The
+        first guesses are refined with up to `steps` Newton steps, and images whose
+        lens equation is still off by more than `tolerance` are dropped.
+        """
+        sources = np.asarray(sources, dtype=np.float64).reshape((-1, 2))
+        source, cells = self.get_candidates(sources)
+        source, images = self._get_first_guesses(sources, source, cells)
+
+        targets = sources[source]
+        for _ in range(steps):
+            residual = apply_lens_equation(self._system, images) - targets
+            if np.all(np.abs(residual) <= tolerance):
+                break
+            # Solve the 2x2 systems with their explicit inverse
+            (a, b), (c, d) = np.moveaxis(get_lens_jacobian(self._system, images), 0, -1)
+            det = a * d - b * c
+            with np.errstate(invalid="ignore", divide="ignore"):
+                step_x = (d * residual[:, 0] - b * residual[:, 1]) / det
+                step_y = (a * residual[:, 1] - c * residual[:, 0]) / det
+            images = images - np.stack((step_x, step_y), axis=-1)
+
+        residual = apply_lens_equation(self._system, images) - targets
+        converged = np.all(np.abs(residual) <= tolerance, axis=-1)
+        source, images = source[converged], images[converged]
+
+        # The same image is found by every cell (or triangle) whose quad contains the
+        # source, so drop images at the same position as the last one of the source
+        order = np.lexsort((images[:, 1], images[:, 0], source))
+        source, images = source[order], images[order]
+        duplicate = np.zeros(len(source), dtype=bool)
+        duplicate[1:] = (source[1:] == source[:-1]) & np.all(
+            np.abs(images[1:] - images[:-1]) <= 1e3 * tolerance, axis=-1
+        )
+        source, images = source[~duplicate], images[~duplicate]
+
+        magnifications = 1.0 / np.linalg.det(get_lens_jacobian(self._system, images))
+        return IRSImages(source, images, magnifications, len(sources))
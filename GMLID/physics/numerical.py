@@ -1,21 +1,51 @@
-from struct import pack
+from itertools import product
 from random import random
 from time import sleep, time
 from collections.abc import Buffer
+from pathlib import Path
+from ctypes import byref
+from typing import Any, AsyncIterator, Generator, Iterable
+import asyncio
 
 from PIL import Image
 import numpy as np
 from arcade import get_window, ArcadeContext
 import arcade.gl as gl
+from pyglet import gl as pgl
+from pyglet.gl import GL_PROGRAM_POINT_SIZE
 
-from GMLID.util import get_fullscreen_geometry, get_glsl, get_symmetric_geometry
-from GMLID.physics.util import Sr_to_au
+from GMLID.resources import get_resources
+from GMLID.util import get_region_byte_data
+from GMLID.physics.util import Sr_to_au, get_r2_offset
 from GMLID.logging import get_logger
 
 from .system import System
+from .source import SourceProfile, create_source_kernel
+from .analytical import apply_lens_equation
+from .reduction import IRSStatistics, get_reducer
+from .export import IRS_EXPORT_SCALES, IRSExport, get_export_limits, export_png
 
 logger = get_logger("physics.numerical")
 
+# The ray jitter modes of the IRSHistogram and their value for the JITTER shader define
+IRS_JITTER_MODES: dict[str, int] = {"random": 0, "r2": 1}
+# How rays find their location in the source plane and their value for the MODE shader define
+IRS_RAY_MODES: dict[str, int] = {"interpolated": 0, "direct": 1, "texel": 2}
+# How the IRSDeflectionMap stores each texel and the texture dtype used
+IRS_DEFLECTION_STORAGE: dict[str, str] = {"f4": "f4", "f2": "f2", "residual": "f2"}
+# How each ray is added to the histogram
+IRS_DEPOSITION_MODES: dict[str, int] = {"point": 0, "bilinear": 1}
+# The rays along each axis of a region of interest tile
+IRS_ROI_TILE: int = 16
+# The most blocks of region of interest tiles along each axis bounded by the lens equation
+IRS_ROI_BLOCKS: int = 256
+# The most evaluations of a lens (blocks times lenses) spent bounding the region of interest
+IRS_ROI_EVALUATIONS: int = 2**24
+# The most lenses given patches by a nested deflection map, matches MAX_PATCHES in the shaders
+IRS_MAX_PATCHES: int = 16
+# The texture unit the patches of a nested deflection map are bound to
+IRS_PATCH_UNIT: int = 7
+
 
 class IRSDeflectionMap:
     """
@@ -26,6 +56,35 @@ class IRSDeflectionMap:
     getting the deflection map texture using the `deflection_map` property won't
     automatically generate it. After updating the system or other attributes you
     must explicitly call `IRSDeflectionMap.generate()`.
+
+    The lens block (the packed lenses on the GPU) is created separately from the
+    texture. A lazy deflection map used only for its `lens_block` by a "direct"
+    IRSHistogram never allocates the texture, so memory scales with the lens count.
+
+    The texels can be stored as "f4" (the source position as two 32-bit floats), "f2"
+    (as two 16-bit floats) or "residual". Residual maps use 16-bit floats to store the
+    deflection of every lens except the most massive. That lens's deflection diverges
+    near it, so it is instead computed exactly by each shader when the map is sampled.
+    Both 16-bit formats halve the memory and file size of the map. Shaders sampling
+    the map must use the `defines` of the map and pass their program to `use()`.
+
+    The same draw can also store the determinant of the lens equation's Jacobian
+    (`jacobian`) and the Fermat potential (`potential`) in a second 32-bit texture.
+    Both are computed exactly from the lenses. The critical curves are where the
+    determinant is zero, so they can be found by `get_critical_curves()` without
+    generating a histogram, and mapped onto the caustics by `get_caustics()`.
+
+    The deflection diverges near each lens, so that is where interpolating the map is
+    least accurate. A nested map (`patch_size` > 0) also renders a square patch of
+    `patch_size` texels centred on each lens, `patch_scale` times the Einstein radius
+    of that lens in half width. Interpolated samples use the patch wherever it covers
+    them, so a modest map with patches is as accurate as a far larger uniform map.
+    Only the most massive `IRS_MAX_PATCHES` lenses get a patch. The patches are only
+    used when sampling, not by `read()`, "texel" rays or "direct" rays.
+
+    The map is created on the given context, such as one from
+    `GMLID.setup.create_headless_context()`, or on the current window's context. Every
+    histogram and map built on top of it uses the same context.
     """
 
     def __init__(
@@ -34,64 +93,185 @@ class IRSDeflectionMap:
         size: tuple[int, int],
         *,
         viewport: tuple[float, float] = (3.0, 3.0),
+        storage: str = "f4",
+        jacobian: bool = False,
+        potential: bool = False,
+        patch_size: int = 0,
+        patch_scale: float = 1.0,
+        ctx: ArcadeContext | None = None,
         lazy: bool = False,
         data: Buffer | None = None,
     ) -> None:
+        if storage not in IRS_DEFLECTION_STORAGE:
+            logger.error(
+                f"Unknown deflection storage {storage}. Expected one of {tuple(IRS_DEFLECTION_STORAGE)}"
+            )
+            raise ValueError(
+                f"Unknown deflection storage {storage}. Expected one of {tuple(IRS_DEFLECTION_STORAGE)}"
+            )
+
         self._system: System = system
         self._size: tuple[int, int] = size
         self._viewport: tuple[float, float] = viewport
+        self._storage: str = storage
+        self._jacobian: bool = jacobian
+        self._potential: bool = potential
+        self._patch_size: int = patch_size
+        self._patch_scale: float = patch_scale
 
-        self._ctx: ArcadeContext
+        self._ctx: ArcadeContext | None = ctx
 
         self._lens_block: gl.Buffer
         self._lens_image: gl.Texture2D
+        # (r) Jacobian determinant, (g) Fermat potential
+        self._property_image: gl.Texture2D | None = None
+
+        # The patches of a nested map are packed into a grid in one texture
+        self._patch_image: gl.Texture2D | None = None
+        self._patch_grid: tuple[int, int] = (0, 0)
+        self._patch_frame: gl.Framebuffer
+        self._patch_buffer: gl.Buffer
+        self._patch_geometry: gl.Geometry
+        self._patch_program: gl.Program
+        self._patches: list[tuple[int, float, float, float]] = []
 
         self._render_geometry: gl.Geometry
         self._render_program: gl.Program
         self._render_frame: gl.Framebuffer
 
+        # The dominant lens the map was generated with, as the system can change before
+        # the map is generated again
+        self._dominant: tuple[int, float, float, float] | None = None
+
+        self._lens_initialised: bool = False
         self._initialised: bool = False
         if not lazy or data is not None:
             self.initialise(data=data)
 
-    def initialise(self, /, force: bool = False, data: Buffer | None = None):
-        if self._initialised and not force:
+    def _initialise_lens_block(self, force: bool = False):
+        if self._lens_initialised and not force:
             return
 
-        self._ctx = ctx = get_window().ctx
+        ctx = self.ctx
 
         # 2 32-bit ints + 4 32-bit floats per lens
         size = 8 + len(self._system.lenses) * 16
         self._lens_block = ctx.buffer(reserve=size)
         self._update_lens_block()
 
+        self._lens_initialised = True
+
+    def initialise(self, /, force: bool = False, data: Buffer | None = None):
+        if self._initialised and not force:
+            return
+
+        self._initialise_lens_block(force)
+        ctx = self.ctx
+
+        self._lens_image, self._property_image, self._render_frame = self._create_targets(data)
+
+        v_x, v_y = self._viewport
+        resources = get_resources(ctx)
+        self._render_geometry = resources.get_symmetric_geometry(v_x * 2, v_y * 2)
+        self._render_program = resources.load_program(
+            vertex_shader="UTIL_unprojected_uv_vs",
+            fragment_shader="IRS_deflection_map_fs",
+            defines={
+                "RESIDUAL": int(self._storage == "residual"),
+                "JACOBIAN": int(self._jacobian),
+                "POTENTIAL": int(self._potential),
+            },
+        )
+
+        if self._patch_size > 0:
+            # 4 vertices of 4 32-bit floats per patch
+            self._patch_buffer = ctx.buffer(reserve=IRS_MAX_PATCHES * 64)
+            self._patch_geometry = ctx.geometry(
+                [gl.BufferDescription(self._patch_buffer, "4f", ["in_coordinate"])],
+                mode=gl.TRIANGLE_STRIP,
+            )
+            self._patch_program = resources.load_program(
+                vertex_shader="UTIL_unprojected_uv_vs",
+                fragment_shader="IRS_deflection_map_fs",
+                defines={
+                    "RESIDUAL": int(self._storage == "residual"),
+                    "JACOBIAN": 0,
+                    "POTENTIAL": 0,
+                },
+            )
+            self._patch_image = None
+            self._patch_grid = (0, 0)
+
+        self._initialised = True
+
+    def _create_targets(
+        self, data: Buffer | None = None
+    ) -> tuple[gl.Texture2D, gl.Texture2D | None, gl.Framebuffer]:
+        ctx = self.ctx
         # Only two lens components are needed, and each component in 32-bit so this
         # saves 64-bits per pixel. Even if it does add complexity to reading the texture
-        self._lens_image = ctx.texture(
+        lens_image = ctx.texture(
             self._size,
             components=2,
-            dtype="f4",
+            dtype=IRS_DEFLECTION_STORAGE[self._storage],
             data=data,
             wrap_x=gl.CLAMP_TO_EDGE,
             wrap_y=gl.CLAMP_TO_EDGE,
             filter=(gl.LINEAR, gl.LINEAR),
         )
 
-        v_x, v_y = self._viewport
-        self._render_geometry = get_symmetric_geometry(ctx, v_x * 2, v_y * 2)
-        self._render_program = ctx.load_program(
-            vertex_shader=get_glsl("UTIL_unprojected_uv_vs"),
-            fragment_shader=get_glsl("IRS_deflection_map_fs"),
+        property_image = None
+        attachments = [lens_image]
+        if self._jacobian or self._potential:
+            # The determinant changes sign on the critical curves, and so needs full precision
+            property_image = ctx.texture(
+                self._size,
+                components=2,
+                dtype="f4",
+                wrap_x=gl.CLAMP_TO_EDGE,
+                wrap_y=gl.CLAMP_TO_EDGE,
+            )
+            attachments.append(property_image)
+
+        return lens_image, property_image, ctx.framebuffer(color_attachments=attachments)
+
+    def _initialise_patches(self, count: int):
+        columns = int(np.ceil(np.sqrt(count)))
+        grid = (columns, int(np.ceil(count / columns)))
+        if grid == self._patch_grid:
+            return
+
+        if self._patch_image is not None:
+            self._patch_frame.delete()
+            self._patch_image.delete()
+        size = self._patch_size
+        self._patch_image = self.ctx.texture(
+            (grid[0] * size, grid[1] * size),
+            components=2,
+            dtype=IRS_DEFLECTION_STORAGE[self._storage],
+            wrap_x=gl.CLAMP_TO_EDGE,
+            wrap_y=gl.CLAMP_TO_EDGE,
+            filter=(gl.LINEAR, gl.LINEAR),
         )
-        self._render_frame = ctx.framebuffer(color_attachments=[self._lens_image])
+        self._patch_frame = self.ctx.framebuffer(color_attachments=[self._patch_image])
+        self._patch_grid = grid
 
-        self._initialised = True
+    @property
+    def ctx(self) -> ArcadeContext:
+        if self._ctx is None:
+            self._ctx = get_window().ctx
+        return self._ctx
 
     @property
     def deflection_map(self) -> gl.Texture2D:
         self.initialise()
         return self._lens_image
 
+    @property
+    def lens_block(self) -> gl.Buffer:
+        self._initialise_lens_block()
+        return self._lens_block
+
     @property
     def width(self) -> int:
         return self._size[0]
@@ -112,14 +292,94 @@ class IRSDeflectionMap:
     def system(self) -> System:
         return self._system
 
+    @property
+    def storage(self) -> str:
+        return self._storage
+
+    @property
+    def nested(self) -> bool:
+        return self._patch_size > 0
+
+    @property
+    def patch_map(self) -> gl.Texture2D | None:
+        return self._patch_image
+
+    @property
+    def jacobian(self) -> bool:
+        return self._jacobian
+
+    @property
+    def potential(self) -> bool:
+        return self._potential
+
+    @property
+    def property_map(self) -> gl.Texture2D | None:
+        """
+        The Jacobian determinant (r) and Fermat potential (g) texture, if either is stored.
+        """
+        return self._property_image
+
+    def get_patches(self) -> list[tuple[int, float, float, float]]:
+        """
+        Get the lens index, packed position and half size of each patch of a nested map.
+        """
+        if self._patch_size <= 0:
+            return []
+        system = self._system
+        count = len(system.lenses)
+        if count == 0:
+            return []
+        if count > IRS_MAX_PATCHES:
+            logger.warning(
+                f"Only the {IRS_MAX_PATCHES} most massive of {count} lenses get a patch"
+            )
+        # Stable, so equal masses keep the order of the lenses
+        order = np.argsort(-system.get_lens_columns()[0], kind="stable")[:IRS_MAX_PATCHES]
+        positions = system.get_packed_positions()[order]
+        half = self._patch_scale * system.get_einstein_radii()[order]
+        return [
+            (int(idx), float(x), float(y), float(h))
+            for idx, (x, y), h in zip(order, positions, half)
+        ]
+
+    @property
+    def defines(self) -> dict[str, int]:
+        """
+        The shader defines needed by programs that sample the deflection map.
+        """
+        return {"RESIDUAL": int(self._storage == "residual"), "NESTED": int(self._patch_size > 0)}
+
+    def get_dominant_lens(self) -> tuple[int, float, float, float]:
+        """
+        Get the index, packed position, and mass fraction of the most massive lens.
+        This is the lens left out of residual deflection maps.
+        """
+        system = self._system
+        if not system.lenses:
+            return -1, 0.0, 0.0, 0.0
+        m, x, y = system.get_lens_columns()
+        idx = int(np.argmax(m))
+        Rl = system.lens_radius
+        return (
+            idx,
+            float((x[idx] - system.com_x) / Rl),
+            float((y[idx] - system.com_y) / Rl),
+            float(m[idx] / system.mass),
+        )
+
+    def _get_generated_dominant(self) -> tuple[int, float, float, float]:
+        # Maps loaded from data were never generated here, so they match the system
+        return self.get_dominant_lens() if self._dominant is None else self._dominant
+
     def _update_lens_block(self):
-        count = len(self._system.lenses)
-        self._lens_block.write(pack(f"2i {count * 4}f", count, 0, *self._system.pack_lenses()))
+        self._lens_block.write(self._system.pack_lens_block())
 
     def update_system(self, system: System):
-        self.initialise()
         old = self._system
         self._system = system
+        if not self._lens_initialised:
+            # The lens block will be filled from the new system when it is first needed
+            return
 
         old_count = len(old.lenses)
         count = len(system.lenses)
@@ -131,36 +391,336 @@ class IRSDeflectionMap:
 
         self._update_lens_block()
 
+    def _render_map(self, dominant: int):
+        self._lens_block.bind_to_storage_buffer()
+        if self._storage == "residual":
+            self._render_program["dominant"] = dominant
+        self._render_geometry.render(self._render_program)
+
     def generate(self):
         self.initialise()
+        self._dominant = self.get_dominant_lens()
 
-        self._ctx.disable(gl.BLEND)
+        self.ctx.disable(gl.BLEND)
         with self._render_frame.activate() as fbo:
+            fbo.clear()
+            self._render_map(self._dominant[0])
+
+        if self._patch_size > 0:
+            self._generate_patches()
+
+    def regenerate(self, band: int = 256) -> Generator[float, None, None]:
+        """
+        Regenerate the map for the current system a band of rows at a time, yielding
+        the fraction done after each band so the work can be spread over frames.
+
+        The bands are drawn into a second texture which is swapped in once every row
+        is done, so the map never mixes two systems. Until then it is still the map of
+        the system it was last generated for. If the system is updated part way the
+        regeneration starts again. The patches of a nested map are redrawn at the swap.
+        """
+        self.initialise()
+        ctx = self.ctx
+        w, h = self._size
+        band = max(1, band)
+
+        lens_image, property_image, frame = self._create_targets()
+        swapped = False
+        try:
+            start = 0
+            system = self._system
+            dominant = self.get_dominant_lens()
+            while start < h:
+                if self._system is not system:
+                    start = 0
+                    system = self._system
+                    dominant = self.get_dominant_lens()
+                rows = min(band, h - start)
+                ctx.disable(gl.BLEND)
+                with frame.activate() as fbo:
+                    fbo.scissor = (0, start, w, rows)
+                    self._render_map(dominant[0])
+                    fbo.scissor = None
+                start += rows
+                if start < h:
+                    yield start / h
+
+            self._render_frame.delete()
+            self._lens_image.delete()
+            if self._property_image is not None:
+                self._property_image.delete()
+            self._lens_image, self._property_image, self._render_frame = (
+                lens_image,
+                property_image,
+                frame,
+            )
+            self._dominant = dominant
+            swapped = True
+            if self._patch_size > 0:
+                self._generate_patches()
+            yield 1.0
+        finally:
+            if not swapped:
+                frame.delete()
+                lens_image.delete()
+                if property_image is not None:
+                    property_image.delete()
+
+    def _generate_patches(self):
+        self._patches = patches = self.get_patches()
+        if not patches:
+            return
+        self._initialise_patches(len(patches))
+        self._patch_buffer.write(
+            b"".join(get_region_byte_data(x, y, 2 * half, 2 * half) for _, x, y, half in patches)
+        )
+
+        size = self._patch_size
+        columns = self._patch_grid[0]
+        with self._patch_frame.activate() as fbo:
             fbo.clear()
             self._lens_block.bind_to_storage_buffer()
-            self._render_geometry.render(self._render_program)
+            if self._storage == "residual":
+                self._patch_program["dominant"] = self._get_generated_dominant()[0]
+            for idx in range(len(patches)):
+                fbo.viewport = (idx % columns * size, idx // columns * size, size, size)
+                self._patch_geometry.render(self._patch_program, first=idx * 4, vertices=4)
 
-    def use(self, unit: int = 0):
+    def use(self, unit: int = 0, program: gl.Program | None = None):
         self.initialise()
         self._lens_image.use(unit)
+        if program is not None and self._storage == "residual":
+            # The sampling program adds back the deflection of the dominant lens
+            _, x, y, fraction = self._get_generated_dominant()
+            program["dominant_lens"] = x, y, fraction
+            program["deflection_extent"] = self._viewport
+        if program is not None and self._patch_size > 0:
+            self._use_patches(program)
+
+    def _use_patches(self, program: gl.Program):
+        patches = self._patches
+        if self._patch_image is not None:
+            self._patch_image.use(IRS_PATCH_UNIT)
+        v_x, v_y = self._viewport
+        values = [0.0] * (IRS_MAX_PATCHES * 4)
+        for idx, (_, x, y, half) in enumerate(patches):
+            # The patches are placed in the uv space of the map
+            values[idx * 4 : idx * 4 + 4] = (
+                0.5 * x / v_x + 0.5,
+                0.5 * y / v_y + 0.5,
+                0.5 * half / v_x,
+                0.5 * half / v_y,
+            )
+        # The patch uniforms are optimised out of programs that never sample the map
+        program.set_uniform_safe("deflection_patches", IRS_PATCH_UNIT)
+        program.set_uniform_safe("patch_count", len(patches))
+        program.set_uniform_safe("patch_grid", self._patch_grid)
+        program.set_uniform_array_safe("patches", values)
+
+    def release(self):
+        """
+        Delete the deflection map and lens block. The shared program and geometry are
+        kept, see `GMLID.resources.release_resources()`.
+        """
+        if self._initialised:
+            self._render_frame.delete()
+            self._lens_image.delete()
+            if self._property_image is not None:
+                self._property_image.delete()
+                self._property_image = None
+            if self._patch_size > 0:
+                if self._patch_image is not None:
+                    self._patch_frame.delete()
+                    self._patch_image.delete()
+                    self._patch_image = None
+                    self._patch_grid = (0, 0)
+                self._patch_buffer.delete()
+                self._patches = []
+            self._initialised = False
+        if self._lens_initialised:
+            self._lens_block.delete()
+            self._lens_initialised = False
 
     def read(self) -> np.ndarray:
         data = self._lens_image.read()
         w, h = self._size
-        return np.frombuffer(data, dtype=np.float32, count=w * h * 2).reshape((w, h, 2))[::-1, :]
+        dtype = np.float16 if IRS_DEFLECTION_STORAGE[self._storage] == "f2" else np.float32
+        array = np.frombuffer(data, dtype=dtype, count=w * h * 2).reshape((h, w, 2))
+        array = array.astype(np.float32)
+
+        if self._storage == "residual":
+            # Rebuild the source positions from the texel centers and the dominant lens
+            v_x, v_y = self._viewport
+            x = ((np.arange(w, dtype=np.float32) + 0.5) / w * 2.0 - 1.0) * v_x
+            y = ((np.arange(h, dtype=np.float32) + 0.5) / h * 2.0 - 1.0) * v_y
+            rays = np.stack(np.meshgrid(x, y), axis=-1)
+            _, l_x, l_y, fraction = self._get_generated_dominant()
+            relative = rays - np.asarray((l_x, l_y), dtype=np.float32)
+            separation = np.sum(relative**2, axis=-1, keepdims=True)
+            array = rays - array - fraction * relative / separation
+
+        return array[::-1, :]
+
+    def _read_property(self, component: int) -> np.ndarray:
+        self.initialise()
+        if self._property_image is None:
+            logger.error("The deflection map wasn't created with a jacobian or potential")
+            raise ValueError("The deflection map wasn't created with a jacobian or potential")
+        w, h = self._size
+        data = np.frombuffer(self._property_image.read(), dtype=np.float32, count=w * h * 2)
+        return data.reshape((h, w, 2))[::-1, :, component]
+
+    def read_jacobian(self) -> np.ndarray:
+        """
+        Read the determinant of the Jacobian, in the same orientation as `read()`.
+        """
+        if not self._jacobian:
+            logger.error("The deflection map wasn't created with a jacobian")
+            raise ValueError("The deflection map wasn't created with a jacobian")
+        return self._read_property(0)
+
+    def read_potential(self) -> np.ndarray:
+        """
+        Read the Fermat potential, in the same orientation as `read()`.
+        """
+        if not self._potential:
+            logger.error("The deflection map wasn't created with a potential")
+            raise ValueError("The deflection map wasn't created with a potential")
+        return self._read_property(1)
+
+    def get_critical_curves(self) -> np.ndarray:
+        """
+        Find the critical curves as (N, 2, 2) line segments in the lens plane by
+        contouring where the Jacobian determinant is zero. The map must be generated.
+        """
+        determinant = self.read_jacobian()
+        w, h = self._size
+        v_x, v_y = self._viewport
+        # The texel centres, with the rows from the top to match read()
+        x = ((np.arange(w) + 0.5) / w * 2.0 - 1.0) * v_x
+        y = ((np.arange(h) + 0.5) / h * 2.0 - 1.0)[::-1] * v_y
+        return get_contour_segments(determinant, x, y)
+
+    def get_caustics(self, critical_curves: np.ndarray | None = None) -> np.ndarray:
+        """
+        Map the critical curve segments onto the source plane with the lens equation.
+        """
+        if critical_curves is None:
+            critical_curves = self.get_critical_curves()
+        points = apply_lens_equation(self._system, critical_curves.reshape((-1, 2)))
+        return points.reshape(critical_curves.shape)
+
+    def get_export(
+        self,
+        distance_range: float = 2.0,
+        clipped: bool = True,
+        blue_value: float = 127,
+        **options: Any,
+    ) -> IRSExport:
+        """
+        Colour the source plane positions on the GPU as red and green, mapping
+        -distance_range/2 - distance_range/2 to 0 - 255. See `IRSExport`.
+        """
+        self.initialise()
+        return IRSExport(
+            self.ctx,
+            self._lens_image,
+            limits=(-distance_range / 2, distance_range / 2),
+            deflection=True,
+            blue=blue_value / 255.0,
+            wrap=not clipped,
+            defines=self.defines,
+            setup=lambda program: self.use(0, program),
+            **options,
+        )
+
+    def export(
+        self, path: Path | str, thumbnail: int | None = None, alpha: bool = False, **options: Any
+    ):
+        """
+        Stream the map into a PNG, see `get_export()` for the options.
+        """
+        export_png(self.get_export, path, thumbnail=thumbnail, alpha=alpha, **options)
 
     def capture(
         self, distance_range: float = 2.0, clipped: bool = True, blue_value: float = 127
     ) -> Image.Image:
-        # maps -distance_range/2 - distance_range/2 to 0.0 - 1.0
-        data = (self.read() / distance_range + 0.5) * 255
-        if clipped:
-            data = np.clip(data, 0.0, 255.0)
-        pixels = np.zeros((self._size[0], self._size[1], 3), dtype=np.float32)
-        pixels[::-1, ::, :2] = data  # set Red and Green values
-        pixels[:, :, 2] = blue_value  # set Blue values
-        img = Image.fromarray(pixels.astype(np.uint8), "RGB")
-        return img
+        export = self.get_export(distance_range, clipped, blue_value)
+        # The capture has always had the bottom row of the map first
+        pixels = export.read()[::-1, :, :3]
+        export.release()
+        return Image.fromarray(np.ascontiguousarray(pixels))
+
+
+class _IRSPassTimer:
+    """
+    Measures the GPU time of batches of histogram passes without stalling the CPU.
+    Each batch is wrapped in a GL_TIME_ELAPSED query and followed by a fence sync.
+    The query results are collected once available, and the fence tells whether the
+    GPU has caught up with the last batch so no more than a frame of work is queued.
+    """
+
+    def __init__(self) -> None:
+        # (query, passes) of the batches whose time isn't available yet
+        self._pending: list[tuple[int, int]] = []
+        self._fence = None
+        # Exponential moving average of the GPU seconds per pass
+        self.pass_time: float | None = None
+
+    @property
+    def busy(self) -> bool:
+        if self._fence is None:
+            return False
+        status = pgl.glClientWaitSync(self._fence, 0, 0)
+        if status == pgl.GL_TIMEOUT_EXPIRED:
+            return True
+        pgl.glDeleteSync(self._fence)
+        self._fence = None
+        return False
+
+    def begin(self, passes: int):
+        query = pgl.GLuint()
+        pgl.glGenQueries(1, byref(query))
+        pgl.glBeginQuery(pgl.GL_TIME_ELAPSED, query)
+        self._pending.append((query.value, passes))
+
+    def end(self):
+        pgl.glEndQuery(pgl.GL_TIME_ELAPSED)
+        if self._fence is not None:
+            pgl.glDeleteSync(self._fence)
+        self._fence = pgl.glFenceSync(pgl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+    def poll(self):
+        while self._pending:
+            query, passes = self._pending[0]
+            available = pgl.GLint()
+            pgl.glGetQueryObjectiv(query, pgl.GL_QUERY_RESULT_AVAILABLE, byref(available))
+            if not available.value:
+                return
+            elapsed = pgl.GLuint64()
+            pgl.glGetQueryObjectui64v(query, pgl.GL_QUERY_RESULT, byref(elapsed))
+            pgl.glDeleteQueries(1, byref(pgl.GLuint(query)))
+            self._pending.pop(0)
+
+            pass_time = elapsed.value * 1e-9 / passes
+            if self.pass_time is None:
+                self.pass_time = pass_time
+            else:
+                self.pass_time = 0.5 * (self.pass_time + pass_time)
+
+    def get_passes(self, budget: float) -> int:
+        # Until the first batch has been timed only one pass is risked
+        if self.pass_time is None or self.pass_time <= 0.0:
+            return 1
+        return max(1, int(budget / self.pass_time))
+
+    def release(self):
+        for query, _ in self._pending:
+            pgl.glDeleteQueries(1, byref(pgl.GLuint(query)))
+        self._pending = []
+        if self._fence is not None:
+            pgl.glDeleteSync(self._fence)
+            self._fence = None
 
 
 class IRSHistogram:
@@ -178,10 +738,55 @@ class IRSHistogram:
     When properties of the LensSystem change the histogram has to be flushed.
     This is an expensive operation so avoid doing it more than necessary.
 
-    There are two methods for calculating where in the source plane the image lands.
-    Firstly a "deflection map" can be generated which computes the deflection at set
-    angles. This is then interpolated for interim positions. The second is to compute
-    the deflection for each ray directly. This is more costly, but more accurate.
+    GPU resources are only created once, so repeated calls to `generate()` keep
+    accumulating into the same texture (including data loaded from a file). The
+    ray origins are derived from gl_VertexID, so no ray grid is ever built on the CPU.
+
+    There are three modes for calculating where in the source plane the image lands.
+    "interpolated" uses the "deflection map" which computes the deflection at set
+    angles. This is then interpolated for interim positions. "direct" computes the
+    deflection for each ray from the lens block. This is more costly, but more accurate,
+    and the deflection texture is never needed. "texel" fetches the deflection map
+    texel under each ray without jitter or interpolation. This is deterministic, so
+    it is best used with a high resolution deflection map and a single iteration.
+
+    Each iteration every ray is jittered within its cell of the ray grid. "random"
+    jitter reseeds a hash every iteration, and so converges at 1/sqrt(N). "r2"
+    jitter instead steps along the R2 low-discrepancy sequence (rotated by a fixed
+    random amount per ray) which fills each cell far more evenly, and reaches the
+    same noise level in fewer iterations.
+
+    By default each ray adds one to the pixel it lands in, which adds quantisation
+    noise on top of the sampling noise. "bilinear" deposition instead splits each ray
+    between the four nearest pixels by where it landed within them, drawing the ray as
+    a 2x2 point. This smooths the histogram slightly, but cuts the noise of each pixel.
+    Rays landing just outside the histogram are clipped, so the outermost pixels miss
+    the share they would get from them. `deposit_rays()` does the same on the CPU.
+
+    For interactive use a histogram can have multiple levels. Each level is half the
+    size of the last and shoots half the rays along each axis. Stepping renders the
+    levels coarse to fine, so a low resolution preview is available immediately and
+    refines over the following steps. Every level sums the rays of the finer levels,
+    forming a mip-style pyramid that can be read with `read(level=...)`.
+
+    `generate()` blocks until every iteration is done. An interactive application
+    should instead call `advance()` once a frame, which submits as many passes as fit
+    in a GPU time budget and returns straight away. The time of each batch is measured
+    on the GPU, and no new passes are submitted while the GPU is still behind, so the
+    frame rate holds while the histogram refines as fast as the GPU allows. `refine()`
+    wraps this in an async iterator, which stops after `cancel()` or when the system
+    of the deflection map changes.
+
+    To zoom in on part of the source plane the histogram can be moved by its `centre`.
+    Most rays then land outside of the histogram, so with `roi` the ray grid is split
+    into tiles and only the tiles whose rays can land inside the histogram are shot.
+    The tiles are found by bounding the lens equation over blocks of tiles on the CPU
+    (see `get_lens_equation_bounds()`), so the deflection map is never read back and
+    the bounds hold for every ray mode and storage. Near a lens the bounds cover the
+    whole source plane, so fields of many lenses gain little. The tiles are found
+    again after every `clear()`, so clear the histogram once the system has changed.
+    The histogram is the same as when every ray is shot, but the cost scales with the
+    area of the lens plane that maps into it.
     """
 
     def __init__(
@@ -191,61 +796,154 @@ class IRSHistogram:
         deflection_map: IRSDeflectionMap,
         *,
         viewport: tuple[float, float] = (2.0, 2.0),
+        centre: tuple[float, float] = (0.0, 0.0),
+        roi: bool = False,
         delay: float | None = None,
+        jitter: str = "random",
+        mode: str = "interpolated",
+        deposition: str = "point",
+        levels: int = 1,
         lazy: bool = False,
         iterations: int = 0,
         data: Buffer | None = None,
     ) -> None:
+        if mode not in IRS_RAY_MODES:
+            logger.error(f"Unknown ray mode {mode}. Expected one of {tuple(IRS_RAY_MODES)}")
+            raise ValueError(f"Unknown ray mode {mode}. Expected one of {tuple(IRS_RAY_MODES)}")
+        if jitter not in IRS_JITTER_MODES:
+            logger.error(f"Unknown jitter mode {jitter}. Expected one of {tuple(IRS_JITTER_MODES)}")
+            raise ValueError(
+                f"Unknown jitter mode {jitter}. Expected one of {tuple(IRS_JITTER_MODES)}"
+            )
+        if deposition not in IRS_DEPOSITION_MODES:
+            logger.error(
+                f"Unknown deposition mode {deposition}. Expected one of {tuple(IRS_DEPOSITION_MODES)}"
+            )
+            raise ValueError(
+                f"Unknown deposition mode {deposition}. Expected one of {tuple(IRS_DEPOSITION_MODES)}"
+            )
+        if levels < 1:
+            logger.error(f"A histogram needs at least one level, not {levels}")
+            raise ValueError(f"A histogram needs at least one level, not {levels}")
+        factor = 2 ** (levels - 1)
+        if count % factor or size[0] % factor or size[1] % factor:
+            logger.warning(
+                f"The ray count and size of a {levels} level histogram should be divisible by {factor} "
+                "otherwise the coarser levels will have a different ray density"
+            )
+
         self._size: tuple[int, int] = size
         self._viewport: tuple[float, float] = viewport
+        self._centre: tuple[float, float] = centre
         self._ray_count: int = count
         self._delay: float | None = delay
+        self._jitter: str = jitter
+        self._mode: str = mode
+        self._deposition: str = deposition
+        self._levels: int = levels
 
-        self._iterations: int = iterations
+        # The iterations of each level. Only the first level can be loaded from data
+        self._level_iterations: list[int] = [iterations] + [0] * (levels - 1)
 
         self._ctx: ArcadeContext
 
         self._deflection_map: IRSDeflectionMap = deflection_map
-        self._histogram: gl.Texture2D
+        self._histograms: list[gl.Texture2D]
 
         self._ray_geometry: gl.Geometry
         self._ray_program: gl.Program
-        self._ray_frame: gl.Framebuffer
+        self._ray_frames: list[gl.Framebuffer]
+
+        # The summed levels of a progressive histogram, the first is the full histogram
+        self._pyramid: list[gl.Texture2D]
+        self._pyramid_frames: list[gl.Framebuffer]
+        self._pyramid_geometry: gl.Geometry
+        self._pyramid_program: gl.Program
+        self._pyramid_built: bool = False
+
+        # The tiles of the ray grid which are shot when using a region of interest.
+        # The tiles must cover at least one ray of the coarsest level.
+        self._roi: bool = roi
+        self._roi_tile: int = min(max(IRS_ROI_TILE, factor), count)
+        self._roi_block: gl.Buffer | None = None
+        self._roi_tile_count: int = 0
+        self._roi_found: bool = False
+
+        # Measures the passes submitted by advance(), created with the GPU resources
+        self._timer: _IRSPassTimer | None = None
+        # Incremented by cancel() to stop every running refine()
+        self._generation: int = 0
 
         self._initialised: bool = False
         if not lazy or data is not None:
             self.initialise(data=data)
 
-    def initialise(self, /, force: bool = True, data: Buffer | None = None):
+    def initialise(self, /, force: bool = False, data: Buffer | None = None):
         if self._initialised and not force:
             return
 
-        self._ctx = ctx = get_window().ctx
-        self._histogram = ctx.texture(self._size, components=1, dtype="f4", data=data)
-
-        # Evenly space x rays between 0.0 and 1.0 (exclusive)
-        # This places the ray's at the center of pixels if the ray count matches the size
-        # On th GPU these use the deflection to find the final location
-        # in the output histogram.
-        count = self._ray_count
-        x = np.linspace(0.5 / count, 1.0 - 0.5 / count, self._ray_count, dtype=np.float32)
-        xy, yx = np.meshgrid(x, x)
-        rays = np.asarray((xy, yx)).transpose((1, 2, 0))  # create 2d array of x,y positions
-        self._ray_geometry = ctx.geometry(
-            [gl.BufferDescription(ctx.buffer(data=rays.tobytes()), "2f", ["origin"])],
-            mode=gl.POINTS,
-        )
+        self._ctx = ctx = self._deflection_map.ctx
+        self._histograms = [
+            ctx.texture(
+                self.get_level_size(level),
+                components=1,
+                dtype="f4",
+                data=data if level == 0 else None,
+            )
+            for level in range(self._levels)
+        ]
+        self._ray_frames = [
+            ctx.framebuffer(color_attachments=histogram) for histogram in self._histograms
+        ]
+
+        # The rays have no attributes. Their origin is derived from gl_VertexID
+        # so nothing has to be built or uploaded from the CPU.
+        resources = get_resources(ctx)
+        self._ray_geometry = resources.get_point_geometry()
+
+        if self._mode == "texel":
+            self._ray_program = resources.load_program(
+                vertex_shader="IRS_histogram_texel_vs",
+                fragment_shader="IRS_histogram_fs",
+                defines={
+                    "ROI": int(self._roi),
+                    "DEPOSIT": IRS_DEPOSITION_MODES[self._deposition],
+                    **self._deflection_map.defines,
+                },
+            )
+        else:
+            self._ray_program = resources.load_program(
+                vertex_shader="IRS_histogram_vs",
+                fragment_shader="IRS_histogram_fs",
+                defines={
+                    "JITTER": IRS_JITTER_MODES[self._jitter],
+                    "MODE": IRS_RAY_MODES[self._mode],
+                    "ROI": int(self._roi),
+                    "DEPOSIT": IRS_DEPOSITION_MODES[self._deposition],
+                    **self._deflection_map.defines,
+                },
+            )
+
+        self._pyramid = [self._histograms[0]]
+        self._pyramid_frames = []
+        if self._levels > 1:
+            for level in range(1, self._levels):
+                texture = ctx.texture(self.get_level_size(level), components=1, dtype="f4")
+                self._pyramid.append(texture)
+                self._pyramid_frames.append(ctx.framebuffer(color_attachments=texture))
+            self._pyramid_geometry = resources.get_fullscreen_geometry()
+            self._pyramid_program = resources.load_program(
+                vertex_shader="UTIL_unprojected_uv_vs",
+                fragment_shader="IRS_histogram_pyramid_fs",
+            )
+        self._pyramid_built = False
+        self._roi_found = False
 
-        self._ray_program = ctx.load_program(
-            vertex_shader=get_glsl("IRS_histogram_vs"), fragment_shader=get_glsl("IRS_histogram_fs")
-        )
-        self._ray_program["shift"] = (1.0 / count, 1.0 / count)
-        self._ray_program["scale"] = 1.0 / self._viewport[0], 1.0 / self._viewport[1]
-        self._ray_frame = ctx.framebuffer(color_attachments=(self._histogram))
+        self._initialised = True
 
     @property
     def histogram(self) -> gl.Texture2D:
-        return self._histogram
+        return self._histograms[0]
 
     @property
     def ray_count(self) -> int:
@@ -267,14 +965,49 @@ class IRSHistogram:
     def viewport_y(self) -> float:
         return self._viewport[1]
 
+    @property
+    def centre(self) -> tuple[float, float]:
+        return self._centre
+
+    @property
+    def roi(self) -> bool:
+        return self._roi
+
+    @property
+    def roi_fraction(self) -> float:
+        """
+        The fraction of the ray grid shot each iteration.
+        """
+        if not self._roi:
+            return 1.0
+        self._find_roi()
+        tiles = -(-self._ray_count // self._roi_tile)
+        return self._roi_tile_count / tiles**2
+
     @property
     def iterations(self) -> int:
-        return self._iterations
+        return self._level_iterations[0]
+
+    @property
+    def levels(self) -> int:
+        return self._levels
 
     @property
     def delay(self) -> float | None:
         return self._delay
 
+    @property
+    def jitter(self) -> str:
+        return self._jitter
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    @property
+    def deposition(self) -> str:
+        return self._deposition
+
     @property
     def deflection_map(self) -> IRSDeflectionMap:
         return self._deflection_map
@@ -283,50 +1016,319 @@ class IRSHistogram:
     def system(self) -> System:
         return self._deflection_map.system
 
+    def get_level_size(self, level: int) -> tuple[int, int]:
+        return max(1, self._size[0] >> level), max(1, self._size[1] >> level)
+
+    def get_level_count(self, level: int) -> int:
+        return max(1, self._ray_count >> level)
+
+    def get_iterations(self, level: int = 0) -> int:
+        """
+        The number of iterations of the given level the summed histogram is worth.
+        Every pass of a finer level adds four times the rays per pixel of a pass
+        at the coarser level.
+        """
+        iterations = 0
+        for idx in range(level + 1):
+            iterations = 4 * iterations + self._level_iterations[idx]
+        return iterations
+
+    def get_histogram(self, level: int = 0) -> gl.Texture2D:
+        """
+        Get the histogram texture of a level with every ray shot at finer levels summed in.
+        """
+        self._build_pyramid()
+        return self._pyramid[level]
+
     def clear(self):
-        self._iterations = 0
-        self._ray_frame.clear()
+        self._level_iterations = [0] * self._levels
+        self._roi_found = False
+        self.flush()
 
-    def step(self):
-        # Set the blend mode to additive so it counts the number of rays that
-        # hit each pixel
-        self._ctx.blend_func = gl.BLEND_ADDITIVE
-        self._ctx.enable(gl.BLEND)
+    def _find_roi(self):
+        if not self._roi or self._roi_found:
+            return
 
-        # Set the ray size to 1 pixel square
-        self._ctx.point_size = 1
+        # The tiles are grouped into blocks, so the cost of bounding them is capped.
+        # Systems with many lenses get fewer, larger blocks. Blocks must cover a texel
+        # of the deflection map, as interpolated rays sample the texels either side.
+        deflection = self._deflection_map
+        count, tile = self._ray_count, self._roi_tile
+        tiles = -(-count // tile)
+        lenses = max(1, len(deflection.system.lenses))
+        blocks = min(IRS_ROI_BLOCKS, max(1, int(np.sqrt(IRS_ROI_EVALUATIONS / lenses))))
+        per_block = -(-tiles // blocks)
+        if self._mode != "direct":
+            texels = min(deflection.width, deflection.height)
+            per_block = max(per_block, -(-count // (tile * texels)))
+        starts = np.arange(0, tiles, per_block) * tile
+        edges = np.append(starts, count) / count * 2.0 - 1.0
+        x_edges = edges * deflection.viewport_x
+        y_edges = edges * deflection.viewport_y
+
+        low, high, lipschitz = get_lens_equation_bounds(deflection.system, x_edges, y_edges)
+        margin = np.zeros(lipschitz.shape)
+        if deflection.storage != "f4":
+            # 16-bit texels are rounded by up to half of their last bit
+            stored = np.max(np.maximum(np.abs(low), np.abs(high)), axis=-1)
+            if deflection.storage == "residual":
+                # Residual texels hold the lens plane position less the source position
+                # and the deflection of the dominant lens, which is bounded by one over
+                # the distance to it
+                _, l_x, l_y, fraction = deflection._get_generated_dominant()
+                x_near = np.abs(0.5 * (x_edges[:-1] + x_edges[1:]) - l_x) - 0.5 * np.diff(x_edges)
+                y_near = np.abs(0.5 * (y_edges[:-1] + y_edges[1:]) - l_y) - 0.5 * np.diff(y_edges)
+                x_near, y_near = np.maximum(x_near, 0.0), np.maximum(y_near, 0.0)
+                with np.errstate(divide="ignore"):
+                    dominant = fraction / np.hypot(x_near[None, :], y_near[:, None])
+                plane = max(np.max(np.abs(x_edges)), np.max(np.abs(y_edges)))
+                stored = stored + plane + dominant
+                # The dominant lens is added back exactly, but the rest of the residual is
+                # interpolated, so it can be off by the change of the lens equation over a
+                # texel
+                texel = np.hypot(
+                    deflection.viewport_x / deflection.width,
+                    deflection.viewport_y / deflection.height,
+                )
+                margin = margin + lipschitz * texel
+            margin = margin + stored * 2.0**-10
+        low = low - margin[..., None]
+        high = high + margin[..., None]
+
+        bounds = []
+        for reduce, bound in ((np.fmin, low), (np.fmax, high)):
+            # Jittered rays can move past the edge of their block, so grow the bounds
+            # by the neighbouring blocks. Rays wrap around the grid.
+            padded = np.pad(bound, ((1, 1), (1, 1), (0, 0)), mode="wrap")
+            for dy in range(3):
+                for dx in range(3):
+                    bound = reduce(bound, padded[dy : dy + bound.shape[0], dx : dx + bound.shape[1]])
+            bounds.append(bound)
+        low, high = bounds
+
+        # Give the window a pixel of margin so rays on its edge are kept
+        v_x, v_y = self._viewport
+        c_x, c_y = self._centre
+        p_x, p_y = 2.0 * v_x / self._size[0], 2.0 * v_y / self._size[1]
+        selected = (
+            (high[..., 0] >= c_x - v_x - p_x)
+            & (low[..., 0] <= c_x + v_x + p_x)
+            & (high[..., 1] >= c_y - v_y - p_y)
+            & (low[..., 1] <= c_y + v_y + p_y)
+        )
+        selected = np.repeat(np.repeat(selected, per_block, axis=0), per_block, axis=1)
+        selected = selected[:tiles, :tiles]
+        tile_grid = np.argwhere(selected)[:, ::-1].astype(np.int32)  # (row, column) -> (x, y)
+
+        if self._roi_block is not None:
+            self._roi_block.delete()
+            self._roi_block = None
+        self._roi_tile_count = len(tile_grid)
+        if self._roi_tile_count:
+            self.initialise()
+            self._roi_block = self._ctx.buffer(data=tile_grid.tobytes())
+        self._roi_found = True
+        logger.debug(
+            f"IRSHistogram region of interest uses {self._roi_tile_count}/{selected.size} tiles"
+        )
 
-        with self._ray_frame.activate():
-            # Bind the deflection map to be used by the program, and set the random
-            # seed used to adjust the ray positions
-            self._deflection_map.use()
+    def _bind_deflection(self):
+        # Direct rays only need the lenses, so the deflection texture is never touched
+        if self._mode == "direct":
+            self._deflection_map.lens_block.bind_to_storage_buffer()
+        else:
+            self._deflection_map.use(0, self._ray_program)
+
+    def _update_rays(self, level: int = 0):
+        # The ray programs are shared between histograms so every uniform is set per pass
+        count = self.get_level_count(level)
+        self._ray_program["count"] = count
+        self._ray_program["centre"] = self._centre
+        self._ray_program["scale"] = 1.0 / self._viewport[0], 1.0 / self._viewport[1]
+        if self._roi:
+            self._ray_program["tile"] = max(1, self._roi_tile >> level)
+        if self._deposition == "bilinear":
+            self._ray_program["resolution"] = self.get_level_size(level)
+        if self._mode == "direct":
+            deflection = self._deflection_map
+            self._ray_program["extent"] = deflection.viewport_x, deflection.viewport_y
+        # Texel rays are never jittered
+        if self._mode == "texel":
+            return
+        # Each level has a coarser ray grid so the rays are jittered across larger cells
+        self._ray_program["shift"] = (1.0 / count, 1.0 / count)
+        # The R2 sequence is indexed by the total iterations so continuing a
+        # generation carries on the sequence rather than repeating it.
+        if self._jitter == "r2":
+            self._ray_program["offset"] = get_r2_offset(self._level_iterations[level])
+        else:
             self._ray_program["seed"] = random()
-            self._ray_geometry.render(self._ray_program)
+
+    def _get_step_level(self) -> int:
+        # Progressive histograms are rendered coarse to fine, one level per step. Each
+        # coarser level costs a quarter of the rays, so a preview is ready within a frame.
+        # Afterwards only the full histogram is stepped, which also refines the coarser
+        # levels as the pyramid sums every ray into them.
+        return max(0, self._levels - 1 - sum(self._level_iterations))
+
+    def _build_pyramid(self):
+        if self._pyramid_built:
+            return
 
         self._ctx.disable(gl.BLEND)
-        self._iterations += 1
-        logger.debug("IRSHistogram finished single step. [Total Iterations = %i]", self._iterations)
+        for level in range(1, self._levels):
+            with self._pyramid_frames[level - 1].activate():
+                self._pyramid_program["finer"] = 0
+                self._pyramid_program["level"] = 1
+                self._pyramid[level - 1].use(0)
+                self._histograms[level].use(1)
+                self._pyramid_geometry.render(self._pyramid_program)
+        self._pyramid_built = True
+
+    def _render_rays(self, level: int = 0):
+        if not self._roi:
+            count = self.get_level_count(level)
+            self._ray_geometry.render(self._ray_program, vertices=count * count)
+            return
 
-    def generate(self, iterations: int = 1000, flush: bool = False):
-        self.initialise()
-        if flush:
-            self._ray_frame.clear()
+        # Each instance is a tile of the region of interest
+        if self._roi_block is None:
+            return
+        tile = max(1, self._roi_tile >> level)
+        self._roi_block.bind_to_storage_buffer(binding=1)
+        self._ray_geometry.render(
+            self._ray_program, vertices=tile * tile, instances=self._roi_tile_count
+        )
 
+    def _begin_rays(self):
         # Set the blend mode to additive so it counts the number of rays that
         # hit each pixel
         self._ctx.blend_func = gl.BLEND_ADDITIVE
         self._ctx.enable(gl.BLEND)
 
-        # Set the ray size to 1 pixel square
+        # Set the ray size to 1 pixel square. Bilinear rays set their own size
+        # to cover the four pixels they are split between.
         self._ctx.point_size = 1
+        if self._deposition == "bilinear":
+            self._ctx.enable(GL_PROGRAM_POINT_SIZE)
+
+    def _end_rays(self):
+        self._ctx.disable(gl.BLEND, GL_PROGRAM_POINT_SIZE)
+        self._pyramid_built = False
+
+    def _step_level(self) -> int:
+        level = self._get_step_level()
+        with self._ray_frames[level].activate():
+            # Bind the deflection map to be used by the program, and set the jitter
+            # used to adjust the ray positions
+            self._bind_deflection()
+            self._update_rays(level)
+            self._render_rays(level)
+        self._level_iterations[level] += 1
+        return level
+
+    def step(self):
+        self.initialise()
+        self._find_roi()
+
+        self._begin_rays()
+        level = self._step_level()
+        self._end_rays()
+        logger.debug(
+            "IRSHistogram finished single step of level %i. [Total Iterations = %i]",
+            level,
+            self._level_iterations[level],
+        )
+
+    def advance(self, time_budget_ms: float = 8.0, limit: int | None = None) -> int:
+        """
+        Submit as many passes as fit in about `time_budget_ms` of GPU time, without
+        waiting for them to finish. Returns the number of passes submitted, which is
+        zero while the GPU is still working through the last call's passes. At most
+        `limit` passes are submitted.
+        """
+        self.initialise()
+        if self._timer is None:
+            self._timer = _IRSPassTimer()
+        timer = self._timer
+
+        timer.poll()
+        if timer.busy:
+            return 0
+        passes = timer.get_passes(time_budget_ms * 1e-3)
+        if limit is not None:
+            passes = min(passes, limit)
+        if passes <= 0:
+            return 0
+
+        self._find_roi()
+        self._begin_rays()
+        timer.begin(passes)
+        for _ in range(passes):
+            self._step_level()
+        timer.end()
+        self._end_rays()
+        logger.debug(
+            f"IRSHistogram advanced {passes} passes. [Total Iterations = {self.iterations}]"
+        )
+        return passes
 
-        with self._ray_frame.activate():
+    @property
+    def pass_time(self) -> float | None:
+        """
+        The measured GPU seconds per pass of `advance()`, None until the first is timed.
+        """
+        if self._timer is None:
+            return None
+        self._timer.poll()
+        return self._timer.pass_time
+
+    def cancel(self):
+        """
+        Stop every running `refine()`. Passes already submitted still land.
+        """
+        self._generation += 1
+
+    async def refine(
+        self,
+        iterations: int | None = None,
+        time_budget_ms: float = 8.0,
+        frame_time: float = 1.0 / 60.0,
+    ) -> AsyncIterator[int]:
+        """
+        Advance the histogram once every `frame_time` seconds, yielding the total
+        iterations after each call that submitted passes. It stops after `iterations`
+        more passes (forever if None), after `cancel()`, or when the system of the
+        deflection map is updated. Cancelling the task awaiting it also stops it.
+        """
+        generation = self._generation
+        system = self._deflection_map.system
+        target = None if iterations is None else self.iterations + iterations
+        while generation == self._generation and self._deflection_map.system is system:
+            remaining = None if target is None else target - self.iterations
+            if remaining is not None and remaining <= 0:
+                return
+            if self.advance(time_budget_ms, remaining):
+                yield self.iterations
+            await asyncio.sleep(frame_time)
+
+    def generate(self, iterations: int = 1000, flush: bool = False):
+        self.initialise()
+        self._find_roi()
+        if flush:
+            self.flush()
+
+        self._begin_rays()
+
+        # Generation always renders the full histogram, the coarser levels of a
+        # progressive histogram are only for previews while stepping.
+        with self._ray_frames[0].activate():
             # Bind the deflection map to be used by the program
-            self._deflection_map.deflection_map.use()
+            self._bind_deflection()
             for i in range(iterations):
-                # set the random seed used to adjust the ray positions
-                self._ray_program["seed"] = random()
-                self._ray_geometry.render(self._ray_program)
+                # set the jitter used to adjust the ray positions
+                self._update_rays()
+                self._render_rays()
 
                 # Wait until the gpu is finished or a set amount of time
                 # as to not overload the GPU. Can have major performance hits
@@ -334,16 +1336,294 @@ class IRSHistogram:
                     self._ctx.finish()
                 elif self._delay:
                     sleep(self._delay)
-                self._iterations += 1
+                self._level_iterations[0] += 1
                 logger.debug(
-                    f"IRSHistogram generation step {i + 1} ({100 * (i + 1) / iterations:.1f}%) [Total Iterations = {self._iterations}]"
+                    f"IRSHistogram generation step {i + 1} ({100 * (i + 1) / iterations:.1f}%) [Total Iterations = {self.iterations}]"
                 )
 
+        self._end_rays()
+        logger.debug(f"IRSHistogram finished generation. [Total Iterations = {self.iterations}]")
+
+    def flush(self):
+        for frame in self._ray_frames:
+            frame.clear()
+        self._pyramid_built = False
+
+    def release(self):
+        """
+        Delete the histogram textures. The shared programs and geometry are kept,
+        see `GMLID.resources.release_resources()`.
+        """
+        if not self._initialised:
+            return
+        for frame in self._ray_frames + self._pyramid_frames:
+            frame.delete()
+        for texture in self._histograms + self._pyramid[1:]:
+            texture.delete()
+        if self._roi_block is not None:
+            self._roi_block.delete()
+            self._roi_block = None
+        if self._timer is not None:
+            self._timer.release()
+            self._timer = None
+        self._initialised = False
+
+    def get_statistics(self, level: int = 0) -> IRSStatistics:
+        """
+        The maximum, minimum, sum and sum of squares of the histogram of a level,
+        reduced on the GPU so only a few bytes are read back.
+        """
+        return get_reducer(self._ctx).reduce(self.get_histogram(level))
+
+    def get_magnification_distribution(
+        self, bins: int = 64, range: tuple[float, float] = (-1.0, 3.0), level: int = 0
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The number of pixels of a level in `bins` bins of log10 magnification, binned
+        on the GPU. Returns the counts and the bin edges like `np.histogram`.
+        """
+        rays = get_rays_per_pixel(self, self.get_iterations(level))
+        return get_reducer(self._ctx).bin_log(
+            self.get_histogram(level), bins, range, 1.0 / rays
+        )
+
+    def read(self, normalised: bool = False, level: int = 0) -> np.ndarray:
+        """
+        Read the histogram of a level. Coarser levels include the rays shot at finer
+        levels, so they should be normalised by `get_iterations(level)`.
+        """
+        texture = self.get_histogram(level)
+        data = texture.read()
+        w, h = texture.size
+        array = np.frombuffer(data, dtype=np.float32, count=w * h).reshape((h, w))[::-1, :]
+        cap = 1.0 if not normalised else np.max(array)
+        return array / cap
+
+    def get_export(self, level: int = 0, **options: Any) -> IRSExport:
+        """
+        Colour the histogram of a level on the GPU, see `IRSExport`. Without `limits`
+        it shows zero to the maximum, or the top decades when `scale` is "log".
+        """
+        if options.get("limits") is None:
+            scale = options.get("scale", "linear")
+            options["limits"] = get_export_limits(self.get_statistics(level), scale)
+        return IRSExport(self._ctx, self.get_histogram(level), **options)
+
+    def export(
+        self, path: Path | str, thumbnail: int | None = None, alpha: bool = False, **options: Any
+    ):
+        """
+        Stream the histogram into a PNG, see `get_export()` for the options.
+        """
+        export_png(self.get_export, path, thumbnail=thumbnail, alpha=alpha, **options)
+
+    def capture(self, level: int = 0) -> Image.Image:
+        export = self.get_export(level)
+        pixels = export.read()[:, :, :3]
+        export.release()
+        return Image.fromarray(np.ascontiguousarray(pixels))
+
+    def __str__(self) -> str:
+        return f"Inverse Ray Shooting Histogram<Rays:{self.ray_count**2}, Iterations:{self.iterations}, Size=({self.width},{self.height})>"
+
+
+class IRSPolygonMap:
+    """
+    The IRSPolygonMap (Inverse Ray Shooting Polygon Map) produces the same caustic maps
+    as the IRSHistogram using inverse polygon mapping. Rather than shooting each ray as a
+    point, the lens plane is split into a grid of cells with the rays at their corners.
+    Each cell is split into two triangles which are mapped onto the source plane and
+    rasterised with their flux spread evenly over their area. Triangles smaller than a
+    pixel are splatted as points, as they may not cover the centre of any pixel.
+
+    A cell carries the flux of one ray, so `read()` and `iterations` mean the same as they
+    do for an IRSHistogram with the same ray count, and the two can be used interchangeably
+    by the IRSCriticalMap and IRSCausticMap. Because the flux fills the source plane rather
+    than landing at points, a single iteration is already smooth. Further iterations shift
+    the grid along the R2 sequence, averaging away the error of the mapping being linear
+    within each cell.
+
+    The "interpolated" and "direct" modes work as they do for the IRSHistogram.
+    """
+
+    def __init__(
+        self,
+        count: int,
+        size: tuple[int, int],
+        deflection_map: IRSDeflectionMap,
+        *,
+        viewport: tuple[float, float] = (2.0, 2.0),
+        centre: tuple[float, float] = (0.0, 0.0),
+        mode: str = "interpolated",
+        lazy: bool = False,
+        iterations: int = 0,
+        data: Buffer | None = None,
+    ) -> None:
+        if mode not in ("interpolated", "direct"):
+            logger.error(f"Unknown polygon mode {mode}. Expected one of ('interpolated', 'direct')")
+            raise ValueError(
+                f"Unknown polygon mode {mode}. Expected one of ('interpolated', 'direct')"
+            )
+
+        self._size: tuple[int, int] = size
+        self._viewport: tuple[float, float] = viewport
+        self._centre: tuple[float, float] = centre
+        self._ray_count: int = count
+        self._mode: str = mode
+        self._iterations: int = iterations
+
+        self._ctx: ArcadeContext
+
+        self._deflection_map: IRSDeflectionMap = deflection_map
+        self._histogram: gl.Texture2D
+        self._render_frame: gl.Framebuffer
+        self._render_geometry: gl.Geometry
+        self._triangle_program: gl.Program
+        self._point_program: gl.Program
+
+        self._initialised: bool = False
+        if not lazy or data is not None:
+            self.initialise(data=data)
+
+    def initialise(self, /, force: bool = False, data: Buffer | None = None):
+        if self._initialised and not force:
+            return
+
+        self._ctx = ctx = self._deflection_map.ctx
+        self._histogram = ctx.texture(self._size, components=1, dtype="f4", data=data)
+        self._render_frame = ctx.framebuffer(color_attachments=self._histogram)
+
+        resources = get_resources(ctx)
+        self._render_geometry = resources.get_point_geometry()
+        defines = {"MODE": IRS_RAY_MODES[self._mode], **self._deflection_map.defines}
+        self._triangle_program = resources.load_program(
+            vertex_shader="IRS_polygon_vs",
+            fragment_shader="IRS_polygon_fs",
+            defines={"POINTS": 0, **defines},
+        )
+        self._point_program = resources.load_program(
+            vertex_shader="IRS_polygon_vs",
+            fragment_shader="IRS_polygon_fs",
+            defines={"POINTS": 1, **defines},
+        )
+
+        self._initialised = True
+
+    @property
+    def histogram(self) -> gl.Texture2D:
+        return self._histogram
+
+    @property
+    def ray_count(self) -> int:
+        return self._ray_count
+
+    @property
+    def width(self) -> int:
+        return self._size[0]
+
+    @property
+    def height(self) -> int:
+        return self._size[1]
+
+    @property
+    def viewport_x(self) -> float:
+        return self._viewport[0]
+
+    @property
+    def viewport_y(self) -> float:
+        return self._viewport[1]
+
+    @property
+    def centre(self) -> tuple[float, float]:
+        return self._centre
+
+    @property
+    def iterations(self) -> int:
+        return self._iterations
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    @property
+    def deflection_map(self) -> IRSDeflectionMap:
+        return self._deflection_map
+
+    @property
+    def system(self) -> System:
+        return self._deflection_map.system
+
+    def clear(self):
+        self._iterations = 0
+        self.flush()
+
+    def _render_polygons(self):
+        count = self._ray_count
+        # The first iteration is aligned with the deflection map, the rest are
+        # shifted within a cell by the R2 sequence
+        o_x, o_y = get_r2_offset(self._iterations)
+        deflection = self._deflection_map
+        for program, vertices in (
+            (self._triangle_program, 6 * count * count),
+            (self._point_program, 2 * count * count),
+        ):
+            # The programs are shared so every uniform is set per pass
+            if self._mode == "direct":
+                deflection.lens_block.bind_to_storage_buffer()
+                program["extent"] = deflection.viewport_x, deflection.viewport_y
+            else:
+                deflection.use(0, program)
+            program["count"] = count
+            program["offset"] = o_x - 0.5, o_y - 0.5
+            program["centre"] = self._centre
+            program["scale"] = 1.0 / self._viewport[0], 1.0 / self._viewport[1]
+            program["resolution"] = self._size
+            self._render_geometry.render(
+                program,
+                mode=gl.POINTS if program is self._point_program else gl.TRIANGLES,
+                vertices=vertices,
+            )
+
+    def step(self):
+        self.generate(1)
+
+    def generate(self, iterations: int = 1, flush: bool = False):
+        self.initialise()
+        if flush:
+            self.flush()
+
+        # Additive blending sums the flux of every polygon that covers a pixel
+        self._ctx.blend_func = gl.BLEND_ADDITIVE
+        self._ctx.enable(gl.BLEND)
+        self._ctx.point_size = 1
+
+        with self._render_frame.activate():
+            for _ in range(iterations):
+                self._render_polygons()
+                self._iterations += 1
+
         self._ctx.disable(gl.BLEND)
-        logger.debug(f"IRSHistogram finished generation. [Total Iterations = {self._iterations}]")
+        logger.debug(f"IRSPolygonMap finished generation. [Total Iterations = {self.iterations}]")
 
     def flush(self):
-        self._ray_frame.clear()
+        self._render_frame.clear()
+
+    def release(self):
+        if not self._initialised:
+            return
+        self._render_frame.delete()
+        self._histogram.delete()
+        self._initialised = False
+
+    def get_statistics(self) -> IRSStatistics:
+        return get_reducer(self._ctx).reduce(self._histogram)
+
+    def get_magnification_distribution(
+        self, bins: int = 64, range: tuple[float, float] = (-1.0, 3.0)
+    ) -> tuple[np.ndarray, np.ndarray]:
+        return get_reducer(self._ctx).bin_log(
+            self._histogram, bins, range, 1.0 / get_rays_per_pixel(self)
+        )
 
     def read(self, normalised: bool = False) -> np.ndarray:
         data = self._histogram.read()
@@ -352,11 +1632,28 @@ class IRSHistogram:
         cap = 1.0 if not normalised else np.max(array)
         return array / cap
 
+    def get_export(self, **options: Any) -> IRSExport:
+        """
+        Colour the histogram on the GPU, see `IRSHistogram.get_export()`.
+        """
+        if options.get("limits") is None:
+            scale = options.get("scale", "linear")
+            options["limits"] = get_export_limits(self.get_statistics(), scale)
+        return IRSExport(self._ctx, self._histogram, **options)
+
+    def export(
+        self, path: Path | str, thumbnail: int | None = None, alpha: bool = False, **options: Any
+    ):
+        export_png(self.get_export, path, thumbnail=thumbnail, alpha=alpha, **options)
+
     def capture(self) -> Image.Image:
-        return Image.fromarray((self.read(True) * 255.0).astype(np.uint8), "L").convert("RGB")
+        export = self.get_export()
+        pixels = export.read()[:, :, :3]
+        export.release()
+        return Image.fromarray(np.ascontiguousarray(pixels))
 
     def __str__(self) -> str:
-        return f"Inverse Ray Shooting Histogram<Rays:{self.ray_count**2}, Iterations:{self._iterations}, Size=({self.width},{self.height})>"
+        return f"Inverse Ray Shooting Polygon Map<Cells:{self.ray_count**2}, Iterations:{self.iterations}, Size=({self.width},{self.height})>"
 
 
 class IRSCriticalMap:
@@ -364,10 +1661,21 @@ class IRSCriticalMap:
     The IRSCritical (Inverse Ray Shooting Critical [Curve] Map) produces a critical
     curve map from the IRSHistogram for a specific system. It first generates a histogram
     for the caustic curve, and then resamples that to create the critical curve map.
+
+    The lens plane is mapped onto the caustic map using the same modes as the
+    IRSHistogram, by default matching the mode of the given histogram.
     """
 
-    def __init__(self, histogram: IRSHistogram, lazy: bool = False) -> None:
+    def __init__(
+        self, histogram: IRSHistogram, lazy: bool = False, mode: str | None = None
+    ) -> None:
+        mode = histogram.mode if mode is None else mode
+        if mode not in IRS_RAY_MODES:
+            logger.error(f"Unknown ray mode {mode}. Expected one of {tuple(IRS_RAY_MODES)}")
+            raise ValueError(f"Unknown ray mode {mode}. Expected one of {tuple(IRS_RAY_MODES)}")
+
         self._histogram: IRSHistogram = histogram
+        self._mode: str = mode
 
         self._critical_map: gl.Texture2D
         self._render_frame: gl.Framebuffer
@@ -382,20 +1690,20 @@ class IRSCriticalMap:
         if self._initialised and not force:
             return
 
-        ctx = get_window().ctx
+        ctx = self._histogram.deflection_map.ctx
 
         self._critical_map = ctx.texture(
             (self._histogram.width, self._histogram.height), components=1, dtype="f4"
         )
 
         self._render_frame = ctx.framebuffer(color_attachments=self._critical_map)
-        self._render_geometry = get_fullscreen_geometry(ctx)
-        self._render_program = ctx.load_program(
-            vertex_shader=get_glsl("UTIL_unprojected_uv_vs"),
-            fragment_shader=get_glsl("IRS_critical_fs"),
+        resources = get_resources(ctx)
+        self._render_geometry = resources.get_fullscreen_geometry()
+        self._render_program = resources.load_program(
+            vertex_shader="UTIL_unprojected_uv_vs",
+            fragment_shader="IRS_critical_fs",
+            defines={"MODE": IRS_RAY_MODES[self._mode], **self._histogram.deflection_map.defines},
         )
-        self._render_program["deflectionMap"] = 0
-        self._render_program["causticMap"] = 1
 
         self._initialised = True
 
@@ -403,15 +1711,43 @@ class IRSCriticalMap:
     def critical_map(self) -> gl.Texture2D:
         return self._critical_map
 
+    @property
+    def mode(self) -> str:
+        return self._mode
+
     def generate(self):
         self._initialise()
+
+        # The program is shared between critical maps so every uniform is set per render
+        histogram = self._histogram
+        deflection = histogram.deflection_map
+        # The deflection map sampler is optimised out in direct mode
+        self._render_program.set_uniform_safe("deflectionMap", 0)
+        self._render_program["causticMap"] = 1
+        self._render_program["viewport"] = histogram.viewport_x, histogram.viewport_y
+        self._render_program["centre"] = histogram.centre
+        if self._mode != "direct":
+            self._render_program["extent"] = deflection.viewport_x, deflection.viewport_y
+
         with self._render_frame.activate() as fbo:
             fbo.clear()
-            # TODO: handle non-deflection map mode
-            self._histogram._deflection_map.deflection_map.use(0)
+            if self._mode == "direct":
+                self._histogram.deflection_map.lens_block.bind_to_storage_buffer()
+            else:
+                self._histogram.deflection_map.use(0, self._render_program)
             self._histogram.histogram.use(1)
             self._render_geometry.render(self._render_program)
 
+    def release(self):
+        if not self._initialised:
+            return
+        self._render_frame.delete()
+        self._critical_map.delete()
+        self._initialised = False
+
+    def get_statistics(self) -> IRSStatistics:
+        return get_reducer(self._histogram.deflection_map.ctx).reduce(self._critical_map)
+
     def read(self) -> np.ndarray:
         data = self._critical_map.read()
         w, h = self._critical_map.size
@@ -419,8 +1755,454 @@ class IRSCriticalMap:
         cap = np.max(array)
         return array / cap
 
+    def get_export(self, **options: Any) -> IRSExport:
+        """
+        Colour the critical map on the GPU, see `IRSHistogram.get_export()`.
+        """
+        if options.get("limits") is None:
+            scale = options.get("scale", "linear")
+            options["limits"] = get_export_limits(self.get_statistics(), scale)
+        return IRSExport(self._histogram.deflection_map.ctx, self._critical_map, **options)
+
+    def export(
+        self, path: Path | str, thumbnail: int | None = None, alpha: bool = False, **options: Any
+    ):
+        export_png(self.get_export, path, thumbnail=thumbnail, alpha=alpha, **options)
+
     def capture(self) -> Image.Image:
-        return Image.fromarray((self.read() * 255.0).astype(np.uint8), "L").convert("RGB")
+        export = self.get_export()
+        pixels = export.read()[:, :, :3]
+        export.release()
+        return Image.fromarray(np.ascontiguousarray(pixels))
+
+
+class IRSLensedImage:
+    """
+    The IRSLensedImage draws the lens plane view of an extended source, such as a
+    limb darkened star (see `create_source_image()`) or a galaxy. Each pixel looks up
+    its position in the source plane in the deflection map and samples the source
+    image there, so a frame costs one fetch per pixel rather than the billions of rays
+    of a histogram. Surface brightness is conserved, so no normalisation is needed.
+
+    The source image covers `source_size` (half size) around `source_centre` in the
+    source plane, and the view covers `viewport` (half size) around `centre` in the
+    lens plane. Both can be changed every frame before calling `generate()`.
+
+    Moving the lenses needs a new deflection map. `update_system()` regenerates it a
+    band of rows per `generate()` with `IRSDeflectionMap.regenerate()`, so dragging a
+    lens never stalls a frame. Until the new map is swapped in, systems of at most
+    `DIRECT_LENSES` lenses are drawn directly from the lens block so the view keeps up
+    with the drag, larger systems keep showing the previous map.
+    """
+
+    # The most lenses drawn directly while the deflection map is regenerated
+    DIRECT_LENSES: int = 64
+
+    def __init__(
+        self,
+        deflection_map: IRSDeflectionMap,
+        size: tuple[int, int],
+        source: gl.Texture2D | np.ndarray | Image.Image,
+        *,
+        source_centre: tuple[float, float] = (0.0, 0.0),
+        source_size: tuple[float, float] = (0.1, 0.1),
+        viewport: tuple[float, float] = (2.0, 2.0),
+        centre: tuple[float, float] = (0.0, 0.0),
+        mode: str = "interpolated",
+        background: tuple[float, float, float, float] = (0.0, 0.0, 0.0, 1.0),
+        band: int = 128,
+        lazy: bool = False,
+    ) -> None:
+        if mode not in IRS_RAY_MODES:
+            logger.error(f"Unknown ray mode {mode}. Expected one of {tuple(IRS_RAY_MODES)}")
+            raise ValueError(f"Unknown ray mode {mode}. Expected one of {tuple(IRS_RAY_MODES)}")
+
+        self._deflection_map: IRSDeflectionMap = deflection_map
+        self._size: tuple[int, int] = size
+        self._source: gl.Texture2D | np.ndarray | Image.Image = source
+        self.source_centre: tuple[float, float] = source_centre
+        self.source_size: tuple[float, float] = source_size
+        self.viewport: tuple[float, float] = viewport
+        self.centre: tuple[float, float] = centre
+        self.background: tuple[float, float, float, float] = background
+        self._mode: str = mode
+        self._band: int = band
+
+        self._regeneration: Generator[float, None, None] | None = None
+
+        self._ctx: ArcadeContext
+        self._image: gl.Texture2D
+        self._source_image: gl.Texture2D
+        self._owns_source: bool = False
+        self._render_frame: gl.Framebuffer
+        self._render_geometry: gl.Geometry
+
+        self._initialised: bool = False
+        if not lazy:
+            self.initialise()
+
+    def initialise(self, force: bool = False):
+        if self._initialised and not force:
+            return
+
+        self._ctx = ctx = self._deflection_map.ctx
+        self._image = ctx.texture(self._size, components=4, dtype="f1")
+        self._render_frame = ctx.framebuffer(color_attachments=self._image)
+        self._render_geometry = get_resources(ctx).get_fullscreen_geometry()
+        self._upload_source()
+
+        self._initialised = True
+
+    def _upload_source(self):
+        source = self._source
+        if isinstance(source, gl.Texture2D):
+            self._source_image = source
+            self._owns_source = False
+            return
+
+        pixels = np.asarray(source)
+        if pixels.dtype != np.uint8:
+            # Float images are brightnesses from 0.0 to 1.0
+            pixels = np.round(np.clip(pixels, 0.0, 1.0) * 255.0).astype(np.uint8)
+        if pixels.ndim == 2:
+            pixels = np.repeat(pixels[:, :, None], 3, axis=2)
+        if pixels.shape[2] == 3:
+            alpha = np.full(pixels.shape[:2] + (1,), 255, dtype=np.uint8)
+            pixels = np.concatenate((pixels, alpha), axis=2)
+        h, w, _ = pixels.shape
+        # Images have their top row first, textures their bottom row
+        self._source_image = self._ctx.texture(
+            (w, h),
+            components=4,
+            dtype="f1",
+            data=np.ascontiguousarray(pixels[::-1]).tobytes(),
+            wrap_x=gl.CLAMP_TO_EDGE,
+            wrap_y=gl.CLAMP_TO_EDGE,
+            filter=(gl.LINEAR, gl.LINEAR),
+        )
+        self._owns_source = True
+
+    @property
+    def image(self) -> gl.Texture2D:
+        return self._image
+
+    @property
+    def source(self) -> gl.Texture2D | np.ndarray | Image.Image:
+        return self._source
+
+    @source.setter
+    def source(self, source: gl.Texture2D | np.ndarray | Image.Image):
+        if self._initialised and self._owns_source:
+            self._source_image.delete()
+        self._source = source
+        if self._initialised:
+            self._upload_source()
+
+    @property
+    def deflection_map(self) -> IRSDeflectionMap:
+        return self._deflection_map
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    @property
+    def regenerating(self) -> bool:
+        return self._regeneration is not None
+
+    def update_system(self, system: System):
+        """
+        Move to a new system, regenerating the deflection map over the next frames.
+        """
+        self._deflection_map.update_system(system)
+        if self._regeneration is None:
+            # A regeneration in progress restarts itself when the system changes
+            self._regeneration = self._deflection_map.regenerate(self._band)
+
+    def _get_mode(self) -> str:
+        if self._regeneration is None:
+            return self._mode
+        # Step the regeneration one band, once it finishes the new map is used
+        if next(self._regeneration) >= 1.0:
+            self._regeneration.close()
+            self._regeneration = None
+            return self._mode
+        if len(self._deflection_map.system.lenses) <= self.DIRECT_LENSES:
+            return "direct"
+        return self._mode
+
+    def generate(self):
+        self.initialise()
+
+        mode = self._get_mode()
+        deflection = self._deflection_map
+        program = get_resources(self._ctx).load_program(
+            vertex_shader="UTIL_unprojected_uv_vs",
+            fragment_shader="IRS_image_fs",
+            defines={"MODE": IRS_RAY_MODES[mode], **deflection.defines},
+        )
+        # The program is shared between images so every uniform is set per render
+        program.set_uniform_safe("deflectionMap", 0)
+        program["sourceImage"] = 1
+        program["viewport"] = self.viewport
+        program["centre"] = self.centre
+        program.set_uniform_safe("extent", (deflection.viewport_x, deflection.viewport_y))
+        program["source_centre"] = self.source_centre
+        program["source_size"] = self.source_size
+        program.set_uniform_safe("background", self.background)
+
+        self._ctx.disable(gl.BLEND)
+        with self._render_frame.activate() as fbo:
+            fbo.clear()
+            if mode == "direct":
+                deflection.lens_block.bind_to_storage_buffer()
+            else:
+                deflection.use(0, program)
+            self._source_image.use(1)
+            self._render_geometry.render(program)
+
+    def release(self):
+        if not self._initialised:
+            return
+        if self._regeneration is not None:
+            self._regeneration.close()
+            self._regeneration = None
+        self._render_frame.delete()
+        self._image.delete()
+        if self._owns_source:
+            self._source_image.delete()
+        self._initialised = False
+
+    def read(self) -> np.ndarray:
+        """
+        Read the (height, width, 4) uint8 image with the top row first.
+        """
+        w, h = self._size
+        return np.frombuffer(self._image.read(), dtype=np.uint8).reshape((h, w, 4))[::-1]
+
+    def capture(self) -> Image.Image:
+        return Image.fromarray(np.ascontiguousarray(self.read()))
+
+
+def warmup_IRS_programs(ctx: ArcadeContext | None = None):
+    """
+    Compile every variant of the IRS programs up front so the first histogram or
+    critical map of each kind doesn't stall while its shaders compile.
+    """
+    resources = get_resources(ctx)
+    for storage, nested in product(IRS_DEFLECTION_STORAGE, (0, 1)):
+        residual = int(storage == "residual")
+        defines = {"RESIDUAL": residual, "NESTED": nested}
+        for jacobian in (0, 1):
+            for potential in (0, 1):
+                resources.load_program(
+                    vertex_shader="UTIL_unprojected_uv_vs",
+                    fragment_shader="IRS_deflection_map_fs",
+                    defines={"RESIDUAL": residual, "JACOBIAN": jacobian, "POTENTIAL": potential},
+                )
+        for roi in (0, 1):
+            for deposit in IRS_DEPOSITION_MODES.values():
+                ray_defines = {"ROI": roi, "DEPOSIT": deposit, **defines}
+                resources.load_program(
+                    vertex_shader="IRS_histogram_texel_vs",
+                    fragment_shader="IRS_histogram_fs",
+                    defines=ray_defines,
+                )
+                for jitter in IRS_JITTER_MODES.values():
+                    for mode in (IRS_RAY_MODES["interpolated"], IRS_RAY_MODES["direct"]):
+                        resources.load_program(
+                            vertex_shader="IRS_histogram_vs",
+                            fragment_shader="IRS_histogram_fs",
+                            defines={"JITTER": jitter, "MODE": mode, **ray_defines},
+                        )
+        resources.load_program(
+            vertex_shader="UTIL_unprojected_uv_vs",
+            fragment_shader="IRS_export_fs",
+            defines={"CHANNELS": 1, "SCALE": 0, **defines},
+        )
+        for mode in IRS_RAY_MODES.values():
+            resources.load_program(
+                vertex_shader="UTIL_unprojected_uv_vs",
+                fragment_shader="IRS_critical_fs",
+                defines={"MODE": mode, **defines},
+            )
+        for mode in IRS_RAY_MODES.values():
+            resources.load_program(
+                vertex_shader="UTIL_unprojected_uv_vs",
+                fragment_shader="IRS_image_fs",
+                defines={"MODE": mode, **defines},
+            )
+        for points in (0, 1):
+            for mode in (IRS_RAY_MODES["interpolated"], IRS_RAY_MODES["direct"]):
+                resources.load_program(
+                    vertex_shader="IRS_polygon_vs",
+                    fragment_shader="IRS_polygon_fs",
+                    defines={"POINTS": points, "MODE": mode, **defines},
+                )
+    resources.load_program(
+        vertex_shader="UTIL_unprojected_uv_vs", fragment_shader="IRS_histogram_pyramid_fs"
+    )
+    resources.load_program(
+        vertex_shader="UTIL_unprojected_uv_vs", fragment_shader="IRS_magnification_fs"
+    )
+    resources.load_program(
+        vertex_shader="UTIL_unprojected_uv_vs", fragment_shader="IRS_reduce_fs"
+    )
+    resources.load_program(vertex_shader="IRS_reduce_bins_vs", fragment_shader="IRS_reduce_bins_fs")
+    for scale in IRS_EXPORT_SCALES.values():
+        resources.load_program(
+            vertex_shader="UTIL_unprojected_uv_vs",
+            fragment_shader="IRS_export_fs",
+            defines={"CHANNELS": 0, "SCALE": scale},
+        )
+    logger.info(f"Warmed up {resources.program_count} IRS programs")
+
+
+def get_contour_segments(
+    values: np.ndarray, x: np.ndarray, y: np.ndarray, level: float = 0.0
+) -> np.ndarray:
+    """
+    Marching squares. Find where the values (sampled at y[row], x[column]) cross the
+    level as (N, 2, 2) line segments. Saddle cells are split by the average of their
+    corners. Cells with a NaN or infinite corner are skipped.
+    """
+    # The corners of each cell, counter-clockwise from (row, column)
+    corners = (
+        values[:-1, :-1],
+        values[:-1, 1:],
+        values[1:, 1:],
+        values[1:, :-1],
+    )
+    c_x = (x[:-1][None, :], x[1:][None, :], x[1:][None, :], x[:-1][None, :])
+    c_y = (y[:-1][:, None], y[:-1][:, None], y[1:][:, None], y[1:][:, None])
+    shape = corners[0].shape
+
+    finite = np.all([np.isfinite(corner) for corner in corners], axis=0)
+    above = [corner > level for corner in corners]
+
+    # Where each edge (from corner i to corner i + 1) crosses the level
+    crossings = []
+    crossed = []
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for edge in range(4):
+            start, end = edge, (edge + 1) % 4
+            t = (level - corners[start]) / (corners[end] - corners[start])
+            point = np.stack(
+                (
+                    np.broadcast_to(c_x[start] + t * (c_x[end] - c_x[start]), shape),
+                    np.broadcast_to(c_y[start] + t * (c_y[end] - c_y[start]), shape),
+                ),
+                axis=-1,
+            )
+            crossings.append(point)
+            crossed.append((above[start] != above[end]) & finite)
+    count = np.sum(crossed, axis=0)
+
+    segments = []
+    # Cells crossed on two edges have a single segment between them
+    single = count == 2
+    order = np.argsort(~np.stack(crossed, axis=-1), axis=-1, kind="stable")[single]
+    points = np.stack(crossings, axis=-2)[single]
+    rows = np.arange(len(points))
+    segments.append(np.stack((points[rows, order[:, 0]], points[rows, order[:, 1]]), axis=1))
+
+    # Saddles are crossed on all four edges. Edges i - 1 and i are either side of
+    # corner i. If the centre is on the same side as corners 0 and 2 they are joined
+    # through it, and corners 1 and 3 are cut off. Otherwise corners 0 and 2 are.
+    saddle = count == 4
+    centre = np.mean([corner[saddle] for corner in corners], axis=0) > level
+    joined = (centre == above[0][saddle])[:, None]
+    e0, e1, e2, e3 = (crossing[saddle] for crossing in crossings)
+    segments.append(np.stack((np.where(joined, e0, e3), np.where(joined, e1, e0)), axis=1))
+    segments.append(np.stack((np.where(joined, e2, e1), np.where(joined, e3, e2)), axis=1))
+
+    return np.concatenate(segments, axis=0)
+
+
+def get_lens_equation_bounds(
+    system: System, x_edges: np.ndarray, y_edges: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Bound where the lens equation maps each cell of the grid between the edges (in
+    Einstein radii) of the lens plane. Returns the (Y, X, 2) low and high bounds of
+    the source plane positions, and the (Y, X) bound of the Jacobian's norm.
+
+    The lens equation is evaluated at the corners of each cell, and every point of a
+    cell is within half its diagonal of a corner. The norm of the Jacobian is at most
+    one plus the sum of each lens's mass fraction over its squared distance to the
+    cell, so the bounds are grown by that times half the diagonal. A cell touching a
+    lens is unbounded. The cost scales with the cells and the number of lenses.
+    """
+    corners = np.stack(np.meshgrid(x_edges, y_edges), axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        targets = apply_lens_equation(system, corners.reshape((-1, 2))).reshape(corners.shape)
+    cells = (targets[:-1, :-1], targets[:-1, 1:], targets[1:, :-1], targets[1:, 1:])
+    low = np.fmin(np.fmin(cells[0], cells[1]), np.fmin(cells[2], cells[3]))
+    high = np.fmax(np.fmax(cells[0], cells[1]), np.fmax(cells[2], cells[3]))
+
+    x_centres, x_half = 0.5 * (x_edges[:-1] + x_edges[1:]), 0.5 * np.diff(x_edges)
+    y_centres, y_half = 0.5 * (y_edges[:-1] + y_edges[1:]), 0.5 * np.diff(y_edges)
+    lipschitz = np.ones((len(y_centres), len(x_centres)))
+    with np.errstate(divide="ignore"):
+        for (l_x, l_y), fraction in zip(system.get_packed_positions(), system.get_mass_fractions()):
+            # The distance from the lens to the nearest point of each cell
+            x_near = np.maximum(np.abs(x_centres - l_x) - x_half, 0.0)
+            y_near = np.maximum(np.abs(y_centres - l_y) - y_half, 0.0)
+            lipschitz += fraction / (x_near[None, :] ** 2 + y_near[:, None] ** 2)
+
+    margin = (lipschitz * np.hypot(x_half[None, :], y_half[:, None]))[..., None]
+    with np.errstate(invalid="ignore"):
+        low = np.where(np.isfinite(margin) & np.isfinite(low), low - margin, -np.inf)
+        high = np.where(np.isfinite(margin) & np.isfinite(high), high + margin, np.inf)
+    return low, high, lipschitz
+
+
+def deposit_rays(
+    rays: np.ndarray,
+    size: tuple[int, int],
+    viewport: tuple[float, float] = (2.0, 2.0),
+    centre: tuple[float, float] = (0.0, 0.0),
+    deposition: str = "point",
+) -> np.ndarray:
+    """
+    Count source plane positions (N, 2) into a histogram on the CPU the same way as
+    an IRSHistogram, such as rays deflected by `analytical.apply_lens_equation`.
+    The result has the same orientation as `IRSHistogram.read()`.
+    """
+    if deposition not in IRS_DEPOSITION_MODES:
+        logger.error(
+            f"Unknown deposition mode {deposition}. Expected one of {tuple(IRS_DEPOSITION_MODES)}"
+        )
+        raise ValueError(
+            f"Unknown deposition mode {deposition}. Expected one of {tuple(IRS_DEPOSITION_MODES)}"
+        )
+    w, h = size
+    # The position of each ray in pixels
+    p_x = ((rays[:, 0] - centre[0]) / viewport[0] * 0.5 + 0.5) * w
+    p_y = ((rays[:, 1] - centre[1]) / viewport[1] * 0.5 + 0.5) * h
+
+    if deposition == "point":
+        corners = ((np.floor(p_x), np.floor(p_y), None),)
+    else:
+        # Measure from the pixel centres so the ray is split between the four around it
+        f_x, f_y = p_x - 0.5, p_y - 0.5
+        x0, y0 = np.floor(f_x), np.floor(f_y)
+        t_x, t_y = f_x - x0, f_y - y0
+        corners = (
+            (x0, y0, (1.0 - t_x) * (1.0 - t_y)),
+            (x0 + 1, y0, t_x * (1.0 - t_y)),
+            (x0, y0 + 1, (1.0 - t_x) * t_y),
+            (x0 + 1, y0 + 1, t_x * t_y),
+        )
+
+    histogram = np.zeros(w * h, dtype=np.float64)
+    for x, y, weight in corners:
+        inside = (0 <= x) & (x < w) & (0 <= y) & (y < h)
+        index = (y[inside] * w + x[inside]).astype(np.int64)
+        weights = None if weight is None else weight[inside]
+        histogram += np.bincount(index, weights=weights, minlength=w * h)
+
+    return histogram.reshape((h, w))[::-1, :].astype(np.float32)
 
 
 def create_caustic_map(histogram: IRSHistogram, source_radius: float) -> np.ndarray:
@@ -515,6 +2297,10 @@ class IRSCausticMap:
 
         self._caustic: np.ndarray = np.zeros((histogram.height, histogram.width))
 
+    @property
+    def histogram(self) -> IRSHistogram:
+        return self._histogram
+
     @property
     def caustic(self) -> np.ndarray:
         return self._caustic
@@ -582,3 +2368,296 @@ class IRSCausticMap:
         logger.info("finished convolution in %s seconds", time() - conv_start)
 
         return self._caustic
+
+
+def get_source_pixels(
+    histogram: IRSHistogram | IRSPolygonMap, source_radius: float
+) -> tuple[float, float]:
+    """
+    The radius of a source in Solar Radii in pixels of the histogram along each axis.
+    """
+    system = histogram.system
+    source_radius = source_radius * Sr_to_au
+    # pixel resolution is in units per pixel
+    pixel_resolution = (
+        2 * histogram.viewport_x * system.source_radius / histogram.width,
+        2 * histogram.viewport_y * system.source_radius / histogram.height,
+    )
+    return source_radius / pixel_resolution[0], source_radius / pixel_resolution[1]
+
+
+def get_rays_per_pixel(
+    histogram: IRSHistogram | IRSPolygonMap, iterations: int | None = None
+) -> float:
+    """
+    How many rays land in each pixel of the histogram without any lenses, after the
+    given iterations or by default the iterations the histogram has been generated for.
+    """
+    iterations = histogram.iterations if iterations is None else iterations
+    deflection = histogram.deflection_map
+    x_overlap = histogram.ray_count * histogram.viewport_x / deflection.viewport_x
+    y_overlap = histogram.ray_count * histogram.viewport_y / deflection.viewport_y
+    return iterations * x_overlap * y_overlap / (histogram.width * histogram.height)
+
+
+def _get_fft_size(size: int) -> int:
+    # The smallest size at least as large made of the factors 2, 3 and 5, which FFTs handle quickly
+    best = 1 << max(size - 1, 0).bit_length()
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p235 = p35
+            while p235 < size:
+                p235 *= 2
+            best = min(best, p235)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+class IRSSourceMaps:
+    """
+    The IRSSourceMaps (Inverse Ray Shooting Source Maps) compute the magnification map
+    of a histogram for many source profiles at once, such as several radii and limb
+    darkening laws when fitting a finite source event.
+
+    The convolution is done with FFTs. The spectrum of the histogram is computed once
+    and cached, so each profile only costs a kernel transform, a multiply and an
+    inverse transform. The histogram is padded by the largest source so the maps don't
+    wrap around. Each map is computed lazily when indexed and then cached, or all of
+    them can be stacked with `generate()`. Call `clear()` after the histogram changes.
+    """
+
+    def __init__(
+        self, histogram: IRSHistogram | IRSPolygonMap, profiles: Iterable[SourceProfile]
+    ) -> None:
+        self._histogram: IRSHistogram | IRSPolygonMap = histogram
+        self._profiles: tuple[SourceProfile, ...] = tuple(profiles)
+
+        # Pad by the largest source so the convolution doesn't wrap around
+        radii = [get_source_pixels(histogram, profile.radius) for profile in self._profiles]
+        pad_x = max((int(np.floor(r_x)) for r_x, _ in radii), default=0)
+        pad_y = max((int(np.floor(r_y)) for _, r_y in radii), default=0)
+        self._shape: tuple[int, int] = (
+            _get_fft_size(histogram.height + pad_y),
+            _get_fft_size(histogram.width + pad_x),
+        )
+
+        self._spectrum: np.ndarray | None = None
+        self._maps: dict[int, np.ndarray] = {}
+
+    @property
+    def profiles(self) -> tuple[SourceProfile, ...]:
+        return self._profiles
+
+    @property
+    def histogram(self) -> IRSHistogram | IRSPolygonMap:
+        return self._histogram
+
+    @property
+    def spectrum(self) -> np.ndarray:
+        if self._spectrum is None:
+            start = time()
+            # Normalise once here so every map is in magnification
+            data = self._histogram.read() / get_rays_per_pixel(self._histogram)
+            self._spectrum = np.fft.rfft2(data, s=self._shape)
+            logger.debug(f"IRSSourceMaps histogram spectrum took {time() - start} seconds")
+        return self._spectrum
+
+    def clear(self):
+        self._spectrum = None
+        self._maps = {}
+
+    def get_map(self, index: int) -> np.ndarray:
+        if index in self._maps:
+            return self._maps[index]
+
+        profile = self._profiles[index]
+        kernel = create_source_kernel(profile, get_source_pixels(self._histogram, profile.radius))
+        k_h, k_w = kernel.shape
+        # Centre the kernel on the origin, wrapping the negative offsets to the far edges
+        padded = np.zeros(self._shape)
+        padded[:k_h, :k_w] = kernel
+        padded = np.roll(padded, (-(k_h // 2), -(k_w // 2)), axis=(0, 1))
+
+        result = np.fft.irfft2(self.spectrum * np.fft.rfft2(padded), s=self._shape)
+        w, h = self._histogram.width, self._histogram.height
+        self._maps[index] = result[:h, :w].astype(np.float32)
+        return self._maps[index]
+
+    def generate(self) -> np.ndarray:
+        """
+        The maps of every profile stacked into one (profiles, height, width) array.
+        """
+        return np.stack([self.get_map(index) for index in range(len(self._profiles))])
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.get_map(index)
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+
+class IRSMagnificationMap:
+    """
+    The IRSMagnificationMap (Inverse Ray Shooting Magnification Map) computes the same
+    finite source magnification as the IRSCausticMap on the GPU. The histogram never
+    leaves the GPU. Each pixel sums the histogram within the source disk and divides by
+    the rays that would land in the disk without lenses, so the result is magnification.
+
+    Large sources are split into tiles of the kernel which are added together in
+    separate passes, so no single draw sums too many pixels. Pixels within a source
+    radius of the edge only sum the part of the disk inside the histogram.
+
+    The map can be displayed straight from `magnification_map`, read whole or read
+    in bands of rows with `read_rows()`. Changing `source_radius` and calling
+    `generate()` again only redraws the map.
+    """
+
+    # Kernel offsets along each axis summed in one pass
+    KERNEL_TILE: int = 32
+
+    def __init__(
+        self, histogram: IRSHistogram | IRSPolygonMap, source_radius: float, lazy: bool = False
+    ) -> None:
+        self._histogram: IRSHistogram | IRSPolygonMap = histogram
+        self._source_radius: float = source_radius  # radius of source star in Solar Radii
+
+        self._ctx: ArcadeContext
+        self._magnification_map: gl.Texture2D
+        self._render_frame: gl.Framebuffer
+        self._render_geometry: gl.Geometry
+        self._render_program: gl.Program
+
+        self._initialised: bool = False
+        if not lazy:
+            self.initialise()
+
+    def initialise(self, force: bool = False):
+        if self._initialised and not force:
+            return
+
+        self._ctx = ctx = self._histogram.deflection_map.ctx
+        self._magnification_map = ctx.texture(
+            (self._histogram.width, self._histogram.height), components=1, dtype="f4"
+        )
+        self._render_frame = ctx.framebuffer(color_attachments=self._magnification_map)
+
+        resources = get_resources(ctx)
+        self._render_geometry = resources.get_fullscreen_geometry()
+        self._render_program = resources.load_program(
+            vertex_shader="UTIL_unprojected_uv_vs", fragment_shader="IRS_magnification_fs"
+        )
+
+        self._initialised = True
+
+    @property
+    def magnification_map(self) -> gl.Texture2D:
+        return self._magnification_map
+
+    @property
+    def histogram(self) -> IRSHistogram | IRSPolygonMap:
+        return self._histogram
+
+    @property
+    def source_radius(self) -> float:
+        return self._source_radius
+
+    @source_radius.setter
+    def source_radius(self, source_radius: float):
+        self._source_radius = source_radius
+
+    def generate(self):
+        self.initialise()
+        r_x, r_y = get_source_pixels(self._histogram, self._source_radius)
+        # A source smaller than a pixel still covers the pixel it is centred on
+        r_x, r_y = max(r_x, 1e-6), max(r_y, 1e-6)
+        e_x, e_y = int(np.floor(r_x)), int(np.floor(r_y))
+
+        offset_x = np.arange(-e_x, e_x + 1)
+        offset_y = np.arange(-e_y, e_y + 1)
+        # The same half width of the disk along each row as the shader
+        span = np.floor(r_x * np.sqrt(np.maximum(1.0 - (offset_y / r_y) ** 2, 0.0)))
+        inside = np.abs(offset_x[None, :]) <= span[:, None]
+        normalisation = 1.0 / (get_rays_per_pixel(self._histogram) * np.count_nonzero(inside))
+
+        program = self._render_program
+        program["histogram"] = 0
+        program["radius"] = r_x, r_y
+        program["normalisation"] = normalisation
+
+        self._ctx.blend_func = gl.BLEND_ADDITIVE
+        self._ctx.enable(gl.BLEND)
+        with self._render_frame.activate() as fbo:
+            fbo.clear()
+            self._histogram.histogram.use(0)
+            tile = self.KERNEL_TILE
+            passes = 0
+            for s_y in range(-e_y, e_y + 1, tile):
+                for s_x in range(-e_x, e_x + 1, tile):
+                    end_x, end_y = min(s_x + tile, e_x + 1), min(s_y + tile, e_y + 1)
+                    # Skip the corner tiles that miss the disk entirely
+                    if not inside[s_y + e_y : end_y + e_y, s_x + e_x : end_x + e_x].any():
+                        continue
+                    program["kernel_start"] = s_x, s_y
+                    program["kernel_end"] = end_x, end_y
+                    self._render_geometry.render(program)
+                    passes += 1
+        self._ctx.disable(gl.BLEND)
+        logger.debug(f"IRSMagnificationMap convolved in {passes} passes")
+
+    def get_statistics(self) -> IRSStatistics:
+        """
+        The maximum, minimum, sum and sum of squares of the magnification map, reduced
+        on the GPU. The mean magnification is `get_statistics().get_mean()`.
+        """
+        return get_reducer(self._ctx).reduce(self._magnification_map)
+
+    def get_magnification_distribution(
+        self, bins: int = 64, range: tuple[float, float] = (-1.0, 3.0)
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The number of pixels in `bins` bins of log10 magnification, binned on the GPU.
+        Returns the counts and the bin edges like `np.histogram`.
+        """
+        return get_reducer(self._ctx).bin_log(self._magnification_map, bins, range)
+
+    def read(self) -> np.ndarray:
+        data = self._magnification_map.read()
+        w, h = self._magnification_map.size
+        return np.frombuffer(data, dtype=np.float32, count=w * h).reshape((h, w))[::-1, :]
+
+    def read_rows(self, band: int = 256) -> Generator[tuple[int, np.ndarray], None, None]:
+        """
+        Read the map in bands of rows from the top, yielding the first row of each band
+        and the band, so a large map never has to be copied to the CPU at once.
+        The rows are in the same order as `read()`.
+        """
+        w, h = self._magnification_map.size
+        for start in range(0, h, band):
+            rows = min(band, h - start)
+            data = self._render_frame.read(
+                viewport=(0, h - start - rows, w, rows), components=1, dtype="f4"
+            )
+            yield start, np.frombuffer(data, dtype=np.float32).reshape((rows, w))[::-1, :]
+
+    def get_export(self, **options: Any) -> IRSExport:
+        """
+        Colour the magnification map on the GPU, see `IRSHistogram.get_export()`.
+        """
+        if options.get("limits") is None:
+            scale = options.get("scale", "linear")
+            options["limits"] = get_export_limits(self.get_statistics(), scale)
+        return IRSExport(self._ctx, self._magnification_map, **options)
+
+    def export(
+        self, path: Path | str, thumbnail: int | None = None, alpha: bool = False, **options: Any
+    ):
+        export_png(self.get_export, path, thumbnail=thumbnail, alpha=alpha, **options)
+
+    def capture(self) -> Image.Image:
+        export = self.get_export()
+        pixels = export.read()[:, :, :3]
+        export.release()
+        return Image.fromarray(np.ascontiguousarray(pixels))
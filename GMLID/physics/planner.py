@@ -0,0 +1,392 @@
+"""
+Choosing the ray count, sizes, and iterations of an IRSHistogram for an error target.
+
+The relative magnification error of a histogram is modelled as the noise of the
+rays and the bias of interpolating the deflection map, added in quadrature.
+
+    noise = noise_scale * R ** -noise_power
+    bias = bias_scale * h ** bias_power
+
+R is the number of rays each pixel would get without any lenses, and h is the
+spacing of the deflection map's texels in Einstein radii. Both are calibrated on a
+single lens, where `one_lens_amplificiation` gives the exact magnification, along
+with how long each pass and each deflection map texel takes on the device. The
+interpolation error partly averages out over iterations, so the bias is an upper bound. Calibrations are cached per device,
+and can be saved to a toml file so each machine only calibrates once.
+"""
+
+from pathlib import Path
+from time import perf_counter
+from tomllib import load as load_toml
+from typing import NamedTuple
+
+import numpy as np
+from arcade import get_window, ArcadeContext
+from tomli_w import dump as dump_toml
+
+from GMLID.logging import get_logger
+
+from .system import Lens, System
+from .analytical import one_lens_amplificiation
+from .numerical import (
+    IRS_JITTER_MODES,
+    IRSDeflectionMap,
+    IRSHistogram,
+    get_rays_per_pixel,
+)
+
+logger = get_logger("physics.planner")
+
+# The bytes of each histogram pixel and each f4 deflection map texel
+IRS_HISTOGRAM_BYTES: int = 4
+IRS_DEFLECTION_BYTES: int = 8
+
+# The sizes the planner chooses between
+IRS_PLAN_RAY_COUNTS: tuple[int, ...] = tuple(2**i for i in range(8, 15))
+IRS_PLAN_DEFLECTION_SIZES: tuple[int, ...] = tuple(2**i for i in range(8, 15))
+# The most iterations the planner chooses
+IRS_PLAN_MAX_ITERATIONS: int = 2**16
+
+# The calibration histogram, and the separations from the lens where its pixels are
+# compared. Closer in the pixels average over the diverging magnification, and
+# further out their images are beyond the edge of the deflection map.
+_CALIBRATION_SIZE: int = 128
+_CALIBRATION_VIEWPORT: tuple[float, float] = (2.0, 2.0)
+_CALIBRATION_RAYS: int = 256
+_CALIBRATION_ITERATIONS: tuple[int, ...] = (1, 2, 4, 8, 16)
+_CALIBRATION_DEFLECTION: tuple[int, int] = (256, 1024)
+_CALIBRATION_RANGE: tuple[float, float] = (0.3, 1.8)
+
+_calibrations: dict[tuple[str, str], "IRSCalibration"] = {}
+
+
+class IRSCalibration(NamedTuple):
+    device: str
+    jitter: str
+    pass_overhead: float  # In seconds
+    rays_per_second: float
+    texels_per_second: float  # Of a one lens deflection map
+    noise_scale: float
+    noise_power: float
+    bias_scale: float
+    bias_power: float
+    max_texture_size: int
+
+    def get_pass_time(self, count: int) -> float:
+        return self.pass_overhead + count * count / self.rays_per_second
+
+    def get_deflection_time(self, size: int, lenses: int = 1) -> float:
+        return lenses * size * size / self.texels_per_second
+
+    def get_noise(self, rays_per_pixel: float) -> float:
+        return self.noise_scale * rays_per_pixel**-self.noise_power
+
+    def get_bias(self, spacing: float) -> float:
+        return self.bias_scale * spacing**self.bias_power
+
+
+class IRSPlan(NamedTuple):
+    ray_count: int
+    size: tuple[int, int]
+    deflection_size: int
+    iterations: int
+    viewport: tuple[float, float]
+    deflection_viewport: tuple[float, float]
+    jitter: str
+    error: float  # The expected relative magnification error
+    time: float  # The expected seconds to generate the histogram
+    memory: int  # The bytes of the histogram and deflection map textures
+
+    def create(self, system: System, ctx: ArcadeContext | None = None) -> IRSHistogram:
+        """
+        Create the deflection map and histogram of the plan. The deflection map is
+        generated, but the histogram must still be generated for `iterations`.
+        """
+        deflection = IRSDeflectionMap(
+            system,
+            (self.deflection_size, self.deflection_size),
+            viewport=self.deflection_viewport,
+            ctx=ctx,
+        )
+        deflection.generate()
+        return IRSHistogram(
+            self.ray_count,
+            self.size,
+            deflection,
+            viewport=self.viewport,
+            jitter=self.jitter,
+        )
+
+
+def get_device_name(ctx: ArcadeContext) -> str:
+    return f"{ctx.info.VENDOR} {ctx.info.RENDERER}"
+
+
+def _get_magnification_error(histogram: IRSHistogram, exact: np.ndarray, mask: np.ndarray) -> float:
+    magnification = histogram.read() / get_rays_per_pixel(histogram)
+    return float(np.sqrt(np.mean((magnification[mask] / exact[mask] - 1.0) ** 2)))
+
+
+def _fit_power(x: np.ndarray, y: np.ndarray) -> tuple[float, float]:
+    # Fit y = scale * x ** power in log-log space
+    power, log_scale = np.polyfit(np.log(x), np.log(y), 1)
+    return float(np.exp(log_scale)), float(power)
+
+
+def _time_passes(histogram: IRSHistogram, passes: int) -> float:
+    histogram.generate(1)  # Compile and upload everything before timing
+    start = perf_counter()
+    histogram.generate(passes)
+    return (perf_counter() - start) / passes
+
+
+def _load_calibrations(path: Path):
+    if not path.exists():
+        return
+    with open(path, "rb") as fp:
+        data = load_toml(fp)
+    for entry in data.get("calibration", ()):
+        calibration = IRSCalibration(**entry)
+        _calibrations[(calibration.device, calibration.jitter)] = calibration
+
+
+def _dump_calibrations(path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as fp:
+        dump_toml({"calibration": [entry._asdict() for entry in _calibrations.values()]}, fp)
+
+
+def calibrate(
+    ctx: ArcadeContext | None = None,
+    *,
+    jitter: str = "r2",
+    path: Path | str | None = None,
+    force: bool = False,
+) -> IRSCalibration:
+    """
+    Measure the speed and error of histograms on the context's device, by default the
+    current window's. The result is cached per device, and loaded from and saved to
+    the toml file at `path` if one is given. `force` recalibrates regardless.
+    """
+    if jitter not in IRS_JITTER_MODES:
+        logger.error(f"Unknown jitter mode {jitter}. Expected one of {tuple(IRS_JITTER_MODES)}")
+        raise ValueError(f"Unknown jitter mode {jitter}. Expected one of {tuple(IRS_JITTER_MODES)}")
+
+    ctx = get_window().ctx if ctx is None else ctx
+    key = (get_device_name(ctx), jitter)
+    path = None if path is None else Path(path)
+    if not force:
+        if key not in _calibrations and path is not None:
+            _load_calibrations(path)
+        if key in _calibrations:
+            return _calibrations[key]
+
+    logger.info(f"Calibrating IRS histograms with {jitter} jitter on {key[0]}")
+    system = System.create(4000.0, 8000.0, Lens(1.0, 0.0, 0.0))
+    size = _CALIBRATION_SIZE
+
+    # The exact magnification at each pixel centre, with the rows from the top to match read()
+    v_x, v_y = _CALIBRATION_VIEWPORT
+    centres = (np.arange(size) + 0.5) / size * 2.0 - 1.0
+    x, y = np.meshgrid(centres * v_x, centres[::-1] * v_y)
+    locations = np.stack((x.ravel(), y.ravel()), axis=-1)
+    exact = one_lens_amplificiation(system, locations).reshape((size, size))
+    separation = np.hypot(x, y)
+    mask = (separation > _CALIBRATION_RANGE[0]) & (separation < _CALIBRATION_RANGE[1])
+
+    # Direct rays have no interpolation bias, so their error is only the noise
+    low, high = _CALIBRATION_DEFLECTION
+    deflection = IRSDeflectionMap(system, (low, low), ctx=ctx)
+    deflection.generate()
+    direct = IRSHistogram(
+        _CALIBRATION_RAYS,
+        (size, size),
+        deflection,
+        viewport=_CALIBRATION_VIEWPORT,
+        jitter=jitter,
+        mode="direct",
+    )
+    rays, errors = [], []
+    for iterations in _CALIBRATION_ITERATIONS:
+        direct.generate(iterations - direct.iterations)
+        rays.append(get_rays_per_pixel(direct))
+        errors.append(_get_magnification_error(direct, exact, mask))
+    noise_scale, noise_power = _fit_power(np.asarray(rays), np.asarray(errors))
+
+    # Interpolated rays with the same jitter land where the direct rays would if the
+    # map were exact, so the difference between them is the interpolation error
+    biases = []
+    reference = direct.read()
+    deflection_time = 0.0
+    for deflection_size in _CALIBRATION_DEFLECTION:
+        if deflection_size != low:
+            deflection.release()
+            deflection = IRSDeflectionMap(
+                system, (deflection_size, deflection_size), ctx=ctx, lazy=True
+            )
+            deflection.initialise()
+            ctx.finish()
+            start = perf_counter()
+            deflection.generate()
+            ctx.finish()
+            deflection_time = perf_counter() - start
+        interpolated = IRSHistogram(
+            _CALIBRATION_RAYS,
+            (size, size),
+            deflection,
+            viewport=_CALIBRATION_VIEWPORT,
+            jitter=jitter,
+        )
+        interpolated.generate(direct.iterations)
+        difference = interpolated.read()[mask] - reference[mask]
+        biases.append(float(np.sqrt(np.mean(difference**2)) / np.mean(reference[mask])))
+        interpolated.release()
+    spacing = 2.0 * deflection.viewport_x / np.asarray(_CALIBRATION_DEFLECTION)
+    bias_scale, bias_power = _fit_power(spacing, np.maximum(np.asarray(biases), 1e-12))
+    direct.release()
+
+    # The time of a pass grows with the rays, on top of a fixed cost to submit it
+    counts = (_CALIBRATION_RAYS, 4 * _CALIBRATION_RAYS)
+    times = []
+    for count in counts:
+        histogram = IRSHistogram(count, (size, size), deflection, jitter=jitter)
+        times.append(_time_passes(histogram, 4))
+        histogram.release()
+    deflection.release()
+    rays_per_second = (counts[1] ** 2 - counts[0] ** 2) / max(times[1] - times[0], 1e-9)
+    pass_overhead = max(times[0] - counts[0] ** 2 / rays_per_second, 0.0)
+    texels_per_second = high * high / max(deflection_time, 1e-9)
+
+    calibration = IRSCalibration(
+        key[0],
+        jitter,
+        pass_overhead,
+        rays_per_second,
+        texels_per_second,
+        noise_scale,
+        -noise_power,
+        bias_scale,
+        # A fit outside of this means the interpolation error was lost in the noise
+        float(np.clip(bias_power, 1.0, 3.0)),
+        ctx.info.MAX_TEXTURE_SIZE,
+    )
+    logger.info(f"Calibrated {calibration}")
+    _calibrations[key] = calibration
+    if path is not None:
+        _dump_calibrations(path)
+    return calibration
+
+
+def plan_histogram(
+    target_error: float,
+    *,
+    size: tuple[int, int] = (1024, 1024),
+    viewport: tuple[float, float] = (2.0, 2.0),
+    deflection_viewport: tuple[float, float] = (3.0, 3.0),
+    time_budget: float | None = None,
+    memory_budget: int | None = None,
+    max_pass_time: float = 0.25,
+    lenses: int = 1,
+    calibration: IRSCalibration | None = None,
+    ctx: ArcadeContext | None = None,
+) -> IRSPlan:
+    """
+    Find the fastest histogram of the given size that reaches the target relative
+    magnification error within the time (seconds) and memory (bytes) budgets. The
+    time includes generating the deflection map of a system with `lenses` lenses.
+    Passes are kept under `max_pass_time` so the GPU is never blocked for long.
+
+    Plans have at most IRS_PLAN_MAX_ITERATIONS iterations. If no plan reaches the
+    target within the budgets and that limit the most accurate plan that fits is
+    returned with a warning. Where the interpolation bias alone misses the target
+    the iterations only bring the noise well under the bias, as more could barely
+    improve the error. If not even one pass fits in the budgets a ValueError is
+    raised. The calibration defaults to `calibrate(ctx)`.
+    """
+    if target_error <= 0.0:
+        logger.error(f"The target error must be positive, not {target_error}")
+        raise ValueError(f"The target error must be positive, not {target_error}")
+    calibration = calibrate(ctx) if calibration is None else calibration
+
+    w, h = size
+    # The rays that land in each pixel each pass for every ray along an axis
+    overlap = (viewport[0] / deflection_viewport[0]) * (viewport[1] / deflection_viewport[1])
+    counts = [
+        count
+        for count in IRS_PLAN_RAY_COUNTS
+        if count == IRS_PLAN_RAY_COUNTS[0] or calibration.get_pass_time(count) <= max_pass_time
+    ]
+
+    best: IRSPlan | None = None
+    fallback: IRSPlan | None = None
+    skipped_memory = False
+    skipped_time = False
+    for deflection_size in IRS_PLAN_DEFLECTION_SIZES:
+        if deflection_size > calibration.max_texture_size:
+            continue
+        memory = IRS_HISTOGRAM_BYTES * w * h + IRS_DEFLECTION_BYTES * deflection_size**2
+        if memory_budget is not None and memory > memory_budget:
+            skipped_memory = True
+            continue
+        bias = calibration.get_bias(2.0 * deflection_viewport[0] / deflection_size)
+        deflection_time = calibration.get_deflection_time(deflection_size, lenses)
+        for count in counts:
+            pass_time = calibration.get_pass_time(count)
+            if time_budget is not None and deflection_time + pass_time > time_budget:
+                # Not even one pass fits in the time budget
+                skipped_time = True
+                continue
+            rays_per_pass = count * count * overlap / (w * h)
+
+            # The rays needed for the noise to take up the rest of the error. If the
+            # bias misses the target anyway, the rays to bring the noise well under it
+            reachable = bias < target_error
+            noise = np.sqrt(target_error**2 - bias**2) if reachable else 0.1 * bias
+            rays = (calibration.noise_scale / noise) ** (1.0 / calibration.noise_power)
+            iterations = max(1, int(np.ceil(rays / rays_per_pass)))
+            limit = IRS_PLAN_MAX_ITERATIONS
+            if time_budget is not None:
+                limit = min(limit, int((time_budget - deflection_time) / pass_time))
+            reachable = reachable and iterations <= limit
+            iterations = min(iterations, limit)
+
+            plan = IRSPlan(
+                count,
+                size,
+                deflection_size,
+                iterations,
+                viewport,
+                deflection_viewport,
+                calibration.jitter,
+                float(np.hypot(bias, calibration.get_noise(iterations * rays_per_pass))),
+                deflection_time + iterations * pass_time,
+                memory,
+            )
+            if reachable:
+                if best is None or (plan.time, plan.memory) < (best.time, best.memory):
+                    best = plan
+            elif fallback is None or (plan.error, plan.time) < (fallback.error, fallback.time):
+                # Otherwise keep the most accurate configuration in case none reach it
+                fallback = plan
+
+    if best is not None:
+        return best
+    if fallback is None:
+        # Every configuration was skipped
+        if skipped_time:
+            logger.error(f"No histogram of size {size} fits in {time_budget} seconds")
+            raise ValueError(f"No histogram of size {size} fits in {time_budget} seconds")
+        if memory_budget is not None and skipped_memory:
+            logger.error(f"No histogram of size {size} fits in {memory_budget} bytes")
+            raise ValueError(f"No histogram of size {size} fits in {memory_budget} bytes")
+        logger.error(
+            f"No deflection map size fits within the max texture size {calibration.max_texture_size}"
+        )
+        raise ValueError(
+            f"No deflection map size fits within the max texture size {calibration.max_texture_size}"
+        )
+    logger.warning(
+        f"No histogram reaches an error of {target_error} within the budgets and iteration limit, "
+        f"the best reaches {fallback.error:.4g}"
+    )
+    return fallback
@@ -0,0 +1,213 @@
+"""
+Reducing textures to a few numbers on the GPU.
+
+Statistics and normalisation only need a handful of values from a histogram or map,
+so rather than reading the whole texture to the host it is reduced on the GPU and
+only the result is read. The maximum, minimum, sum and sum of squares come from a
+chain of passes which each reduce blocks of texels, and the distribution of the log
+of the values is binned by drawing one point per texel onto the pixel of its bin.
+
+Each context has one IRSReducer which keeps the chain for every size of texture it
+has reduced, use `get_reducer()` rather than creating it directly.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+from arcade import ArcadeContext, get_window
+import arcade.gl as gl
+
+from GMLID.resources import get_resources
+from GMLID.logging import get_logger
+
+logger = get_logger("physics.reduction")
+
+
+class IRSStatistics(NamedTuple):
+    maximum: float
+    minimum: float
+    total: float
+    squares: float  # The sum of the squares of the values
+    count: int  # The number of texels reduced
+
+    def get_mean(self) -> float:
+        return self.total / self.count
+
+    def get_variance(self) -> float:
+        mean = self.get_mean()
+        return max(self.squares / self.count - mean * mean, 0.0)
+
+    def scale(self, factor: float) -> "IRSStatistics":
+        """
+        The statistics of the values multiplied by a positive factor.
+        """
+        return IRSStatistics(
+            self.maximum * factor,
+            self.minimum * factor,
+            self.total * factor,
+            self.squares * factor * factor,
+            self.count,
+        )
+
+
+class IRSReducer:
+    """
+    The IRSReducer reduces textures on one context. Each pass of the chain reduces
+    blocks of `BLOCK` x `BLOCK` texels, so a 8192x8192 texture takes five passes and
+    only 16 bytes are read back.
+    """
+
+    # The texels along each axis reduced by one texel of the next pass
+    BLOCK: int = 8
+    # The most texels binned into one row, a float only counts exactly up to 2^24
+    BIN_BATCH: int = 1 << 24
+
+    def __init__(self, ctx: ArcadeContext) -> None:
+        self._ctx: ArcadeContext = ctx
+        self._chains: dict[tuple[int, int], list[tuple[gl.Texture2D, gl.Framebuffer]]] = {}
+        self._bins: dict[tuple[int, int], tuple[gl.Texture2D, gl.Framebuffer]] = {}
+
+    @property
+    def ctx(self) -> ArcadeContext:
+        return self._ctx
+
+    def _get_chain(self, size: tuple[int, int]) -> list[tuple[gl.Texture2D, gl.Framebuffer]]:
+        chain = self._chains.get(size)
+        if chain is not None:
+            return chain
+
+        chain = []
+        w, h = size
+        while (w, h) != (1, 1):
+            w, h = -(-w // self.BLOCK), -(-h // self.BLOCK)
+            texture = self._ctx.texture((w, h), components=4, dtype="f4")
+            chain.append((texture, self._ctx.framebuffer(color_attachments=texture)))
+        self._chains[size] = chain
+        logger.debug(f"Created a {len(chain)} pass reduction chain for {size}")
+        return chain
+
+    def _get_bins(self, bins: int, rows: int) -> tuple[gl.Texture2D, gl.Framebuffer]:
+        target = self._bins.get((bins, rows))
+        if target is None:
+            texture = self._ctx.texture((bins, rows), components=1, dtype="f4")
+            target = self._bins[bins, rows] = (
+                texture,
+                self._ctx.framebuffer(color_attachments=texture),
+            )
+        return target
+
+    def reduce(self, texture: gl.Texture2D, component: int = 0) -> IRSStatistics:
+        """
+        The maximum, minimum, sum and sum of squares of one component of a texture.
+        """
+        w, h = texture.size
+        if w * h == 1:
+            value = float(np.frombuffer(texture.read(), dtype=np.float32)[component])
+            return IRSStatistics(value, value, value, value * value, 1)
+
+        # The programs are fetched every time so they survive `release_resources()`
+        resources = get_resources(self._ctx)
+        geometry = resources.get_fullscreen_geometry()
+        program = resources.load_program(
+            vertex_shader="UTIL_unprojected_uv_vs", fragment_shader="IRS_reduce_fs"
+        )
+        program["source"] = 0
+        program["component"] = component
+        program["block"] = self.BLOCK, self.BLOCK
+
+        source = texture
+        for idx, (level, frame) in enumerate(self._get_chain((w, h))):
+            program["first"] = int(idx == 0)
+            with frame.activate():
+                source.use(0)
+                geometry.render(program)
+            source = level
+
+        maximum, minimum, total, squares = np.frombuffer(source.read(), dtype=np.float32)
+        return IRSStatistics(float(maximum), float(minimum), float(total), float(squares), w * h)
+
+    def bin_log(
+        self,
+        texture: gl.Texture2D,
+        bins: int = 64,
+        range: tuple[float, float] = (-1.0, 3.0),
+        scale: float = 1.0,
+        component: int = 0,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Count the texels of one component of a texture in `bins` bins evenly spaced
+        in the log10 of the value times `scale`, between the two log10 in `range`.
+        Like `np.histogram` it returns the counts and the bin edges (in log10), and
+        values outside of the range, zero or negative are not counted.
+        """
+        if bins < 1 or range[1] <= range[0]:
+            logger.error(f"Invalid bins {bins} or range {range}")
+            raise ValueError(f"Invalid bins {bins} or range {range}")
+
+        w, h = texture.size
+        rows = -(-(w * h) // self.BIN_BATCH)
+        target, frame = self._get_bins(bins, rows)
+
+        resources = get_resources(self._ctx)
+        geometry = resources.get_point_geometry()
+        program = resources.load_program(
+            vertex_shader="IRS_reduce_bins_vs", fragment_shader="IRS_reduce_bins_fs"
+        )
+        program["source"] = 0
+        program["component"] = component
+        program["scale"] = scale
+        program["range"] = range
+        program["bins"] = bins
+        program["rows"] = rows
+
+        self._ctx.blend_func = gl.BLEND_ADDITIVE
+        self._ctx.enable(gl.BLEND)
+        self._ctx.point_size = 1
+        with frame.activate() as fbo:
+            fbo.clear()
+            texture.use(0)
+            for row in np.arange(rows).tolist():
+                program["row"] = row
+                first = row * self.BIN_BATCH
+                geometry.render(
+                    program, first=first, vertices=min(self.BIN_BATCH, w * h - first)
+                )
+        self._ctx.disable(gl.BLEND)
+
+        counts = np.frombuffer(target.read(), dtype=np.float32).reshape((rows, bins))
+        return np.sum(counts, axis=0, dtype=np.float64), np.linspace(*range, bins + 1)
+
+    def release(self):
+        for chain in self._chains.values():
+            for texture, frame in chain:
+                frame.delete()
+                texture.delete()
+        for texture, frame in self._bins.values():
+            frame.delete()
+            texture.delete()
+        self._chains = {}
+        self._bins = {}
+
+
+_reducers: dict[ArcadeContext, IRSReducer] = {}
+
+
+def get_reducer(ctx: ArcadeContext | None = None) -> IRSReducer:
+    """
+    Get the shared reducer of a context, by default the current window's.
+    """
+    ctx = get_window().ctx if ctx is None else ctx
+    reducer = _reducers.get(ctx)
+    if reducer is None:
+        reducer = _reducers[ctx] = IRSReducer(ctx)
+    return reducer
+
+
+def release_reducer(ctx: ArcadeContext | None = None):
+    """
+    Release and forget the reduction chains of a context, by default the current window's.
+    """
+    ctx = get_window().ctx if ctx is None else ctx
+    reducer = _reducers.pop(ctx, None)
+    if reducer is not None:
+        reducer.release()
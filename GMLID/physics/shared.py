@@ -0,0 +1,330 @@
+"""
+Sharing maps with analysis workers through shared memory.
+
+A generating process publishes a histogram, deflection map or caustic map into a
+`multiprocessing.shared_memory` block, and hands the small IRSSharedDescriptor to its
+workers. Each worker attaches to the block by the name in the descriptor and gets a
+NumPy view of it, so a whole pool of workers shares one copy of the map.
+
+Textures are read from the GPU straight into the block. The GPU stores rows from the
+bottom, so the descriptor marks the block as flipped and the view reverses it to the
+rows from the top, matching `read()` without copying.
+
+The publishing IRSSharedMap owns the block and unlinks it when it is closed, so it
+must outlive the workers. Workers should drop their views before closing.
+"""
+
+from ctypes import c_ubyte
+from multiprocessing.shared_memory import SharedMemory
+from typing import NamedTuple
+
+import numpy as np
+from pyglet import gl as pgl
+import arcade.gl as gl
+
+from GMLID.logging import get_logger
+
+from .system import System, create_lenses
+from .numerical import (
+    IRSDeflectionMap,
+    IRSHistogram,
+    IRSCausticMap,
+    IRSMagnificationMap,
+    get_rays_per_pixel,
+)
+
+logger = get_logger("physics.shared")
+
+# The GL formats of the float textures read straight into shared memory, by components
+_READ_FORMATS: dict[int, int] = {1: pgl.GL_RED, 2: pgl.GL_RG, 4: pgl.GL_RGBA}
+
+
+class IRSSharedDescriptor(NamedTuple):
+    name: str  # The name of the shared memory block
+    kind: str  # "histogram", "deflection", "magnification" or "caustic"
+    shape: tuple[int, ...]
+    dtype: str
+    flipped: bool  # Whether the rows are stored from the bottom, as on the GPU
+    viewport: tuple[float, float]  # In Einstein radii
+    centre: tuple[float, float]  # The centre of the viewport in the source plane in Einstein radii
+    iterations: int
+    rays_per_pixel: float  # The rays per pixel without lenses, nan if not a histogram
+    lens_distance: float  # In parsecs (pc)
+    source_distance: float  # In parsecs (pc)
+    lenses: tuple[tuple[float, float, float], ...]  # The mass and position of each lens
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def get_system(self) -> System:
+        return System.create(self.lens_distance, self.source_distance, create_lenses(self.lenses))
+
+
+def _describe_system(system: System) -> dict:
+    m, x, y = system.get_lens_columns()
+    return {
+        "lens_distance": system.lens_distance,
+        "source_distance": system.source_distance,
+        "lenses": tuple(zip(m.tolist(), x.tolist(), y.tolist())),
+    }
+
+
+class IRSSharedMap:
+    """
+    A map in a shared memory block. The publisher creates it with `create()` (or one
+    of the `publish_*()` functions) and workers attach with `attach(descriptor)`.
+    Use it as a context manager, or call `close()` once done with `array`.
+    """
+
+    def __init__(
+        self, memory: SharedMemory, descriptor: IRSSharedDescriptor, owner: bool
+    ) -> None:
+        self._memory: SharedMemory | None = memory
+        self._descriptor: IRSSharedDescriptor = descriptor
+        self._owner: bool = owner
+        self._array: np.ndarray | None = np.ndarray(
+            descriptor.shape, dtype=descriptor.dtype, buffer=memory.buf
+        )
+
+    @classmethod
+    def create(
+        cls,
+        kind: str,
+        shape: tuple[int, ...],
+        system: System,
+        *,
+        dtype: str = "float32",
+        flipped: bool = False,
+        viewport: tuple[float, float] = (2.0, 2.0),
+        centre: tuple[float, float] = (0.0, 0.0),
+        iterations: int = 0,
+        rays_per_pixel: float = float("nan"),
+        name: str | None = None,
+    ) -> "IRSSharedMap":
+        """
+        Allocate an uninitialised block for a map of the given shape and dtype.
+        """
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        memory = SharedMemory(name=name, create=True, size=size)
+        descriptor = IRSSharedDescriptor(
+            memory.name,
+            kind,
+            tuple(int(length) for length in shape),
+            np.dtype(dtype).str,
+            flipped,
+            tuple(viewport),
+            tuple(centre),
+            iterations,
+            rays_per_pixel,
+            **_describe_system(system),
+        )
+        logger.debug(f"Created the {size} byte shared {kind} {memory.name}")
+        return cls(memory, descriptor, True)
+
+    @classmethod
+    def attach(cls, descriptor: IRSSharedDescriptor) -> "IRSSharedMap":
+        """
+        Attach to a published block. Only the publisher unlinks the block, so the
+        worker's resource tracker is told to leave it alone.
+        """
+        memory = SharedMemory(name=descriptor.name, track=False)
+        if memory.size < descriptor.nbytes:
+            memory.close()
+            logger.error(f"The shared block {descriptor.name} is smaller than its descriptor")
+            raise ValueError(f"The shared block {descriptor.name} is smaller than its descriptor")
+        return cls(memory, descriptor, False)
+
+    @property
+    def descriptor(self) -> IRSSharedDescriptor:
+        return self._descriptor
+
+    @property
+    def name(self) -> str:
+        return self._descriptor.name
+
+    @property
+    def owner(self) -> bool:
+        return self._owner
+
+    @property
+    def raw(self) -> np.ndarray:
+        """
+        The block as it is stored, with the rows from the bottom if it is flipped.
+        """
+        if self._array is None:
+            logger.error(f"The shared map {self._descriptor.name} is closed")
+            raise ValueError(f"The shared map {self._descriptor.name} is closed")
+        return self._array
+
+    @property
+    def array(self) -> np.ndarray:
+        """
+        A view of the map with the rows from the top, like `read()` of the map.
+        """
+        raw = self.raw
+        return raw[::-1] if self._descriptor.flipped else raw
+
+    def get_system(self) -> System:
+        return self._descriptor.get_system()
+
+    def close(self):
+        """
+        Detach from the block, and unlink it if this is the publisher. Any views of
+        `array` must be dropped first.
+        """
+        if self._memory is None:
+            return
+        self._array = None
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+            logger.debug(f"Unlinked the shared {self._descriptor.kind} {self._descriptor.name}")
+        self._memory = None
+
+    def __enter__(self) -> "IRSSharedMap":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_texture_into(texture: gl.Texture2D, buffer: memoryview, level: int = 0):
+    """
+    Read a float texture into a writable buffer as float32, without a copy on the host.
+    Half float textures are converted by the driver.
+    """
+    w, h = texture.size
+    size = w * h * texture.components * 4
+    if len(buffer) < size:
+        logger.error(f"A {len(buffer)} byte buffer can't hold the {size} bytes of the texture")
+        raise ValueError(f"A {len(buffer)} byte buffer can't hold the {size} bytes of the texture")
+
+    ctx = texture.ctx
+    if ctx.gl_api != "opengl":
+        # GLES can't read textures directly, so it falls back on a copy
+        data = np.frombuffer(texture.read(level), dtype=np.dtype(f"f{texture.component_size}"))
+        np.frombuffer(buffer, dtype=np.float32, count=len(data))[:] = data
+        return
+
+    target = (c_ubyte * size).from_buffer(buffer)
+    pgl.glActiveTexture(pgl.GL_TEXTURE0 + ctx.default_texture_unit)
+    pgl.glBindTexture(pgl.GL_TEXTURE_2D, texture.glo)
+    pgl.glPixelStorei(pgl.GL_PACK_ALIGNMENT, 1)
+    pgl.glGetTexImage(
+        pgl.GL_TEXTURE_2D, level, _READ_FORMATS[texture.components], pgl.GL_FLOAT, target
+    )
+    del target
+
+
+def _publish_texture(
+    texture: gl.Texture2D, kind: str, system: System, name: str | None, **options
+) -> IRSSharedMap:
+    w, h = texture.size
+    components = texture.components
+    shape = (h, w) if components == 1 else (h, w, components)
+    shared = IRSSharedMap.create(kind, shape, system, flipped=True, name=name, **options)
+    try:
+        read_texture_into(texture, shared._memory.buf)
+    except Exception:
+        shared.close()
+        raise
+    return shared
+
+
+def publish_histogram(
+    histogram: IRSHistogram, level: int = 0, name: str | None = None
+) -> IRSSharedMap:
+    """
+    Publish the ray counts of a level of a histogram. Dividing by the descriptor's
+    `rays_per_pixel` gives the magnification.
+    """
+    iterations = histogram.get_iterations(level)
+    return _publish_texture(
+        histogram.get_histogram(level),
+        "histogram",
+        histogram.system,
+        name,
+        viewport=(histogram.viewport_x, histogram.viewport_y),
+        centre=histogram.centre,
+        iterations=iterations,
+        rays_per_pixel=get_rays_per_pixel(histogram, iterations),
+    )
+
+
+def publish_deflection_map(
+    deflection_map: IRSDeflectionMap, name: str | None = None
+) -> IRSSharedMap:
+    """
+    Publish the (height, width, 2) source plane positions of a deflection map. Maps
+    stored as residuals are rebuilt on the host first, which costs one copy.
+    """
+    viewport = (deflection_map.viewport_x, deflection_map.viewport_y)
+    if deflection_map.storage != "residual":
+        return _publish_texture(
+            deflection_map.deflection_map,
+            "deflection",
+            deflection_map.system,
+            name,
+            viewport=viewport,
+        )
+    return publish_array(deflection_map.read(), "deflection", deflection_map.system, name, viewport)
+
+
+def publish_magnification_map(
+    magnification_map: IRSMagnificationMap, name: str | None = None
+) -> IRSSharedMap:
+    histogram = magnification_map.histogram
+    return _publish_texture(
+        magnification_map.magnification_map,
+        "magnification",
+        histogram.system,
+        name,
+        viewport=(histogram.viewport_x, histogram.viewport_y),
+        centre=histogram.centre,
+        iterations=histogram.iterations,
+    )
+
+
+def publish_caustic_map(caustic_map: IRSCausticMap, name: str | None = None) -> IRSSharedMap:
+    """
+    Publish the magnification of an IRSCausticMap, which is already on the host.
+    """
+    histogram = caustic_map.histogram
+    return publish_array(
+        caustic_map.caustic,
+        "caustic",
+        histogram.system,
+        name,
+        (histogram.viewport_x, histogram.viewport_y),
+        histogram.iterations,
+        histogram.centre,
+    )
+
+
+def publish_array(
+    array: np.ndarray,
+    kind: str,
+    system: System,
+    name: str | None = None,
+    viewport: tuple[float, float] = (2.0, 2.0),
+    iterations: int = 0,
+    centre: tuple[float, float] = (0.0, 0.0),
+) -> IRSSharedMap:
+    """
+    Publish a map already on the host, with the rows from the top. This copies it
+    into the block once.
+    """
+    array = np.asarray(array)
+    shared = IRSSharedMap.create(
+        kind,
+        array.shape,
+        system,
+        dtype=array.dtype.str,
+        viewport=viewport,
+        centre=centre,
+        iterations=iterations,
+        name=name,
+    )
+    shared.raw[...] = array
+    return shared
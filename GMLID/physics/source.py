@@ -0,0 +1,83 @@
+"""
+The brightness profile of the lensed source star.
+
+A finite source is a disk whose brightness falls towards its limb. The limb darkening
+laws are written in terms of mu, the cosine of the angle between the line of sight and
+the surface normal, which is sqrt(1 - r^2) at a fraction r of the source's radius.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+from GMLID.logging import get_logger
+
+logger = get_logger("physics.source")
+
+# The number of coefficients each limb darkening law has
+LIMB_DARKENING_LAWS: dict[str, int] = {"uniform": 0, "linear": 1, "quadratic": 2}
+
+
+class SourceProfile(NamedTuple):
+    radius: float  # In Solar Radii (R*)
+    law: str = "uniform"
+    coefficients: tuple[float, ...] = ()
+
+    def get_intensity(self, mu: np.ndarray) -> np.ndarray:
+        """
+        The brightness relative to the centre of the disk for each mu.
+        """
+        if LIMB_DARKENING_LAWS.get(self.law) != len(self.coefficients):
+            logger.error(f"Invalid limb darkening law {self.law} {self.coefficients}")
+            raise ValueError(f"Invalid limb darkening law {self.law} {self.coefficients}")
+
+        match self.law:
+            case "linear":
+                (u,) = self.coefficients
+                return 1.0 - u * (1.0 - mu)
+            case "quadratic":
+                a, b = self.coefficients
+                return 1.0 - a * (1.0 - mu) - b * (1.0 - mu) ** 2
+            case _:
+                return np.ones_like(mu)
+
+
+def uniform_profile(radius: float) -> SourceProfile:
+    return SourceProfile(radius)
+
+
+def linear_profile(radius: float, u: float) -> SourceProfile:
+    return SourceProfile(radius, "linear", (u,))
+
+
+def quadratic_profile(radius: float, a: float, b: float) -> SourceProfile:
+    return SourceProfile(radius, "quadratic", (a, b))
+
+
+def create_source_kernel(profile: SourceProfile, radius: tuple[float, float]) -> np.ndarray:
+    """
+    Sample the profile at the centre of each pixel of a disk with the given radius in
+    pixels along each axis. The kernel is normalised so it sums to one.
+    """
+    # A source smaller than a pixel still covers the pixel it is centred on
+    r_x, r_y = max(radius[0], 1e-6), max(radius[1], 1e-6)
+    e_x, e_y = int(np.floor(r_x)), int(np.floor(r_y))
+    offset_x = np.arange(-e_x, e_x + 1) / r_x
+    offset_y = np.arange(-e_y, e_y + 1) / r_y
+    separation = offset_x[None, :] ** 2 + offset_y[:, None] ** 2
+
+    inside = separation <= 1.0
+    mu = np.sqrt(np.maximum(1.0 - separation, 0.0))
+    kernel = np.where(inside, profile.get_intensity(mu), 0.0)
+    return kernel / np.sum(kernel)
+
+
+def create_source_image(profile: SourceProfile, size: int = 256) -> np.ndarray:
+    """
+    A (size, size) image of the source's disk, its brightness relative to the centre
+    and zero outside of the disk. The image spans the diameter of the source.
+    """
+    offset = (np.arange(size) + 0.5) / size * 2.0 - 1.0
+    separation = offset[None, :] ** 2 + offset[:, None] ** 2
+    mu = np.sqrt(np.maximum(1.0 - separation, 0.0))
+    return np.where(separation <= 1.0, profile.get_intensity(mu), 0.0).astype(np.float32)
@@ -6,11 +6,17 @@ stored in solar masses, and distances are in Au and Parsecs.
 
 The Packed data sent to the GPU is instead fractional based on the
 mass fraction and Einstein angle.
+
+Small systems hold their lenses as a tuple of `Lens`. Large populations (star fields)
+should instead be given as a `LensArray`, a NumPy structured array which is never
+expanded into Python objects. Both are indexed and iterated as `Lens`.
 """
 
-from typing import Generator, Iterable, NamedTuple, Self
+from typing import Any, Generator, Iterable, Iterator, NamedTuple, Self
 from math import tan
 
+import numpy as np
+
 from GMLID.physics.util import calculate_einstein_angle, pc_to_au
 from GMLID.logging import get_logger
 
@@ -23,11 +29,79 @@ class Lens(NamedTuple):
     y: float  # In Astronomical Units (Au)
 
 
+# The layout of a LensArray, the same fields as Lens
+LENS_DTYPE = np.dtype([("m", np.float64), ("x", np.float64), ("y", np.float64)])
+# Loaded systems with more lenses than this hold them as a LensArray rather than Lens tuples
+LENS_ARRAY_THRESHOLD: int = 64
+
+
+class LensArray:
+    """
+    A structured array of lenses with the fields of `Lens`. Indexing a single lens
+    or iterating returns `Lens` tuples, while `m`, `x`, and `y` are views of the columns.
+    Two LensArrays are equal, and hash the same, when they hold the same lenses, so
+    Systems built from them compare by value like Systems of `Lens` tuples.
+    """
+
+    def __init__(self, data: Any) -> None:
+        data = np.asarray(data)
+        if data.dtype.names is None:
+            # An (N, 3) array of mass, x, and y
+            data = np.ascontiguousarray(data, dtype=np.float64).reshape((-1, 3))
+            data = data.view(LENS_DTYPE).reshape(-1)
+        elif data.dtype != LENS_DTYPE:
+            data = data.astype(LENS_DTYPE)
+        self._data: np.ndarray = data.reshape(-1)
+
+    @classmethod
+    def from_lenses(cls, lenses: Iterable[Lens]) -> Self:
+        return cls(np.array([tuple(lens) for lens in lenses], dtype=LENS_DTYPE))
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._data
+
+    @property
+    def m(self) -> np.ndarray:
+        return self._data["m"]
+
+    @property
+    def x(self) -> np.ndarray:
+        return self._data["x"]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self._data["y"]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __getitem__(self, idx: Any) -> Any:
+        if isinstance(idx, (int, np.integer)):
+            m, x, y = self._data[idx].tolist()
+            return Lens(m, x, y)
+        return LensArray(self._data[idx])
+
+    def __iter__(self) -> Iterator[Lens]:
+        return (Lens(m, x, y) for m, x, y in self._data.tolist())
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, LensArray):
+            return NotImplemented
+        return bool(np.array_equal(self._data, other._data))
+
+    def __hash__(self) -> int:
+        return hash(self._data.tobytes())
+
+    def __repr__(self) -> str:
+        return f"LensArray({len(self._data)} lenses)"
+
+
 class System(NamedTuple):
     # Input Values
     lens_distance: float  # In parsecs (pc)
     source_distance: float  # In parsces (pc)
-    lenses: tuple[Lens, ...]
+    lenses: tuple[Lens, ...] | LensArray
 
     # Mass
     mass: float  # In solar masses (M*)
@@ -44,10 +118,11 @@ class System(NamedTuple):
         cls,
         lens_distance: float,
         source_distance: float,
-        lenses: Iterable[Lens] | Lens,
+        lenses: Iterable[Lens] | Lens | LensArray | np.ndarray,
     ) -> Self:
         """
         Create a lens system, and precalculate values required in calculations.
+        A LensArray or NumPy array of lenses is kept as a LensArray.
         """
         if source_distance <= lens_distance:
             logger.critical(
@@ -57,16 +132,20 @@ class System(NamedTuple):
                 "The distance to the source must be strictly greater than the distance to the lens"
             )
 
-        lenses = (lenses,) if isinstance(lenses, Lens) else tuple(lenses)
+        if isinstance(lenses, np.ndarray):
+            lenses = LensArray(lenses)
+        elif isinstance(lenses, Lens):
+            lenses = (lenses,)
+        elif not isinstance(lenses, LensArray):
+            lenses = tuple(lenses)
         if len(lenses) == 0:
             return cls(lens_distance, source_distance, (), 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
 
         # Collect the total mass and center of mass
-        mass = com_x = com_y = 0.0
-        for lens in lenses:
-            mass += lens.m
-            com_x += lens.x * lens.m
-            com_y += lens.y * lens.m
+        m, x, y = get_lens_columns(lenses)
+        mass = float(np.sum(m))
+        com_x = float(np.dot(x, m))
+        com_y = float(np.dot(y, m))
         if mass <= 0.0:
             logger.critical(
                 f"total system mass ({mass}) is invalid. Ensure all lenses have mass, and none are negative."
@@ -96,6 +175,53 @@ class System(NamedTuple):
             source_radius,
         )
 
+    @property
+    def lens_count(self) -> int:
+        return len(self.lenses)
+
+    def get_lens_columns(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Get the masses and positions of the lenses as arrays.
+        """
+        return get_lens_columns(self.lenses)
+
+    def get_mass_fractions(self) -> np.ndarray:
+        m, _, _ = get_lens_columns(self.lenses)
+        return m / self.mass
+
+    def get_einstein_radii(self) -> np.ndarray:
+        """
+        The Einstein radius of each lens in Einstein radii of the whole system.
+        """
+        return np.sqrt(self.get_mass_fractions())
+
+    def get_packed_positions(self) -> np.ndarray:
+        """
+        The (N, 2) positions of the lenses relative to the center of mass in Einstein radii.
+        """
+        _, x, y = get_lens_columns(self.lenses)
+        Rl = self.lens_radius
+        return np.stack(((x - self.com_x) / Rl, (y - self.com_y) / Rl), axis=-1)
+
+    def pack_lens_block(self) -> np.ndarray:
+        """
+        Pack the lenses into a float32 array with the std430 layout of the lens block,
+        two 32-bit ints (count, reserved) followed by a vec4 per lens. The array supports
+        the buffer protocol, so it can be written to a GL buffer without copying.
+        """
+        count = len(self.lenses)
+        block = np.zeros(2 + 4 * count, dtype=np.float32)
+        block[:2].view(np.int32)[0] = count
+        if count == 0:
+            return block
+
+        packed = block[2:].reshape((count, 4))
+        m, _, _ = get_lens_columns(self.lenses)
+        packed[:, 0] = m  # The mass is unneccisary, but due to byte alignment it is still reserved
+        packed[:, 1] = m / self.mass
+        packed[:, 2:] = self.get_packed_positions()
+        return block
+
     def pack_lenses(self) -> Generator[float, None, None]:
         c_x = self.com_x
         c_y = self.com_y
@@ -109,3 +235,26 @@ class System(NamedTuple):
             yield (lens.m / M)
             yield (lens.x - c_x) / Rl
             yield (lens.y - c_y) / Rl
+
+
+def create_lenses(table: np.ndarray) -> tuple[Lens, ...] | LensArray:
+    """
+    Create the lenses of a system from an (N, 3) table of mass, x, and y. Small
+    systems get a tuple of `Lens`, and more than LENS_ARRAY_THRESHOLD lenses a LensArray.
+    """
+    table = np.asarray(table, dtype=np.float64).reshape((-1, 3))
+    if len(table) > LENS_ARRAY_THRESHOLD:
+        return LensArray(table)
+    return tuple(Lens(m, x, y) for m, x, y in table.tolist())
+
+
+def get_lens_columns(
+    lenses: tuple[Lens, ...] | LensArray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get the masses, x, and y of the lenses as float64 arrays.
+    """
+    if isinstance(lenses, LensArray):
+        return lenses.m, lenses.x, lenses.y
+    table = np.array(lenses, dtype=np.float64).reshape((-1, 3))
+    return table[:, 0], table[:, 1], table[:, 2]
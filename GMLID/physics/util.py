@@ -32,3 +32,20 @@ def calculate_einstein_angle(mass: float, lens: float, source: float) -> float:
             "lens or source plane distance is invalid and the einstein angle cannot be calculated"
         )
     return (EINSTEIN_FACTOR * mass * (source - lens) / (source * lens)) ** 0.5
+
+
+# The plastic number, the generator of the R2 low-discrepancy sequence
+PLASTIC_NUMBER = 1.32471795724474602596
+
+
+def get_r2_offset(index: int) -> tuple[float, float]:
+    """
+    Get the index-th point of the 2D R2 low-discrepancy sequence in [0.0, 1.0).
+
+    Successive points fill the unit square far more evenly than pseudo-random
+    samples, so jitter taken from the sequence converges closer to 1/N than 1/sqrt(N).
+    """
+    return (
+        (0.5 + index / PLASTIC_NUMBER) % 1.0,
+        (0.5 + index / PLASTIC_NUMBER**2) % 1.0,
+    )
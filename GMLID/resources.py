@@ -0,0 +1,142 @@
+"""
+The shader programs and static geometry shared by every IRS object on a context.
+
+Programs are compiled once per context for each shader set and defines, and the
+quad geometry is only ever uploaded once per size. Because programs are shared,
+objects must set their uniforms every time they render rather than once at creation.
+
+Long running processes should call `release_resources()` once they are finished with
+a context, as the registry otherwise keeps every program and buffer alive.
+"""
+
+from typing import Any
+
+from arcade import ArcadeContext, get_window
+import arcade.gl as gl
+
+from GMLID.util import get_glsl, get_symmetric_byte_data, get_uv_byte_data
+from GMLID.logging import get_logger
+
+logger = get_logger("resources")
+
+
+class IRSResources:
+    """
+    The IRSResources is a registry of the programs and geometry for one context.
+    Use `get_resources()` rather than creating it directly so it is shared.
+    """
+
+    def __init__(self, ctx: ArcadeContext) -> None:
+        self._ctx: ArcadeContext = ctx
+
+        self._programs: dict[tuple[str, str | None, tuple[tuple[str, str], ...]], gl.Program] = {}
+        self._geometry: dict[tuple[Any, ...], gl.Geometry] = {}
+        self._buffers: list[gl.Buffer] = []
+
+    @property
+    def ctx(self) -> ArcadeContext:
+        return self._ctx
+
+    @property
+    def program_count(self) -> int:
+        return len(self._programs)
+
+    def load_program(
+        self,
+        *,
+        vertex_shader: str,
+        fragment_shader: str | None = None,
+        defines: dict[str, Any] | None = None,
+    ) -> gl.Program:
+        """
+        Get the compiled program for the named glsl shaders and defines, compiling it
+        if it hasn't been used on this context yet.
+        """
+        defines = {name: str(value) for name, value in (defines or {}).items()}
+        key = (vertex_shader, fragment_shader, tuple(sorted(defines.items())))
+        program = self._programs.get(key)
+        if program is not None:
+            return program
+
+        program = self._ctx.load_program(
+            vertex_shader=get_glsl(vertex_shader),
+            fragment_shader=None if fragment_shader is None else get_glsl(fragment_shader),
+            defines=defines,
+        )
+        self._programs[key] = program
+        logger.debug(f"Compiled {vertex_shader} {fragment_shader} with {defines}")
+        return program
+
+    def _create_geometry(self, key: tuple[Any, ...], data: bytes | None) -> gl.Geometry:
+        geometry = self._geometry.get(key)
+        if geometry is not None:
+            return geometry
+
+        if data is None:
+            geometry = self._ctx.geometry(mode=gl.POINTS)
+        else:
+            buffer = self._ctx.buffer(data=data)
+            self._buffers.append(buffer)
+            geometry = self._ctx.geometry(
+                [gl.BufferDescription(buffer, "4f", ["in_coordinate"])],
+                mode=gl.TRIANGLE_STRIP,
+            )
+        self._geometry[key] = geometry
+        return geometry
+
+    def get_symmetric_geometry(self, width: float, height: float) -> gl.Geometry:
+        return self._create_geometry(
+            ("symmetric", width, height), get_symmetric_byte_data(width, height)
+        )
+
+    def get_fullscreen_geometry(self) -> gl.Geometry:
+        return self._create_geometry(("fullscreen",), get_uv_byte_data())
+
+    def get_point_geometry(self) -> gl.Geometry:
+        """
+        Geometry with no attributes, for draws that derive everything from gl_VertexID.
+        """
+        return self._create_geometry(("points",), None)
+
+    def release(self):
+        """
+        Delete every program and buffer in the registry. Any object still using them
+        must be re-initialised with `force=True`.
+        """
+        for program in self._programs.values():
+            program.delete()
+        for geometry in self._geometry.values():
+            geometry.flush()
+        for buffer in self._buffers:
+            buffer.delete()
+
+        logger.debug(
+            f"Released {len(self._programs)} programs and {len(self._geometry)} geometries"
+        )
+        self._programs = {}
+        self._geometry = {}
+        self._buffers = []
+
+
+_resources: dict[ArcadeContext, IRSResources] = {}
+
+
+def get_resources(ctx: ArcadeContext | None = None) -> IRSResources:
+    """
+    Get the shared resources of a context, by default the current window's.
+    """
+    ctx = get_window().ctx if ctx is None else ctx
+    resources = _resources.get(ctx)
+    if resources is None:
+        resources = _resources[ctx] = IRSResources(ctx)
+    return resources
+
+
+def release_resources(ctx: ArcadeContext | None = None):
+    """
+    Release and forget the shared resources of a context, by default the current window's.
+    """
+    ctx = get_window().ctx if ctx is None else ctx
+    resources = _resources.pop(ctx, None)
+    if resources is not None:
+        resources.release()
@@ -4,17 +4,56 @@ from typing import TYPE_CHECKING
 from GMLID.logging import setup_logging, get_logger
 
 if TYPE_CHECKING:
-    from arcade import Window
+    from arcade import ArcadeContext, Window
+
+# The IRS shaders use shader storage blocks, which need OpenGL 4.3
+GL_VERSION: tuple[int, int] = (4, 3)
+
+# Contexts only hold a weak reference to their window, so keep every headless window alive
+_headless_windows: list[Window] = []
+
+
+def create_headless_context(device: int | None = None) -> ArcadeContext:
+    """
+    Create an OpenGL 4.3 context without a display, for compute nodes with no X server.
+
+    The context is backed by EGL, so it works with GPU drivers and software
+    rasterisers like llvmpipe alike. Pass it to `IRSDeflectionMap(..., ctx=ctx)`.
+    Worker processes should each create their own context, and on multi-GPU nodes
+    can pick a GPU with `device` (the EGL device index) before their first context.
+    Only the most recently created context is current, so use one per process.
+
+    Headless mode has to be chosen before arcade is imported, so the process must be
+    started with the ARCADE_HEADLESS=1 environment variable.
+    """
+    import pyglet
+    import arcade
+
+    logger = get_logger("setup")
+    if not arcade.headless:
+        logger.error("Headless contexts need ARCADE_HEADLESS=1 set before arcade is imported")
+        raise RuntimeError("Headless contexts need ARCADE_HEADLESS=1 set before arcade is imported")
+
+    if device is not None:
+        pyglet.options.headless_device = device
+
+    window = arcade.Window(1, 1, "GMLID Headless Context", visible=False, gl_version=GL_VERSION)
+    _headless_windows.append(window)
+    logger.debug(f"Created headless context {window.ctx.info.RENDERER}")
+
+    return window.ctx
 
 
 def setup_GMLID() -> Window:
     setup_logging()
     logger = get_logger("setup")
-    from arcade import Window
-
-    window = Window(1, 1, "GMLID Headless Context")
+    import arcade
 
-    window.minimize()
+    if arcade.headless:
+        window = create_headless_context().window
+    else:
+        window = arcade.Window(1, 1, "GMLID Headless Context", gl_version=GL_VERSION)
+        window.minimize()
 
     logger.debug("GMLID setup")
 
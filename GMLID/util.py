@@ -3,6 +3,7 @@ from importlib.resources import path
 from pathlib import Path
 
 from arcade import ArcadeContext
+from arcade.resources import add_resource_handle
 import arcade.gl as gl
 
 import GMLID.glsl as glsl_module
@@ -13,6 +14,10 @@ def get_glsl(name: str) -> Path:
         return pth
 
 
+# Let shaders share code with `#include :gmlid:<name>.glsl`
+add_resource_handle("gmlid", get_glsl("IRS_lens_lib").parent.resolve())
+
+
 def get_symmetric_byte_data(width: float, height: float):
     return pack(
         "16f",
@@ -35,6 +40,29 @@ def get_symmetric_byte_data(width: float, height: float):
     )
 
 
+def get_region_byte_data(x: float, y: float, width: float, height: float):
+    # Like the symmetric data, but centred on (x, y)
+    return pack(
+        "16f",
+        -1.0,
+        -1.0,
+        x - width / 2,
+        y - height / 2,
+        -1.0,
+        1.0,
+        x - width / 2,
+        y + height / 2,
+        1.0,
+        -1.0,
+        x + width / 2,
+        y - height / 2,
+        1.0,
+        1.0,
+        x + width / 2,
+        y + height / 2,
+    )
+
+
 def get_symmetric_geometry(ctx: ArcadeContext, width: float, height: float):
     return ctx.geometry(
         [
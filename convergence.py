@@ -0,0 +1,205 @@
+from functools import partial
+from time import time
+import argparse
+
+import numpy as np
+
+from GMLID import setup_GMLID
+from GMLID.physics import IRSDeflectionMap, IRSHistogram, Lens, System
+from GMLID.physics.analytical import one_lens_amplificiation
+from GMLID.physics.numerical import (
+    IRS_JITTER_MODES,
+    IRS_DEPOSITION_MODES,
+    IRS_RAY_MODES,
+    get_rays_per_pixel,
+)
+from GMLID.logging import get_logger
+
+from generate import test_systems
+
+logger = get_logger("convergence")
+
+# The IRSHistogram options that can be compared, the first mode is the baseline
+COMPARISONS: dict[str, tuple[str, ...]] = {
+    "jitter": tuple(IRS_JITTER_MODES),
+    "deposition": tuple(IRS_DEPOSITION_MODES),
+}
+
+# The separations compared against the analytic single lens, the same range
+# planner.calibrate uses to stay clear of the singularity and the histogram edges
+ANALYTIC_RANGE: tuple[float, float] = (0.3, 1.8)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        "convergence",
+        "Measure how many IRSHistogram iterations each mode of an option needs to reach a noise level",
+    )
+    parser.add_argument(
+        "--compare", choices=tuple(COMPARISONS), default="jitter", help="option to compare"
+    )
+    parser.add_argument("--rays", type=int, default=512, help="rays per axis")
+    parser.add_argument("--size", type=int, default=256, help="histogram width and height")
+    parser.add_argument("--deflection", type=int, default=2048, help="deflection map size")
+    parser.add_argument("--iterations", type=int, default=256, help="iterations to measure up to")
+    parser.add_argument(
+        "--reference", type=int, default=4096, help="iterations used for the reference histogram"
+    )
+    parser.add_argument(
+        "--reference-deposition",
+        choices=tuple(IRS_DEPOSITION_MODES),
+        default="point",
+        help="deposition of the reference, bilinear measures only the noise of bilinear histograms",
+    )
+    parser.add_argument("--systems", type=int, default=len(test_systems), help="systems to test")
+    parser.add_argument(
+        "--analytic",
+        action="store_true",
+        help="measure a single lens against its exact magnification instead of an IRS reference",
+    )
+    parser.add_argument(
+        "--target",
+        type=float,
+        default=None,
+        help="error every mode is compared at, by default the baseline's final error",
+    )
+    parser.add_argument(
+        "--jitter", choices=tuple(IRS_JITTER_MODES), default="random", help="jitter when not compared"
+    )
+    parser.add_argument(
+        "--mode", choices=tuple(IRS_RAY_MODES), default="interpolated", help="ray mode of the histograms"
+    )
+    return parser.parse_args()
+
+
+def get_error(histogram: IRSHistogram, reference: np.ndarray, floor: float = 0.0) -> float:
+    # RMS deviation from the reference as a fraction of the mean ray count, with the
+    # (independent) noise of the reference itself removed in quadrature
+    data = histogram.read() / histogram.iterations
+    error = np.mean((data - reference) ** 2) / np.mean(reference) ** 2
+    return float(np.sqrt(max(error - floor**2, 0.0)))
+
+
+def get_exact_error(histogram: IRSHistogram, exact: np.ndarray, mask: np.ndarray) -> float:
+    # RMS relative deviation of the magnification from the exact one, as planner.calibrate measures it
+    magnification = histogram.read()[mask] / get_rays_per_pixel(histogram)
+    return float(np.sqrt(np.mean((magnification / exact - 1.0) ** 2)))
+
+
+def get_exact_magnification(
+    system: System, histogram: IRSHistogram
+) -> tuple[np.ndarray, np.ndarray]:
+    # The exact magnification at the pixel centres within ANALYTIC_RANGE, with the
+    # rows from the top to match read(). Single precision keeps 8192x8192 in memory
+    x = (np.arange(histogram.width, dtype="f4") + 0.5) / histogram.width * 2.0 - 1.0
+    y = (np.arange(histogram.height, dtype="f4") + 0.5) / histogram.height * 2.0 - 1.0
+    x = x[None, :] * histogram.viewport_x
+    y = y[::-1, None] * histogram.viewport_y
+    separation = np.hypot(x, y)
+    mask = (separation > ANALYTIC_RANGE[0]) & (separation < ANALYTIC_RANGE[1])
+    del separation
+    locations = np.stack(
+        (np.broadcast_to(x, mask.shape)[mask], np.broadcast_to(y, mask.shape)[mask]), axis=-1
+    )
+    return one_lens_amplificiation(system, locations), mask
+
+
+def get_iterations_to_reach(errors: dict[int, float], target: float) -> float:
+    # Interpolate in log-log space between the measured checkpoints
+    checkpoints = sorted(errors)
+    if errors[checkpoints[0]] <= target:
+        return float(checkpoints[0])
+    for low, high in zip(checkpoints, checkpoints[1:]):
+        if errors[high] <= target:
+            if errors[low] <= target:
+                return float(low)
+            t = np.log(errors[low] / target) / np.log(errors[low] / errors[high])
+            return float(np.exp(np.log(low) + t * np.log(high / low)))
+    return float("inf")
+
+
+def main():
+    args = parse_args()
+    window = setup_GMLID()
+
+    if args.analytic:
+        # The single lens planner.calibrate measures, centred so the exact solution applies
+        systems = [System.create(4000.0, 8000.0, Lens(1.0, 0.0, 0.0))]
+    else:
+        systems = test_systems[: args.systems]
+
+    checkpoints = [2**i for i in range(int(np.log2(args.iterations)) + 1)]
+    deflection = IRSDeflectionMap(systems[0], (args.deflection, args.deflection))
+    modes = COMPARISONS[args.compare]
+    histograms = {}
+    for mode in modes:
+        options = {"jitter": args.jitter, "mode": args.mode, args.compare: mode}
+        histograms[mode] = IRSHistogram(args.rays, (args.size, args.size), deflection, **options)
+    # The reference uses independent pseudo-random jitter so it doesn't share
+    # samples with the modes being measured
+    reference_histogram = IRSHistogram(
+        args.rays,
+        (args.size, args.size),
+        deflection,
+        mode=args.mode,
+        deposition=args.reference_deposition,
+    )
+
+    rays_per_pixel = get_rays_per_pixel(reference_histogram, 1)
+    print(f"{args.size}x{args.size} histogram, {rays_per_pixel:.3f} rays per pixel per iteration")
+    print(f"{'system':>6} | {'mode':>8} | " + " | ".join(f"{n:>7}" for n in checkpoints))
+    savings = []
+    for idx, system in enumerate(systems, 1):
+        deflection.update_system(system)
+        deflection.generate()
+
+        if args.analytic:
+            exact, mask = get_exact_magnification(system, reference_histogram)
+            measure = partial(get_exact_error, exact=exact, mask=mask)
+        else:
+            reference_histogram.clear()
+            reference_histogram.step()
+            single = reference_histogram.read()
+            for _ in range(args.reference - 1):
+                reference_histogram.step()
+            reference = reference_histogram.read() / reference_histogram.iterations
+            # Pseudo-random noise falls as 1/sqrt(N) so a single pass predicts the reference's noise
+            floor = np.sqrt(np.mean((single - reference) ** 2)) / np.mean(reference)
+            floor = float(floor / np.sqrt(args.reference))
+            measure = partial(get_error, reference=reference, floor=floor)
+
+        errors: dict[str, dict[int, float]] = {}
+        for mode, histogram in histograms.items():
+            histogram.clear()
+            errors[mode] = {}
+            s_time = time()
+            for n in checkpoints:
+                while histogram.iterations < n:
+                    histogram.step()
+                errors[mode][n] = measure(histogram)
+                # Past the target the remaining checkpoints don't change the result
+                if args.target is not None and errors[mode][n] <= args.target:
+                    break
+            window.ctx.finish()
+            logger.info(f"System{idx} {mode} measured in {time() - s_time} seconds")
+            print(
+                f"{idx:>6} | {mode:>8} | "
+                + " | ".join(f"{errors[mode][n]:>7.4f}" for n in errors[mode])
+            )
+
+        # How many iterations the other mode needs to match the baseline at the target,
+        # by default the baseline's error at the final checkpoint
+        baseline, other = modes
+        target = errors[baseline][checkpoints[-1]] if args.target is None else args.target
+        needed = {mode: get_iterations_to_reach(errors[mode], target) for mode in modes}
+        savings.append(needed[baseline] / needed[other])
+        print(
+            f"System{idx}: {baseline} reaches {target:.4f} in {needed[baseline]:.1f} iterations, "
+            f"{other} in {needed[other]:.1f} ({savings[-1]:.1f}x fewer)"
+        )
+
+    print(f"Mean reduction in iterations: {np.mean(savings):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,40 @@
 from pathlib import Path
 from time import time
 
-from arcade import Window
 import numpy as np
 
 from GMLID.physics import System, Lens, IRSDeflectionMap, IRSHistogram
 from GMLID.io import _dump_histogram_raw
 from GMLID.logging import get_logger
+from GMLID.setup import setup_GMLID
 
 logger = get_logger("generation")
-try:
-    test_systems = (
-        System.create(4000.0, 8000.0, (Lens(0.8, 0.0, 0.0), Lens(0.2, 3.0, 0.0))),
-        System.create(4000.0, 8000.0, (Lens(0.8, 0.0, 0.0), Lens(0.2, 3.5, 0.0))),
-        System.create(4000.0, 8000.0, (Lens(0.8, 0.0, 0.0), Lens(0.2, 4.0, 0.0))),
-        System.create(4000.0, 8000.0, (Lens(0.8, 0.0, 0.0), Lens(0.2, 4.5, 0.0))),
-        System.create(4000.0, 8000.0, (Lens(0.8, 0.0, 0.0), Lens(0.2, 5.0, 0.0))),
-        *(
-            System.create(
-                4000.0,
-                8000.0,
-                (
-                    Lens(0.8, 0.0, 0.0),
-                    Lens(0.2, 4.0, 0.0),
-                    Lens(0.2, -4.0 * np.cos(x), 4.0 * np.sin(x)),
-                ),
-            )
-            for x in np.linspace(0.0, np.pi / 2, 5)
-        ),
-    )
+
+test_systems = (
+    System.create(4000.0, 8000.0, (Lens(0.8, 0.0, 0.0), Lens(0.2, 3.0, 0.0))),
+    System.create(4000.0, 8000.0, (Lens(0.8, 0.0, 0.0), Lens(0.2, 3.5, 0.0))),
+    System.create(4000.0, 8000.0, (Lens(0.8, 0.0, 0.0), Lens(0.2, 4.0, 0.0))),
+    System.create(4000.0, 8000.0, (Lens(0.8, 0.0, 0.0), Lens(0.2, 4.5, 0.0))),
+    System.create(4000.0, 8000.0, (Lens(0.8, 0.0, 0.0), Lens(0.2, 5.0, 0.0))),
+    *(
+        System.create(
+            4000.0,
+            8000.0,
+            (
+                Lens(0.8, 0.0, 0.0),
+                Lens(0.2, 4.0, 0.0),
+                Lens(0.2, -4.0 * np.cos(x), 4.0 * np.sin(x)),
+            ),
+        )
+        for x in np.linspace(0.0, np.pi / 2, 5)
+    ),
+)
+
+
+def main():
     logger.info("Created Systems")
 
-    win = Window()
+    win = setup_GMLID()
     logger.info("Created Window")
 
     deflection = IRSDeflectionMap(test_systems[0], (16382, 16382))
@@ -66,7 +69,12 @@ try:
 
         _dump_histogram_raw(Path(f"System{idx}.histogram"), histogram)
         logger.info("Dumped Histogram")
-except KeyboardInterrupt:
-    logger.warning("Interrupted Code Execution", exc_info=True)
-except Exception as e:
-    logger.exception(e)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logger.warning("Interrupted Code Execution", exc_info=True)
+    except Exception as e:
+        logger.exception(e)